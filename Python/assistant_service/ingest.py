@@ -6,6 +6,7 @@ from langchain_community.embeddings import HuggingFaceInferenceAPIEmbeddings
 from langchain.text_splitter import CharacterTextSplitter
 from langchain.document_loaders import DirectoryLoader
 from dotenv import load_dotenv
+import job_queue as jq
 
 def process_transcript(podcast_id,episode_id,has_speaker_labels=False):
     """
@@ -48,10 +49,8 @@ def process_transcript(podcast_id,episode_id,has_speaker_labels=False):
             print(f"Transcript not found at {BASE_DIR}/{podcast_id}/{episode_id}.json")
             raise FileNotFoundError(f"Transcript not found at {BASE_DIR}/{podcast_id}/{episode_id}.json")
 
-        # Create a status file to indicate that the ingestion is in progress
-        with open(status_file_path, 'w') as f:
-            f.write('In progress')
-            f.close()
+        # Mark the ingestion step as in progress (also writes the status file)
+        jq.start_step('ingestion', status_file_path)
 
         # Create the embeddings
         embeddings = HuggingFaceInferenceAPIEmbeddings(
@@ -65,20 +64,23 @@ def process_transcript(podcast_id,episode_id,has_speaker_labels=False):
         # Extract the speaker and text values from the JSON transcript
         text_values = [entry['text'] for entry in data]
         
+        # Lines that overlap no speaker turn of the diarization have no speaker
         if(has_speaker_labels):
-            speaker_values = [entry['speaker'] for entry in data]
+            speaker_values = [entry.get('speaker') for entry in data]
 
         # Combine the speaker and text values into a single string
         combined_text = ''
         for i in range(len(text_values)):
-            if(has_speaker_labels and len(speaker_values)>0):
+            if(has_speaker_labels and speaker_values[i] is not None):
                 combined_text += f"{speaker_values[i]}: {text_values[i]}\n"
-            combined_text += f"{text_values[i]}\n"
+            else:
+                combined_text += f"{text_values[i]}\n"
 
         with open(f'{BASE_DIR}/{podcast_id}/{episode_id}_data.txt', 'w') as output_file:
             output_file.write(combined_text)
 
         print("Transcript parsed to text")
+        jq.report_progress(20)
 
         # Load documents from the directory
         transcript_loader = DirectoryLoader(f'{BASE_DIR}/{podcast_id}', glob=f"**/{episode_id}_data.txt")
@@ -93,6 +95,7 @@ def process_transcript(podcast_id,episode_id,has_speaker_labels=False):
         documents = text_splitter.split_documents(documents)
 
         print("Documents split into chunks")
+        jq.report_progress(40)
 
         ids = [str(uuid.uuid5(uuid.NAMESPACE_DNS, doc.page_content)) for doc in documents]
         unique_ids = list(set(ids))
@@ -121,18 +124,15 @@ def process_transcript(podcast_id,episode_id,has_speaker_labels=False):
         # Delete the transcript text file to save space
         os.remove(f'{BASE_DIR}/{podcast_id}/{episode_id}_data.txt')
 
-        # Once the ingestion is done, delete the status file
-        os.remove(status_file_path)
+        # Once the ingestion is done, mark the step as done (also deletes the status file)
+        jq.finish_step(status_file_path)
 
         print("Vectorstore persisted")
         print("Vectorstore collections: " + str(vectorstoreDB._collection.count()))
         print("------------ Ingestion complete ------------")
     except Exception as e:
-        # If an error occurs, update the status file with the error message
-        with open(status_file_path, 'w') as f:
-            f.write('Error\n')
-            f.write(str(e))
-            f.close()
+        # If an error occurs, mark the step as failed (also updates the status file with the error message)
+        jq.fail_step(e, status_file_path)
         
         # If an error occurs, print the error message to the console and raise it again
         print(f"An error occurred: {e}")
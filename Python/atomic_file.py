@@ -0,0 +1,40 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+
+@contextmanager
+def open_atomic(file_path, mode='w'):
+    """
+    Opens a temporary file to write file_path through. The file replaces file_path once the block exits without error,
+    so readers never see a partially written file and a crash never leaves a truncated one behind.
+
+    Example:
+        with open_atomic(file_path, 'wb') as file:
+            np.save(file, array)
+
+    Args:
+        file_path (str): The path of the file to write.
+        mode (str, optional): 'w' for text or 'wb' for binary. Defaults to 'w'.
+    """
+    # Unique per thread, so concurrent writers of the same file never write into the same temporary file
+    tmp_file_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_file_path, mode) as file:
+            yield file
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_file_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_json_atomic(obj, file_path):
+    """
+    Writes an object to a JSON file through a temporary file (see open_atomic).
+    """
+    with open_atomic(file_path) as file:
+        json.dump(obj, file)
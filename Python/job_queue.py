@@ -0,0 +1,536 @@
+import itertools
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from multiprocessing import cpu_count
+
+import torch
+
+# Job statuses, the running and failed statuses match the ones written to the status files
+QUEUED = "Queued"
+RUNNING = "In progress"
+DONE = "Done"
+FAILED = "Error"
+
+# Written to the status file of a job while it waits in the queue, the Backend reads any status containing "progress" as in progress
+QUEUED_STATUS_TEXT = "In progress (queued)"
+
+# Allowed status transitions, done and failed jobs are final
+TRANSITIONS = {
+    QUEUED: (RUNNING, FAILED),
+    RUNNING: (DONE, FAILED),
+    DONE: (),
+    FAILED: (),
+}
+
+# Job priorities, lower values run first
+HIGH_PRIORITY = 0
+DEFAULT_PRIORITY = 5
+LOW_PRIORITY = 10
+
+# Stages, each stage has its own pool of workers
+TTS_STAGE = "tts"
+TTS_STREAM_STAGE = "tts_stream"
+STT_STAGE = "stt"
+INGEST_STAGE = "ingest"
+
+# Pool sizes. TTS and STT share the GPU so they default to a single worker each, ingestion is CPU bound.
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "1"))
+# Stream previews get their own workers so that they never queue behind a multi-minute episode job
+TTS_STREAM_WORKERS = int(os.getenv("TTS_STREAM_WORKERS", "1"))
+STT_WORKERS = int(os.getenv("STT_WORKERS", "1"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(max(1, cpu_count() // 2))))
+
+# Maximum number of jobs waiting in each stage before new requests are rejected
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "16"))
+
+# Number of finished jobs kept in the job store
+MAX_FINISHED_JOBS = int(os.getenv("MAX_FINISHED_JOBS", "500"))
+
+# Whether steps also write the legacy '_status.txt' files polled by the Backend
+STATUS_FILE_WRITE_THROUGH = os.getenv("STATUS_FILE_WRITE_THROUGH", "1") == "1"
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted to a stage whose queue is full.
+    """
+    pass
+
+
+class JobConflictError(Exception):
+    """
+    Raised when a job is submitted for a resource that another queued or running job already holds.
+    """
+    pass
+
+
+class Job:
+    """
+    A unit of work run by a worker pool.
+
+    Attributes:
+        id (str): The unique id of the job.
+        stage (str): The stage whose pool runs the job.
+        name (str): The name of the job (e.g. 'tts_rvc').
+        target (callable): The function run by the job.
+        args (tuple): The positional arguments of the target.
+        kwargs (dict): The keyword arguments of the target.
+        priority (int): The priority of the job, lower values run first.
+        podcast_id (str): The podcast the job works on, if any.
+        episode_id (str): The episode the job works on, if any.
+        resource (str): The resource the job holds while it is queued or running, if any.
+        status_file_path (str): The legacy status file written by the job's step, marked as in progress while the job is queued, if any.
+        status (str): The status of the job (Queued, In progress, Done or Error).
+        step (str): The step the job is currently running (e.g. 'tts', 'rvc').
+        progress (float): The progress of the current step, in percent.
+        error (str): The error message if the job failed.
+        metrics (dict): Measurements reported while the job runs (e.g. time to first audio, in seconds).
+        created_at (float): When the job was submitted.
+        started_at (float): When a worker started the job.
+        finished_at (float): When the job finished.
+    """
+    def __init__(self, stage, name, target, args=(), kwargs=None, priority=DEFAULT_PRIORITY,
+                 podcast_id=None, episode_id=None, resource=None, status_file_path=None):
+        self.id = str(uuid.uuid4())
+        self.stage = stage
+        self.name = name
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.priority = priority
+        self.podcast_id = None if podcast_id is None else str(podcast_id)
+        self.episode_id = None if episode_id is None else str(episode_id)
+        self.resource = resource
+        self.status_file_path = status_file_path
+        self.status = QUEUED
+        self.step = None
+        self.progress = 0.0
+        self.error = None
+        self.metrics = {}
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        """
+        Returns the job as a JSON serializable dict.
+        """
+        return {
+            "id": self.id,
+            "stage": self.stage,
+            "name": self.name,
+            "priority": self.priority,
+            "podcast_id": self.podcast_id,
+            "episode_id": self.episode_id,
+            "status": self.status,
+            "step": self.step,
+            "progress": round(self.progress, 1),
+            "error": self.error,
+            "metrics": dict(self.metrics),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobStore:
+    """
+    In-memory table of jobs, indexed by id and by episode.
+
+    All state changes go through the store under its lock, so checking whether a resource is busy and
+    claiming it is atomic. Every change is published to the subscribers of the job (e.g. SSE streams).
+    """
+    def __init__(self, max_finished_jobs=MAX_FINISHED_JOBS):
+        self.max_finished_jobs = max_finished_jobs
+        self.lock = threading.RLock()
+        self.jobs = OrderedDict()
+        self.by_episode = {}
+        self.active_resources = {}
+        self.subscribers = {}
+
+    def add(self, job):
+        """
+        Adds a queued job to the store and claims its resource.
+
+        Raises:
+            JobConflictError: If another queued or running job holds the resource of the job.
+        """
+        with self.lock:
+            if job.resource is not None:
+                holder = self.active_resources.get(job.resource)
+                if holder is not None:
+                    raise JobConflictError(f"A {self.jobs[holder].name} job is already {self.jobs[holder].status.lower()} for the given episode (job {holder}).")
+                self.active_resources[job.resource] = job.id
+
+            self.jobs[job.id] = job
+            if job.episode_id is not None:
+                self.by_episode.setdefault((job.podcast_id, job.episode_id), []).append(job.id)
+            self.prune()
+
+    def remove(self, job):
+        """
+        Removes a job that could not be queued and releases its resource.
+        """
+        with self.lock:
+            self.release_resource(job)
+            self.jobs.pop(job.id, None)
+            ids = self.by_episode.get((job.podcast_id, job.episode_id))
+            if ids is not None and job.id in ids:
+                ids.remove(job.id)
+                if not ids:
+                    del self.by_episode[(job.podcast_id, job.episode_id)]
+
+    def get(self, job_id):
+        """
+        Returns the job with the given id, or None.
+        """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def find(self, podcast_id, episode_id):
+        """
+        Returns the jobs of the given episode, oldest first.
+        """
+        with self.lock:
+            return [self.jobs[i] for i in self.by_episode.get((str(podcast_id), str(episode_id)), []) if i in self.jobs]
+
+    def list(self):
+        """
+        Returns every job in the store, oldest first.
+        """
+        with self.lock:
+            return list(self.jobs.values())
+
+    def transition(self, job, status, error=None):
+        """
+        Atomically moves a job to a new status.
+
+        Raises:
+            Exception: If the transition is not allowed (e.g. from a final status).
+        """
+        with self.lock:
+            if status not in TRANSITIONS[job.status]:
+                raise Exception(f"Invalid job transition for job {job.id}: {job.status} -> {status}")
+
+            job.status = status
+            if status == RUNNING:
+                job.started_at = time.time()
+            else:
+                job.finished_at = time.time()
+                job.error = error if error is not None else job.error
+                self.release_resource(job)
+            self.publish(job)
+
+    def update_progress(self, job, step=None, progress=None, error=None):
+        """
+        Records the current step and progress of a running job.
+        """
+        with self.lock:
+            if step is not None:
+                job.step = step
+            if progress is not None:
+                job.progress = max(0.0, min(100.0, float(progress)))
+            if error is not None:
+                job.error = error
+            self.publish(job)
+
+    def record_metric(self, job, name, value):
+        """
+        Records a measurement of a job (e.g. time to first audio).
+        """
+        with self.lock:
+            job.metrics[name] = value
+            self.publish(job)
+
+    def release_resource(self, job):
+        with self.lock:
+            if job.resource is not None and self.active_resources.get(job.resource) == job.id:
+                del self.active_resources[job.resource]
+
+    def prune(self):
+        """
+        Drops the oldest finished jobs once more than max_finished_jobs are kept.
+        """
+        with self.lock:
+            finished = [j for j in self.jobs.values() if j.status in (DONE, FAILED)]
+            for job in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+                self.remove(job)
+
+    def subscribe(self, job_id, loop, events):
+        """
+        Subscribes an asyncio queue to the updates of a job.
+
+        Args:
+            job_id (str): The id of the job.
+            loop (asyncio.AbstractEventLoop): The event loop that owns the queue.
+            events (asyncio.Queue): The queue that receives a dict snapshot of the job on every update.
+        """
+        with self.lock:
+            self.subscribers.setdefault(job_id, []).append((loop, events))
+
+    def unsubscribe(self, job_id, events):
+        with self.lock:
+            subscribers = [s for s in self.subscribers.get(job_id, []) if s[1] is not events]
+            if subscribers:
+                self.subscribers[job_id] = subscribers
+            else:
+                self.subscribers.pop(job_id, None)
+
+    def publish(self, job):
+        """
+        Sends a snapshot of the job to its subscribers. Called from worker threads, so events are handed to each event loop.
+        """
+        with self.lock:
+            event = job.to_dict()
+            for loop, events in self.subscribers.get(job.id, []):
+                loop.call_soon_threadsafe(events.put_nowait, event)
+
+
+# The job run by the current worker thread, used by the step functions below
+current = threading.local()
+
+
+def get_current_job():
+    """
+    Returns the job run by the current thread and its store, or (None, None) outside of a worker.
+    """
+    return getattr(current, "job", None), getattr(current, "store", None)
+
+
+def write_status_file(status_file_path, status, error=None):
+    """
+    Writes a legacy status file, or removes it once the step is done.
+    """
+    if not STATUS_FILE_WRITE_THROUGH or status_file_path is None:
+        return
+    if status == DONE:
+        if os.path.isfile(status_file_path):
+            os.remove(status_file_path)
+        return
+    with open(status_file_path, 'w') as f:
+        f.write(status)
+        if error is not None:
+            f.write('\n')
+            f.write(str(error))
+
+
+def clear_queued_status_file(job):
+    """
+    Replaces the queued status file of a job whose target ended without starting its step (e.g. a failed pre-check),
+    so that the Backend does not see it as in progress forever.
+    """
+    if not STATUS_FILE_WRITE_THROUGH or job.status_file_path is None:
+        return
+    try:
+        with open(job.status_file_path, 'r') as f:
+            if f.read() != QUEUED_STATUS_TEXT:
+                return
+    except OSError:
+        return
+    write_status_file(job.status_file_path, FAILED if job.status == FAILED else DONE, job.error)
+
+
+def start_step(step, status_file_path=None):
+    """
+    Marks the start of a step (e.g. 'tts', 'rvc', 'transcription') of the current job.
+
+    Args:
+        step (str): The name of the step.
+        status_file_path (str, optional): The legacy status file of the step, written when write-through is enabled. Defaults to None.
+    """
+    job, store = get_current_job()
+    if job is not None:
+        store.update_progress(job, step=step, progress=0)
+    write_status_file(status_file_path, RUNNING)
+
+
+def report_progress(progress):
+    """
+    Reports the progress of the current step, in percent. Does nothing outside of a worker.
+    """
+    job, store = get_current_job()
+    if job is not None:
+        store.update_progress(job, progress=progress)
+
+
+def record_metric(name, value):
+    """
+    Records a measurement of the current job. Does nothing outside of a worker.
+    """
+    job, store = get_current_job()
+    if job is not None:
+        store.record_metric(job, name, value)
+
+
+def finish_step(status_file_path=None):
+    """
+    Marks the end of the current step.
+    """
+    job, store = get_current_job()
+    if job is not None:
+        store.update_progress(job, progress=100)
+    write_status_file(status_file_path, DONE)
+
+
+def fail_step(error, status_file_path=None):
+    """
+    Marks the current step as failed. The job fails once its target returns, even if the error was handled.
+    """
+    job, store = get_current_job()
+    if job is not None:
+        store.update_progress(job, error=str(error))
+    write_status_file(status_file_path, FAILED, error)
+
+
+class WorkerPool:
+    """
+    A fixed number of worker threads pulling jobs from a bounded priority queue.
+    Jobs of the same priority run in submission order.
+    """
+    def __init__(self, stage, num_workers, store, max_queue_depth=MAX_QUEUE_DEPTH):
+        self.stage = stage
+        self.num_workers = max(1, num_workers)
+        self.store = store
+        self.max_queue_depth = max_queue_depth
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.workers = []
+
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self.work, name=f"{stage}-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job):
+        """
+        Adds a job to the queue.
+
+        Raises:
+            QueueFullError: If the queue already holds max_queue_depth jobs.
+        """
+        with self.lock:
+            if self.queue.qsize() >= self.max_queue_depth:
+                raise QueueFullError(f"The {self.stage} queue is full ({self.max_queue_depth} jobs waiting), try again later.")
+            self.queue.put((job.priority, next(self.counter), job))
+
+    def work(self):
+        """
+        Worker loop, runs jobs one at a time until the process exits.
+        """
+        while True:
+            _, _, job = self.queue.get()
+            try:
+                print(f"[{threading.current_thread().name}] Running {job.name} job {job.id}")
+                self.run(job)
+                print(f"[{threading.current_thread().name}] {job.name} job {job.id}: {job.status}")
+            finally:
+                self.queue.task_done()
+
+    def run(self, job):
+        """
+        Runs the target of a job and records its outcome in the store. Exceptions are recorded, not raised.
+        """
+        self.store.transition(job, RUNNING)
+        current.job, current.store = job, self.store
+        try:
+            job.target(*job.args, **job.kwargs)
+            self.store.transition(job, FAILED if job.error is not None else DONE)
+        except Exception as e:
+            traceback.print_exc()
+            self.store.transition(job, FAILED, str(e))
+        finally:
+            current.job = current.store = None
+            clear_queued_status_file(job)
+
+    def stats(self):
+        """
+        Returns the number of workers and waiting jobs of the pool.
+        """
+        return {"stage": self.stage, "workers": self.num_workers, "queued": self.queue.qsize(), "max_queue_depth": self.max_queue_depth}
+
+
+class JobQueue:
+    """
+    Dispatches jobs to the worker pool of their stage and keeps track of them in the job store.
+    """
+    def __init__(self, pool_sizes, max_queue_depth=MAX_QUEUE_DEPTH):
+        """
+        Args:
+            pool_sizes (dict): The number of workers of each stage.
+            max_queue_depth (int): The maximum number of waiting jobs per stage.
+        """
+        self.store = JobStore()
+        self.pools = {stage: WorkerPool(stage, size, self.store, max_queue_depth) for stage, size in pool_sizes.items()}
+
+    def submit(self, stage, name, target, args=(), kwargs=None, priority=DEFAULT_PRIORITY,
+               podcast_id=None, episode_id=None, resource=None, status_file_path=None):
+        """
+        Creates a job and queues it in the pool of the given stage.
+
+        Args:
+            stage (str): The stage to run the job in.
+            name (str): The name of the job.
+            target (callable): The function to run.
+            args (tuple): The positional arguments of the target.
+            kwargs (dict): The keyword arguments of the target.
+            priority (int): The priority of the job, lower values run first. Default is DEFAULT_PRIORITY.
+            podcast_id (str): The podcast the job works on, used to look jobs up by episode. Default is None.
+            episode_id (str): The episode the job works on, used to look jobs up by episode. Default is None.
+            resource (str): A resource only one queued or running job may hold at a time. Default is None.
+            status_file_path (str): The legacy status file of the job's step, marked as in progress as soon as the job is queued. Default is None.
+
+        Returns:
+            Job: The queued job.
+
+        Raises:
+            QueueFullError: If the queue of the stage is full.
+            JobConflictError: If another job holds the resource.
+        """
+        if stage not in self.pools:
+            raise Exception(f"Unknown stage: {stage}")
+
+        job = Job(stage, name, target, args, kwargs, int(priority), podcast_id, episode_id, resource, status_file_path)
+        self.store.add(job)
+        # Written before the job can start, so the worker's own status always comes last
+        try:
+            write_status_file(status_file_path, QUEUED_STATUS_TEXT)
+        except OSError as e:
+            # e.g. the podcast folder does not exist, the job fails its own checks
+            print(f"WARNING: Could not write the status file of job {job.id}: {e}")
+        try:
+            self.pools[stage].submit(job)
+        except QueueFullError:
+            self.store.remove(job)
+            write_status_file(status_file_path, DONE)
+            raise
+        return job
+
+    def stats(self):
+        """
+        Returns the stats of every pool.
+        """
+        return [pool.stats() for pool in self.pools.values()]
+
+
+def create_job_queue():
+    """
+    Creates the job queue with pools sized for this machine.
+
+    Returns:
+        JobQueue: The job queue.
+    """
+    if not torch.cuda.is_available():
+        print("WARNING: No GPU available, TTS and STT jobs will run on the CPU.")
+
+    return JobQueue({
+        TTS_STAGE: TTS_WORKERS,
+        TTS_STREAM_STAGE: TTS_STREAM_WORKERS,
+        STT_STAGE: STT_WORKERS,
+        INGEST_STAGE: INGEST_WORKERS,
+    })
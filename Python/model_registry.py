@@ -0,0 +1,364 @@
+import gc
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+# Memory budgets for resident models, in GB. A budget of 0 disables eviction for that pool.
+RAM_BUDGET_GB = float(os.getenv("MODEL_RAM_BUDGET_GB", "0"))
+VRAM_BUDGET_GB = float(os.getenv("MODEL_VRAM_BUDGET_GB", "0"))
+
+BYTES_PER_GB = 1024 ** 3
+
+
+class ModelEntry:
+    """
+    A model held by the registry, along with its bookkeeping.
+
+    Attributes:
+        key (tuple): The (kind, checkpoint, device, dtype) key of the model.
+        model (object): The loaded model.
+        size_bytes (int): The estimated memory used by the model.
+        refcount (int): The number of callers currently using the model.
+    """
+    def __init__(self, key, model, size_bytes):
+        self.key = key
+        self.model = model
+        self.size_bytes = size_bytes
+        self.refcount = 0
+
+    @property
+    def pool(self):
+        """
+        Returns the memory pool ('vram' or 'ram') the model counts against.
+        """
+        return get_pool(self.key[2])
+
+
+def get_pool(device):
+    """
+    Returns the memory pool for the given device.
+
+    Args:
+        device (str): The device the model lives on.
+
+    Returns:
+        str: 'vram' for GPU devices, 'ram' otherwise.
+    """
+    device = str(device)
+    return "vram" if device.startswith("cuda") or device.startswith("xpu") else "ram"
+
+
+def get_checkpoint_id(checkpoint):
+    """
+    Returns an identifier for the given checkpoint that changes when the file on disk changes.
+
+    Args:
+        checkpoint (str): The path to the checkpoint, or a model name for models resolved by their library.
+
+    Returns:
+        str: The real path and modification time of the checkpoint if it is a file, the checkpoint otherwise.
+    """
+    checkpoint = str(checkpoint)
+    if os.path.isfile(checkpoint):
+        stat = os.stat(checkpoint)
+        return f"{os.path.realpath(checkpoint)}@{stat.st_mtime_ns}"
+    return checkpoint
+
+
+def estimate_size(model):
+    """
+    Estimates the memory used by a model by summing the size of its parameters and buffers.
+    Objects wrapping torch modules (e.g. TextToSpeech or VC) are inspected one level deep.
+
+    Args:
+        model (object): The model to estimate.
+
+    Returns:
+        int: The estimated size in bytes.
+    """
+    modules = []
+    if isinstance(model, torch.nn.Module):
+        modules.append(model)
+    elif isinstance(model, (tuple, list)):
+        modules.extend(m for m in model if isinstance(m, torch.nn.Module))
+    elif hasattr(model, "__dict__"):
+        modules.extend(m for m in vars(model).values() if isinstance(m, torch.nn.Module))
+
+    size = 0
+    seen = set()
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            if id(tensor) in seen:
+                continue
+            seen.add(id(tensor))
+            size += tensor.numel() * tensor.element_size()
+    return size
+
+
+class ModelRegistry:
+    """
+    Process-wide registry that keeps loaded models resident so that back-to-back requests skip the load.
+
+    Models are keyed by (kind, checkpoint, device, dtype). Each kind has a loader registered by the service
+    that owns it. Callers acquire a model, use it and release it; models that are not in use are evicted
+    in least recently used order once the RAM or VRAM budget is exceeded.
+    """
+    def __init__(self, ram_budget_gb=RAM_BUDGET_GB, vram_budget_gb=VRAM_BUDGET_GB):
+        self.budgets = {
+            "ram": int(ram_budget_gb * BYTES_PER_GB),
+            "vram": int(vram_budget_gb * BYTES_PER_GB),
+        }
+        self.loaders = {}
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.key_locks = {}
+        self.max_resident = {}
+        self.exclusive = set()
+        # Notified whenever a model is released, wakes the callers waiting for an exclusive model
+        self.released = threading.Condition(self.lock)
+
+    def register(self, kind, loader, unloader=None, size_hint_gb=None, max_resident=None, exclusive=False):
+        """
+        Registers the loader for a kind of model.
+
+        Args:
+            kind (str): The kind of model (e.g. 'tortoise', 'rvc', 'whisperx').
+            loader (callable): Called as loader(checkpoint, device, dtype, **kwargs) and returns the loaded model.
+            unloader (callable, optional): Called with the model when it is evicted. Defaults to None.
+            size_hint_gb (float, optional): The size to account for when it cannot be measured (e.g. CTranslate2 models). Defaults to None.
+            max_resident (int, optional): The largest number of models of this kind kept resident, on top of the memory budgets.
+                                          The least recently used ones that are not in use are evicted first. Defaults to None (no limit).
+            exclusive (bool, optional): Whether a model of this kind is used by one caller at a time, for models that keep state
+                                        between calls. acquire() then waits until the model is released. Defaults to False.
+        """
+        with self.lock:
+            self.loaders[kind] = (loader, unloader, size_hint_gb)
+            if exclusive:
+                self.exclusive.add(kind)
+            else:
+                self.exclusive.discard(kind)
+            if max_resident is not None:
+                self.max_resident[kind] = max_resident
+            else:
+                self.max_resident.pop(kind, None)
+
+    def make_key(self, kind, checkpoint, device, dtype):
+        """
+        Builds the registry key for a model.
+
+        Returns:
+            tuple: The (kind, checkpoint id, device, dtype) key.
+        """
+        return (kind, get_checkpoint_id(checkpoint), str(device), str(dtype))
+
+    def acquire(self, kind, checkpoint, device="cpu", dtype="float32", **kwargs):
+        """
+        Returns the resident model for the given key, loading it if needed, and increments its reference count.
+        Every call must be matched by a call to release(). Models of exclusive kinds are only returned once released
+        by their previous caller, so a thread must not acquire the same exclusive model twice.
+
+        Args:
+            kind (str): The kind of model.
+            checkpoint (str): The path to the checkpoint or the name of the model.
+            device (str): The device to load the model on. Default is 'cpu'.
+            dtype (str): The dtype / compute type of the model. Default is 'float32'.
+            kwargs: Extra arguments forwarded to the loader.
+
+        Returns:
+            object: The loaded model.
+
+        Raises:
+            Exception: If no loader is registered for the kind, or if the loader fails.
+        """
+        if kind not in self.loaders:
+            raise Exception(f"No loader registered for model kind '{kind}'.")
+
+        key = self.make_key(kind, checkpoint, device, dtype)
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        # Only one thread loads a given model, the others wait for it and reuse it
+        with key_lock:
+            with self.lock:
+                entry = self.entries.get(key)
+                while entry is not None and kind in self.exclusive and entry.refcount > 0:
+                    self.released.wait()
+                    # The model may have been evicted in the meantime
+                    entry = self.entries.get(key)
+                if entry is not None:
+                    entry.refcount += 1
+                    self.entries.move_to_end(key)
+                    return entry.model
+
+            loader, _, size_hint_gb = self.loaders[kind]
+            print(f"Loading {kind} model: {checkpoint} ({device}, {dtype})")
+            model = loader(checkpoint, device, dtype, **kwargs)
+
+            size_bytes = estimate_size(model)
+            if size_bytes == 0 and size_hint_gb is not None:
+                size_bytes = int(size_hint_gb * BYTES_PER_GB)
+
+            with self.lock:
+                entry = ModelEntry(key, model, size_bytes)
+                entry.refcount = 1
+                self.entries[key] = entry
+                victims = self.pop_over_max_resident(kind) + self.pop_over_budget(entry.pool)
+
+        self.unload(victims)
+        return model
+
+    def release(self, model):
+        """
+        Decrements the reference count of a model returned by acquire().
+        The model stays resident until it is evicted.
+
+        Args:
+            model (object): The model returned by acquire().
+        """
+        with self.lock:
+            entry = next((e for e in self.entries.values() if e.model is model), None)
+            if entry is None:
+                return
+            entry.refcount = max(0, entry.refcount - 1)
+            self.released.notify_all()
+            victims = self.pop_over_max_resident(entry.key[0]) + self.pop_over_budget(entry.pool)
+
+        self.unload(victims)
+
+    @contextmanager
+    def use(self, kind, checkpoint, device="cpu", dtype="float32", **kwargs):
+        """
+        Context manager that acquires a model and releases it on exit.
+
+        Example:
+            with registry.use('whisperx', 'base', 'cuda', 'float16') as model:
+                model.transcribe(audio)
+        """
+        model = self.acquire(kind, checkpoint, device, dtype, **kwargs)
+        try:
+            yield model
+        finally:
+            self.release(model)
+
+    def peek(self, kind, checkpoint, device="cpu", dtype="float32"):
+        """
+        Returns the resident model for the given key without acquiring it, or None if it is not loaded.
+        Only for reading attributes that do not change once the model is loaded (e.g. its sample rate).
+        """
+        with self.lock:
+            entry = self.entries.get(self.make_key(kind, checkpoint, device, dtype))
+            return entry.model if entry is not None else None
+
+    def preload(self, kind, checkpoint, device="cpu", dtype="float32", **kwargs):
+        """
+        Loads a model so that it is resident before the first request uses it.
+        """
+        self.release(self.acquire(kind, checkpoint, device, dtype, **kwargs))
+
+    def pop_over_budget(self, pool):
+        """
+        Removes unused models of the given pool from the registry, least recently used first, until the pool fits its budget.
+        Models in use are never removed, so the pool may stay over budget until they are released.
+        Called with the lock held, the removed entries are then passed to unload() once it is released.
+
+        Returns:
+            list: The removed entries.
+        """
+        budget = self.budgets[pool]
+        if budget <= 0:
+            return []
+
+        victims = []
+        used = sum(e.size_bytes for e in self.entries.values() if e.pool == pool)
+        while used > budget:
+            victim = next((key for key, e in self.entries.items() if e.pool == pool and e.refcount == 0), None)
+            if victim is None:
+                print(f"WARNING: Resident {pool} models use {used / BYTES_PER_GB:.2f}GB, over the {budget / BYTES_PER_GB:.2f}GB budget, but all are in use.")
+                break
+            entry = self.entries.pop(victim)
+            used -= entry.size_bytes
+            victims.append(entry)
+        return victims
+
+    def pop_over_max_resident(self, kind):
+        """
+        Removes unused models of the given kind from the registry, least recently used first, until at most max_resident
+        of them are resident. Models in use are never removed, so the kind may stay over its limit until they are released.
+        Called with the lock held, the removed entries are then passed to unload() once it is released.
+
+        Returns:
+            list: The removed entries.
+        """
+        limit = self.max_resident.get(kind)
+        if limit is None:
+            return []
+
+        keys = [key for key in self.entries if key[0] == kind]
+        victims = [key for key in keys if self.entries[key].refcount == 0][:max(0, len(keys) - limit)]
+        return [self.entries.pop(key) for key in victims]
+
+    def unload(self, entries):
+        """
+        Frees the memory of models removed from the registry. Called without the lock held, as unloading and emptying
+        the CUDA cache are slow and would stall every other acquire and release.
+        """
+        if not entries:
+            return
+
+        for entry in entries:
+            print(f"Evicting {entry.key[0]} model: {entry.key[1]} ({entry.key[2]}, {entry.key[3]})")
+            _, unloader, _ = self.loaders[entry.key[0]]
+            if unloader is not None:
+                unloader(entry.model)
+        # Drop the last references to the models before collecting them
+        del entries[:]
+
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def evict(self, key):
+        """
+        Removes a model from the registry and frees its memory.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.unload([entry])
+
+    def clear(self):
+        """
+        Evicts every model that is not in use.
+        """
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if entry.refcount == 0]
+        for key in keys:
+            self.evict(key)
+
+    def stats(self):
+        """
+        Returns a snapshot of the resident models.
+
+        Returns:
+            list: One dict per model with its kind, checkpoint, device, dtype, size in GB and reference count.
+        """
+        with self.lock:
+            return [
+                {
+                    "kind": entry.key[0],
+                    "checkpoint": entry.key[1],
+                    "device": entry.key[2],
+                    "dtype": entry.key[3],
+                    "size_gb": round(entry.size_bytes / BYTES_PER_GB, 3),
+                    "refcount": entry.refcount,
+                }
+                for entry in self.entries.values()
+            ]
+
+
+# The registry shared by the server and the service pipelines
+registry = ModelRegistry()
@@ -0,0 +1,81 @@
+import os
+import threading
+
+from collections import OrderedDict
+
+from rvc_service.infer.lib.audio import load_audio
+
+# Size of the decoded audio kept in memory, in MB
+AUDIO_CACHE_MB = int(os.getenv("RVC_AUDIO_CACHE_MB", "256"))
+
+
+class AudioCache(object):
+    """
+    A thread-safe LRU cache of decoded audio arrays, bounded by their total size in bytes.
+    Counts its hits, misses and evictions.
+    """
+
+    def __init__(self, max_bytes=AUDIO_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns a copy of the audio saved under key, or None.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key].copy()
+
+    def put(self, key, audio):
+        """
+        Saves a copy of the audio under key, evicting the least recently used audio beyond max_bytes.
+        Audio larger than max_bytes is not cached.
+        """
+        if audio.nbytes > self.max_bytes:
+            return
+        audio = audio.copy()
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key).nbytes
+            self.entries[key] = audio
+            self.size += audio.nbytes
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1].nbytes
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size_mb": round(self.size / 1024 / 1024, 1),
+                "max_mb": round(self.max_bytes / 1024 / 1024, 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+audio_cache = AudioCache()
+
+
+def load_audio_cached(file, sr):
+    """
+    load_audio, reusing the decoded audio of a file until it is modified.
+    """
+    stat = os.stat(file)
+    key = (os.path.realpath(file), stat.st_mtime_ns, stat.st_size, sr)
+    audio = audio_cache.get(key)
+    if audio is None:
+        audio = load_audio(file, sr)
+        audio_cache.put(key, audio)
+    return audio
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+from collections import OrderedDict
+
+import numpy as np
+
+from atomic_file import open_atomic
+
+# Folder where features are saved, empty to keep them in memory only
+FEATURE_CACHE_DIR = os.getenv("RVC_FEATURE_CACHE_DIR", "ServerFiles/Cache/rvc_features")
+
+# Size of the features kept in memory, in MB
+FEATURE_CACHE_MEMORY_MB = int(os.getenv("RVC_FEATURE_CACHE_MEMORY_MB", "512"))
+
+# Size of the features kept on disk, in MB
+FEATURE_CACHE_DISK_MB = int(os.getenv("RVC_FEATURE_CACHE_DISK_MB", "4096"))
+
+
+def audio_hash(audio):
+    """
+    Returns a hash of the samples of an audio array, used to key the features computed from it.
+    """
+    audio = np.ascontiguousarray(audio)
+    return hashlib.sha1(str((audio.dtype, audio.shape)).encode() + audio.data).hexdigest()
+
+
+class FeatureCache(object):
+    """
+    A size-bounded cache of the arrays computed from an input audio (f0, HuBERT features), keyed by the hash of the
+    audio and the parameters they were computed with.
+
+    Arrays are kept in memory up to memory_bytes and saved as <key>.npy files in the cache folder up to disk_bytes.
+    The least recently used ones are dropped first, in memory and on disk.
+    """
+
+    def __init__(self, directory=FEATURE_CACHE_DIR, memory_bytes=FEATURE_CACHE_MEMORY_MB * 1024 * 1024,
+                 disk_bytes=FEATURE_CACHE_DISK_MB * 1024 * 1024):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+
+        self.entries = OrderedDict()
+        self.size = 0
+
+        # Size of the files in the cache folder, None until the folder is first read
+        self.disk_size = None
+
+    @staticmethod
+    def key(*parts):
+        """
+        Returns the key of an array from the audio hash and parameters it was computed with.
+        """
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the array saved under key, or None. The array is shared, copy it before modifying it.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if not self.directory:
+            return None
+        path = os.path.join(self.directory, "%s.npy" % key)
+        try:
+            value = np.load(path)
+            os.utime(path)  # Most recently used
+        except (OSError, ValueError):
+            return None
+        self.remember(key, value)
+        return value
+
+    def put(self, key, value):
+        """
+        Saves a copy of the array under key.
+        """
+        value = np.array(value)
+        self.remember(key, value)
+        if not self.directory or value.nbytes > self.disk_bytes:
+            return
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, "%s.npy" % key)
+            with open_atomic(path, "wb") as file:
+                np.save(file, value)
+        except OSError as e:
+            logger.warning("Could not save features to %s: %s", self.directory, e)
+            return
+        with self.lock:
+            if self.disk_size is not None:
+                self.disk_size += os.path.getsize(path)
+            self.evict_disk()
+
+    def remember(self, key, value):
+        with self.lock:
+            if value.nbytes > self.memory_bytes:
+                return
+            if key in self.entries:
+                self.size -= self.entries.pop(key).nbytes
+            self.entries[key] = value
+            self.size += value.nbytes
+            while self.size > self.memory_bytes:
+                self.size -= self.entries.popitem(last=False)[1].nbytes
+
+    def evict_disk(self):
+        """
+        Removes the least recently used files once the cache folder is over disk_bytes. Called with the lock held.
+        """
+        if self.disk_size is not None and self.disk_size <= self.disk_bytes:
+            return
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy"):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime_ns, stat.st_size, name))
+        self.disk_size = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if self.disk_size <= self.disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                self.disk_size -= size
+            except OSError:
+                pass
+
+
+feature_cache = FeatureCache()
@@ -0,0 +1,80 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+import torch
+
+# Fraction of the GPU memory reserved by the caching allocator above which it is emptied between segments
+MEMORY_PRESSURE = float(os.getenv("RVC_MEMORY_PRESSURE", "0.9"))
+
+# Whether to empty the caching allocator at the end of every job, instead of keeping it warm for the next one
+EMPTY_CACHE_AT_JOB_END = os.getenv("RVC_EMPTY_CACHE_AT_JOB_END", "0") == "1"
+
+
+class MemoryPolicy(object):
+    """
+    Decides when the RVC pipeline releases the memory cached by the CUDA allocator.
+
+    Calling torch.cuda.empty_cache() after every segment hands the cached blocks back to the driver, only for the next
+    segment to request them again, and synchronizes the device each time. The policy keeps the allocator warm across
+    segments and jobs, and only empties it when the reserved memory goes over MEMORY_PRESSURE of the device memory,
+    or at the end of a job when EMPTY_CACHE_AT_JOB_END is set.
+
+    It also measures the peak allocated and reserved memory of each job. The peak counters are per device, so jobs
+    running at the same time on the same GPU are counted together.
+    """
+
+    def __init__(self, device, pressure=MEMORY_PRESSURE, empty_at_job_end=EMPTY_CACHE_AT_JOB_END):
+        self.device = device
+        self.pressure = pressure
+        self.empty_at_job_end = empty_at_job_end
+        self.enabled = "cuda" in str(device) and torch.cuda.is_available()
+        self.total = torch.cuda.get_device_properties(device).total_memory if self.enabled else 0
+
+        # Number of times the cache was emptied in the current job
+        self.num_empties = 0
+
+        # The memory stats of the last finished job
+        self.job_stats = {}
+
+    def start_job(self):
+        self.num_empties = 0
+        if self.enabled:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def after_segment(self):
+        """
+        Called after every segment, empties the cache only under memory pressure.
+        """
+        if self.enabled and torch.cuda.memory_reserved(self.device) > self.pressure * self.total:
+            logger.info(
+                "Emptying CUDA cache, %.0f MB reserved",
+                torch.cuda.memory_reserved(self.device) / 1024 / 1024,
+            )
+            torch.cuda.empty_cache()
+            self.num_empties += 1
+
+    def end_job(self):
+        """
+        Called at the end of a job.
+
+        Returns:
+            dict: The peak allocated, peak reserved and currently reserved memory of the job in MB,
+                along with the number of times the cache was emptied. Empty when not running on CUDA.
+        """
+        if not self.enabled:
+            self.job_stats = {}
+            return self.job_stats
+        self.job_stats = {
+            "gpu_peak_allocated_mb": round(torch.cuda.max_memory_allocated(self.device) / 1024 / 1024, 1),
+            "gpu_peak_reserved_mb": round(torch.cuda.max_memory_reserved(self.device) / 1024 / 1024, 1),
+            "gpu_reserved_mb": round(torch.cuda.memory_reserved(self.device) / 1024 / 1024, 1),
+            "gpu_cache_empties": self.num_empties,
+        }
+        if self.empty_at_job_end:
+            torch.cuda.empty_cache()
+        else:
+            self.after_segment()
+        return self.job_stats
+
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import torch
+
+# Number of neighbours blended for every frame, like the faiss search in Pipeline.vc
+TOP_K = 8
+
+# Largest number of distances computed at once, bounds the memory of DeviceBank.blend
+CHUNK_ELEMENTS = int(os.getenv("RVC_RETRIEVAL_CHUNK_ELEMENTS", str(64 * 1024 * 1024)))
+
+
+class DeviceBank(object):
+    """
+    The feature bank of a speaker kept on the device, searched with a matmul and topk instead of faiss.
+
+    The search is exact, where the faiss indexes of the speakers are IVF indexes searched with nprobe=1, so the
+    neighbours can differ slightly from faiss'.
+    """
+
+    def __init__(self, big_npy, device, is_half):
+        self.vectors = torch.from_numpy(np.ascontiguousarray(big_npy, dtype=np.float32)).to(device)
+        self.sq_norms = self.vectors.pow(2).sum(1)
+        if is_half:
+            self.vectors = self.vectors.half()
+
+    @property
+    def shape(self):
+        return self.vectors.shape
+
+    def blend(self, feats, k=TOP_K):
+        """
+        Replaces every frame by the average of its k nearest neighbours in the bank, weighted by the inverse square
+        of their squared L2 distance.
+
+        Args:
+            feats (torch.Tensor): The frames, of shape (frames, channels), on the bank's device.
+            k (int, optional): The number of neighbours. Defaults to TOP_K.
+
+        Returns:
+            torch.Tensor: The blended frames, of the same shape and dtype as feats.
+        """
+        k = min(k, self.vectors.shape[0])
+        chunk_size = max(1, CHUNK_ELEMENTS // self.vectors.shape[0])
+        out = []
+        for chunk in feats.split(chunk_size):
+            # Squared distances, ||f||^2 - 2 f.b + ||b||^2, accumulated in float32
+            dots = torch.matmul(chunk.to(self.vectors.dtype), self.vectors.T).float()
+            dist = chunk.float().pow(2).sum(1, keepdim=True) - 2 * dots + self.sq_norms
+            score, ix = torch.topk(dist, k, dim=1, largest=False)
+            weight = torch.square(1 / score.clamp_min(1e-12))
+            weight /= weight.sum(dim=1, keepdim=True)
+            out.append((self.vectors[ix].float() * weight.unsqueeze(2)).sum(1))
+        return torch.cat(out).to(feats.dtype)
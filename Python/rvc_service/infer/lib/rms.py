@@ -0,0 +1,62 @@
+import numpy as np
+
+# Number of output samples whose gain is computed at once by change_rms
+BLOCK_SIZE = 1 << 16
+
+
+def frame_rms(y, hop_length):
+    """
+    The RMS of every frame of 2 * hop_length samples, every hop_length samples, of a signal padded with
+    hop_length zeros on each side. Same as librosa.feature.rms(y=y, frame_length=2 * hop_length, hop_length=hop_length).
+
+    Each frame is made of two hops, so the sums of squares are computed once per hop, about BLOCK_SIZE samples at a time,
+    and only O(frames) memory is allocated.
+    """
+    n_hops = -(-y.shape[0] // hop_length)
+    # Sum of squares of every hop, with an empty hop before the first one
+    hop_sums = np.zeros(n_hops + 1)
+    block_hops = max(1, BLOCK_SIZE // hop_length)
+    for start in range(0, n_hops, block_hops):
+        end = min(start + block_hops, n_hops)
+        if end == n_hops:
+            # The last block may end with a partial hop, sum it hop by hop
+            for hop in range(start, end):
+                hop_sums[hop + 1] = np.sum(np.square(y[hop * hop_length : (hop + 1) * hop_length], dtype=np.float64))
+        else:
+            block = y[start * hop_length : end * hop_length].reshape(end - start, hop_length)
+            hop_sums[start + 1 : end + 1] = np.sum(np.square(block, dtype=np.float64), axis=1)
+    n_frames = 1 + y.shape[0] // hop_length
+    power = (hop_sums[:n_frames] + np.append(hop_sums[1:], 0)[:n_frames]) / (2 * hop_length)
+    return np.sqrt(power)
+
+
+def interpolate_at(values, n_out, start, end):
+    """
+    The values of F.interpolate(values, size=n_out, mode="linear") (align_corners=False) at the outputs [start, end).
+    """
+    scale = values.shape[0] / n_out
+    src = np.maximum((np.arange(start, end) + 0.5) * scale - 0.5, 0)
+    index0 = np.minimum(src.astype(np.int64), values.shape[0] - 1)
+    index1 = np.minimum(index0 + 1, values.shape[0] - 1)
+    weight1 = src - index0
+    return values[index0] * (1 - weight1) + values[index1] * weight1
+
+
+def change_rms(data1, sr1, data2, sr2, rate):  # 1是输入音频，2是输出音频,rate是2的占比
+    """
+    Mixes the loudness envelope of the input (data1) into the output (data2), in place:
+    data2 is multiplied by rms1 ** (1 - rate) * rms2 ** (rate - 1), with both RMS envelopes measured every half second
+    and linearly interpolated to every sample of data2.
+
+    The envelopes are computed at frame rate and the gain is applied BLOCK_SIZE samples at a time, so apart from data2
+    itself the memory used is O(frames) instead of O(samples).
+    """
+    rms1 = frame_rms(data1, sr1 // 2)  # 每半秒一个点
+    rms2 = frame_rms(data2, sr2 // 2)
+    for start in range(0, data2.shape[0], BLOCK_SIZE):
+        end = min(start + BLOCK_SIZE, data2.shape[0])
+        gain1 = interpolate_at(rms1, data2.shape[0], start, end)
+        gain2 = np.maximum(interpolate_at(rms2, data2.shape[0], start, end), 1e-6)
+        data2[start:end] *= np.power(gain1, 1 - rate) * np.power(gain2, rate - 1)
+    return data2
+
@@ -25,6 +25,17 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Inputs longer than this many frames (of 10ms) are run through the model in windows, bounding the memory used by long
+# inputs. The model then sees no context past the window edges, so the f0 differs from running the input at once.
+# 0 (the default) runs every input at once
+WINDOW_FRAMES = int(os.getenv("RMVPE_WINDOW_FRAMES", "0"))
+
+# Number of frames shared by consecutive windows, their salience is crossfaded over it
+OVERLAP_FRAMES = int(os.getenv("RMVPE_OVERLAP_FRAMES", "128"))
+
+# Number of windows run through the model at once
+WINDOW_BATCH = int(os.getenv("RMVPE_WINDOW_BATCH", "4"))
+
 
 class STFT(torch.nn.Module):
     def __init__(
@@ -565,6 +576,7 @@ class RMVPE:
             self.model = self.model.to(device)
         cents_mapping = 20 * np.arange(360) + 1997.3794084376191
         self.cents_mapping = np.pad(cents_mapping, (4, 4))  # 368
+        self.cents_mapping_torch = {}
 
     def mel2hidden(self, mel):
         with torch.no_grad():
@@ -585,13 +597,20 @@ class RMVPE:
             return hidden[:, :n_frames]
 
     def decode(self, hidden, thred=0.03):
-        cents_pred = self.to_local_average_cents(hidden, thred=thred)
+        if torch.is_tensor(hidden):
+            cents_pred = self.to_local_average_cents_torch(hidden, thred=thred)
+        else:
+            cents_pred = self.to_local_average_cents(hidden, thred=thred)
         f0 = 10 * (2 ** (cents_pred / 1200))
         f0[f0 == 10] = 0
         # f0 = np.array([10 * (2 ** (cent_pred / 1200)) if cent_pred else 0 for cent_pred in cents_pred])
         return f0
 
     def infer_from_audio(self, audio, thred=0.03):
+        n_frames = audio.shape[0] // 160 + 1
+        if 0 < WINDOW_FRAMES < n_frames and "privateuseone" not in str(self.device):
+            return self.infer_from_audio_windowed(audio, thred=thred)
+
         # torch.cuda.synchronize()
         t0 = ttime()
         mel = self.mel_extractor(
@@ -605,42 +624,101 @@ class RMVPE:
         t2 = ttime()
         # print(234234,hidden.device.type)
         if "privateuseone" not in str(self.device):
-            hidden = hidden.squeeze(0).cpu().numpy()
+            # Decode on the device, only the f0 is copied back
+            f0 = self.decode(hidden.squeeze(0).float(), thred=thred).cpu().numpy()
         else:
             hidden = hidden[0]
-        if self.is_half == True:
-            hidden = hidden.astype("float32")
-
-        f0 = self.decode(hidden, thred=thred)
+            if self.is_half == True:
+                hidden = hidden.astype("float32")
+            f0 = self.decode(hidden, thred=thred)
         # torch.cuda.synchronize()
         t3 = ttime()
         # print("hmvpe:%s\t%s\t%s\t%s"%(t1-t0,t2-t1,t3-t2,t3-t0))
         return f0
 
+    def infer_from_audio_windowed(
+        self, audio, thred=0.03, window=WINDOW_FRAMES or 3200, overlap=OVERLAP_FRAMES, batch_size=WINDOW_BATCH
+    ):
+        """
+        infer_from_audio for long inputs, with memory bounded by the window size instead of the input length.
+
+        The mel spectrogram and the model run on windows of `window` frames (WINDOW_FRAMES, or 32s when windowing is
+        off), `batch_size` windows at a time.
+        Consecutive windows share `overlap` frames, over which their salience maps are crossfaded linearly.
+        Every window is decoded as soon as it is stitched, so only the f0 of the whole input is kept.
+        The frames of each window are computed from the same samples as in infer_from_audio, only the context seen
+        by the model is cut at the window edges.
+
+        Returns:
+            np.ndarray: The f0 of every frame, like infer_from_audio.
+        """
+        window = 32 * max(1, window // 32)  # No padding in mel2hidden
+        overlap = max(0, min(overlap, window // 2))
+        n_frames = audio.shape[0] // 160 + 1
+        # Same padding as the centered STFT, frame i then starts at sample i * 160
+        audio = torch.from_numpy(np.pad(audio, (512, 512), mode="reflect")).float()
+        starts = list(range(0, max(n_frames - overlap, 1), window - overlap))
+
+        fade_in = torch.linspace(0, 1, overlap + 2, device=self.device)[1:-1].unsqueeze(1)
+        f0 = []
+        carry = None
+        for b in range(0, len(starts), batch_size):
+            batch = [(start, min(start + window, n_frames)) for start in starts[b : b + batch_size]]
+            # Only the last window can be shorter, it runs on its own
+            groups = [batch[:-1], batch[-1:]] if batch[-1][1] - batch[-1][0] < window else [batch]
+            for group in groups:
+                if not group:
+                    continue
+                frames = [end - start for start, end in group]
+                chunks = torch.stack(
+                    [audio[start * 160 : (start + frames[0] - 1) * 160 + 1024] for start, _ in group]
+                ).to(self.device)
+                with torch.no_grad():
+                    mel = self.mel_extractor(chunks, center=False)
+                hidden = self.mel2hidden(mel).float()
+                for (start, end), salience in zip(group, hidden):
+                    if carry is not None and overlap > 0:
+                        salience[:overlap] = salience[:overlap] * fade_in + carry
+                    if end < n_frames and overlap > 0:
+                        carry = salience[-overlap:] * (1 - fade_in)
+                        salience = salience[:-overlap]
+                    f0.append(self.decode(salience, thred=thred).cpu().numpy())
+        return np.concatenate(f0)
+
     def to_local_average_cents(self, salience, thred=0.05):
-        # t0 = ttime()
+        """
+        Decodes the salience map into cents: the average of the cents of the 9 bins around the most salient bin of
+        every frame, weighted by their salience. Frames whose maximum salience is at most thred are set to 0.
+        """
         center = np.argmax(salience, axis=1)  # 帧长#index
-        salience = np.pad(salience, ((0, 0), (4, 4)))  # 帧长,368
-        # t1 = ttime()
-        center += 4
-        todo_salience = []
-        todo_cents_mapping = []
-        starts = center - 4
-        ends = center + 5
-        for idx in range(salience.shape[0]):
-            todo_salience.append(salience[:, starts[idx] : ends[idx]][idx])
-            todo_cents_mapping.append(self.cents_mapping[starts[idx] : ends[idx]])
-        # t2 = ttime()
-        todo_salience = np.array(todo_salience)  # 帧长，9
-        todo_cents_mapping = np.array(todo_cents_mapping)  # 帧长，9
+        # Bins of the 9 wide window around the center of every frame, those past the edges read as 0 like the padding
+        # of the loop. Indexes in cents_mapping are shifted by its padding of 4.
+        window = center[:, None] + np.arange(-4, 5)  # 帧长，9
+        todo_salience = np.take_along_axis(salience, np.clip(window, 0, salience.shape[1] - 1), axis=1)  # 帧长，9
+        todo_salience[(window < 0) | (window >= salience.shape[1])] = 0
+        todo_cents_mapping = self.cents_mapping[window + 4]  # 帧长，9
         product_sum = np.sum(todo_salience * todo_cents_mapping, 1)
         weight_sum = np.sum(todo_salience, 1)  # 帧长
         devided = product_sum / weight_sum  # 帧长
-        # t3 = ttime()
-        maxx = np.max(salience, axis=1)  # 帧长
+        maxx = todo_salience[:, 4]  # 帧长
+        devided[maxx <= thred] = 0
+        return devided
+
+    def to_local_average_cents_torch(self, salience, thred=0.05):
+        """
+        to_local_average_cents on the device the salience map is on, in float32.
+        """
+        if salience.device not in self.cents_mapping_torch:
+            self.cents_mapping_torch[salience.device] = torch.from_numpy(
+                self.cents_mapping
+            ).float().to(salience.device)
+        cents_mapping = self.cents_mapping_torch[salience.device]
+        maxx, center = torch.max(salience, dim=1)
+        window = center.unsqueeze(1) + torch.arange(-4, 5, device=salience.device)
+        todo_salience = torch.gather(salience, 1, window.clamp(0, salience.shape[1] - 1))
+        todo_salience = todo_salience.masked_fill((window < 0) | (window >= salience.shape[1]), 0)
+        devided = torch.sum(todo_salience * cents_mapping[window + 4], 1) / torch.sum(todo_salience, 1)
         devided[maxx <= thred] = 0
-        # t4 = ttime()
-        # print("decode:%s\t%s\t%s\t%s" % (t1 - t0, t2 - t1, t3 - t2, t4 - t3))
         return devided
 
 
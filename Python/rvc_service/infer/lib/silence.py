@@ -0,0 +1,48 @@
+import numpy as np
+
+
+def find_cut_points(audio_pad, length, window, t_center, t_query):
+    """
+    Finds where to cut a long input so that the cuts land in the quietest spots.
+
+    Around every multiple of t_center, the cut is the first sample within t_query on either side where the sum of
+    |audio_pad| over the next `window` samples is the smallest. Only the query windows are read, and each moving sum
+    is computed as a difference of cumulative sums, so the cost is one pass over the query windows instead of
+    `window` passes over the whole input.
+
+    The cut points are identical to the original loop over the whole input: the cumulative sums round differently from
+    its sample-by-sample sums, so every position within the rounding error bound of the minimum is re-summed in the
+    original order before picking the first minimum.
+
+    Args:
+        audio_pad: The input audio, reflect-padded by window // 2 on each side.
+        length: The length of the audio before padding.
+        window: The number of samples summed at each position.
+        t_center: The interval between cuts, in samples.
+        t_query: How far from each multiple of t_center the cut may move, in samples.
+
+    Returns:
+        list: The cut points, as sample indices of the unpadded audio.
+    """
+    opt_ts = []
+    eps = np.finfo(audio_pad.dtype).eps if audio_pad.dtype.kind == "f" else np.finfo(np.float64).eps
+    for t in range(t_center, length, t_center):
+        start = t - t_query
+        end = min(t + t_query, length)
+
+        # Moving sum over `window` samples at every position in [start, end)
+        segment = np.abs(audio_pad[start : end + window])
+        cumsum = np.concatenate(([0], np.cumsum(segment)))
+        sums = cumsum[window : window + end - start] - cumsum[: end - start]
+
+        # Bound on the rounding error of the cumulative sums, anything within twice of it may be the true minimum
+        tol = 2 * eps * segment.shape[0] * cumsum[-1]
+        candidates = np.flatnonzero(sums <= sums.min() + 2 * tol)
+
+        exact = np.zeros(candidates.shape[0], dtype=audio_pad.dtype)
+        for i in range(window):
+            exact += segment[candidates + i]
+
+        opt_ts.append(start + candidates[np.argmin(exact)])
+    return opt_ts
+
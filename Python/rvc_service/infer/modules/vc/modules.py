@@ -9,6 +9,7 @@ import torch
 from io import BytesIO
 
 from rvc_service.infer.lib.audio import load_audio, wav2
+from rvc_service.infer.lib.audio_cache import load_audio_cached
 from rvc_service.infer.lib.infer_pack.models import (
     SynthesizerTrnMs256NSFsid,
     SynthesizerTrnMs256NSFsid_nono,
@@ -178,7 +179,7 @@ class VC:
             return "You need to upload an audio", None
         f0_up_key = int(f0_up_key)
         try:
-            audio = load_audio(input_audio_path, 16000)
+            audio = load_audio_cached(input_audio_path, 16000)
             audio_max = np.abs(audio).max() / 0.95
             if audio_max > 1:
                 audio /= audio_max
@@ -242,6 +243,55 @@ class VC:
             logger.warning(info)
             return info, (None, None)
 
+    def vc_stream(
+        self,
+        sid,
+        blocks,
+        sr,
+        f0_up_key,
+        f0_method,
+        file_index,
+        index_rate,
+        filter_radius,
+        rms_mix_rate,
+        protect,
+        block_ms=None,
+        crossfade_ms=None,
+    ):
+        """
+        Converts an audio stream block by block, see Pipeline.stream.
+
+        Yields:
+            np.ndarray: The converted audio, int16 at self.tgt_sr.
+        """
+        if self.hubert_model is None:
+            self.hubert_model = load_hubert(self.config)
+
+        kwargs = {}
+        if block_ms is not None:
+            kwargs["block_ms"] = block_ms
+        if crossfade_ms is not None:
+            kwargs["crossfade_ms"] = crossfade_ms
+        for audio in self.pipeline.stream(
+            self.hubert_model,
+            self.net_g,
+            sid,
+            blocks,
+            sr,
+            int(f0_up_key),
+            f0_method,
+            file_index,
+            index_rate,
+            self.if_f0,
+            filter_radius,
+            self.tgt_sr,
+            rms_mix_rate,
+            self.version,
+            protect,
+            **kwargs,
+        ):
+            yield (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+
     def vc_multi(
         self,
         sid,
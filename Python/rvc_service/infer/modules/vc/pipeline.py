@@ -1,11 +1,13 @@
+import hashlib
 import os
 import sys
+import threading
 import traceback
 import logging
 
 logger = logging.getLogger(__name__)
 
-from functools import lru_cache
+from collections import OrderedDict
 from time import time as ttime
 
 import faiss
@@ -18,17 +20,168 @@ import torch.nn.functional as F
 import torchcrepe
 from scipy import signal
 
+from atomic_file import open_atomic
+from rvc_service.infer.lib.feature_cache import audio_hash, feature_cache
+from rvc_service.infer.lib.memory import MemoryPolicy
+from rvc_service.infer.lib.retrieval import DeviceBank
+from rvc_service.infer.lib.rmvpe import OVERLAP_FRAMES as RMVPE_OVERLAP_FRAMES
+from rvc_service.infer.lib.rmvpe import WINDOW_FRAMES as RMVPE_WINDOW_FRAMES
+from rvc_service.infer.lib.rms import change_rms
+from rvc_service.infer.lib.silence import find_cut_points
+
 now_dir = os.getcwd()
 sys.path.append(now_dir)
 
 bh, ah = signal.butter(N=5, Wn=48, btype="high", fs=16000)
 
-input_audio_path2wav = {}
+# Number of speaker indexes kept resident by get_index()
+INDEX_CACHE_SIZE = int(os.getenv("RVC_INDEX_CACHE_SIZE", "4"))
+
+# Folder where the feature banks reconstructed from the indexes are saved, outside of the speakers' model folders
+INDEX_CACHE_DIR = os.getenv("RVC_INDEX_CACHE_DIR", "ServerFiles/Cache/rvc_index")
+
+index_cache = OrderedDict()
+index_cache_lock = threading.Lock()
+
+# One lock per index path, held while it is loaded, so that loading one speaker's index does not block the others
+index_key_locks = {}
+
+# Default feature retrieval engine of Pipeline, "faiss" or "device" (see Pipeline.retrieve)
+RETRIEVAL = os.getenv("RVC_RETRIEVAL", "faiss")
+
+# Largest feature bank searched on the device, larger banks fall back to faiss
+DEVICE_RETRIEVAL_MAX_BANK = int(os.getenv("RVC_DEVICE_RETRIEVAL_MAX_BANK", "200000"))
+
+device_bank_cache = OrderedDict()
+
+# Length of the blocks converted by Pipeline.stream, and of the crossfade between them, in milliseconds
+STREAM_BLOCK_MS = int(os.getenv("RVC_STREAM_BLOCK_MS", "300"))
+STREAM_CROSSFADE_MS = int(os.getenv("RVC_STREAM_CROSSFADE_MS", "40"))
+
+# Number of silence-split segments converted together by Pipeline.vc_batch, 0 picks it from the free GPU memory.
+# Opt-in: batched segments are zero-padded to the longest one, which changes HuBERT's features (its first GroupNorm
+# normalizes over the padded length), so the output differs slightly from converting the segments one at a time
+# and depends on which segments share a batch. The default of 1 converts every segment with vc, like before
+SEGMENT_BATCH_SIZE = int(os.getenv("RVC_SEGMENT_BATCH_SIZE", "1"))
+
+# Estimated GPU memory used per second of segment audio when converting in batches, in MB (doubled in fp32)
+SEGMENT_BATCH_MB_PER_SECOND = int(os.getenv("RVC_SEGMENT_BATCH_MB_PER_SECOND", "80"))
+
+# The convolutional feature extractor of HuBERT, as (kernel size, stride) per layer
+HUBERT_CONV_LAYERS = [(10, 5)] + [(3, 2)] * 4 + [(2, 2)] * 2
+
+
+def hubert_frames(length):
+    """
+    Returns the number of feature frames HuBERT outputs for an input of `length` samples.
+    """
+    for kernel_size, stride in HUBERT_CONV_LAYERS:
+        length = (length - kernel_size) // stride + 1
+    return length
+
+
+def get_big_npy_path(file_index, mtime_ns):
+    """
+    Returns the path of the feature bank reconstructed from a version of an index, in INDEX_CACHE_DIR.
+    """
+    name = hashlib.sha1(os.path.realpath(file_index).encode()).hexdigest()[:16]
+    return os.path.join(INDEX_CACHE_DIR, "%s_%d.big.npy" % (name, mtime_ns))
+
+
+def get_cached(cache, key):
+    """
+    Returns the cached value of key, marking it as most recently used, or None. Called with index_cache_lock held.
+    """
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    return None
+
+
+def put_cached(cache, key, value):
+    """
+    Caches the value of key, dropping the other versions of the same index and the least recently used entries.
+    Called with index_cache_lock held.
+    """
+    for cached_key in [k for k in cache if k[0] == key[0]]:
+        del cache[cached_key]
+    cache[key] = value
+    while len(cache) > INDEX_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def get_index(file_index):
+    """
+    Returns the faiss index of a speaker and its feature bank (big_npy), reading them from disk only once.
+
+    The feature bank is reconstructed from the index the first time and saved in INDEX_CACHE_DIR, keyed by the index
+    path and mtime, then memory-mapped instead of being materialized in RAM on every conversion.
+    Indexes are keyed by path and mtime, the least recently used ones are dropped beyond INDEX_CACHE_SIZE.
+    """
+    key = (os.path.realpath(file_index), os.stat(file_index).st_mtime_ns)
+    with index_cache_lock:
+        cached = get_cached(index_cache, key)
+        if cached is not None:
+            return cached
+        key_lock = index_key_locks.setdefault(key[0], threading.Lock())
+
+    # Only one thread loads a given index, the others wait for it and reuse it
+    with key_lock:
+        with index_cache_lock:
+            cached = get_cached(index_cache, key)
+            if cached is not None:
+                return cached
 
+        logger.info("Loading index %s", file_index)
+        index = faiss.read_index(file_index)
 
-@lru_cache
-def cache_harvest_f0(input_audio_path, fs, f0max, f0min, frame_period):
-    audio = input_audio_path2wav[input_audio_path]
+        big_npy_path = get_big_npy_path(file_index, key[1])
+        if not os.path.isfile(big_npy_path):
+            os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+            with open_atomic(big_npy_path, "wb") as big_npy_file:
+                np.save(big_npy_file, index.reconstruct_n(0, index.ntotal))
+            # Remove the feature banks of the older versions of the index
+            prefix = os.path.basename(big_npy_path).split("_")[0] + "_"
+            for name in os.listdir(INDEX_CACHE_DIR):
+                if name.startswith(prefix) and name.endswith(".big.npy") and name != os.path.basename(big_npy_path):
+                    try:
+                        os.remove(os.path.join(INDEX_CACHE_DIR, name))
+                    except OSError:
+                        pass
+        big_npy = np.load(big_npy_path, mmap_mode="r")
+
+        with index_cache_lock:
+            put_cached(index_cache, key, (index, big_npy))
+        return index, big_npy
+
+
+def get_device_bank(file_index, big_npy, device, is_half):
+    """
+    Returns the feature bank of a speaker as a DeviceBank, copying it to the device only once.
+    Banks are keyed like get_index() and share its cache size.
+    """
+    key = (os.path.realpath(file_index), os.stat(file_index).st_mtime_ns, str(device), is_half)
+    with index_cache_lock:
+        cached = get_cached(device_bank_cache, key)
+        if cached is not None:
+            return cached
+        key_lock = index_key_locks.setdefault(key[0], threading.Lock())
+
+    with key_lock:
+        with index_cache_lock:
+            cached = get_cached(device_bank_cache, key)
+            if cached is not None:
+                return cached
+
+        logger.info("Copying the feature bank of %s to %s", file_index, device)
+        bank = DeviceBank(big_npy, device, is_half)
+
+        with index_cache_lock:
+            put_cached(device_bank_cache, key, bank)
+        return bank
+
+
+def harvest_f0(audio, fs, f0max, f0min, frame_period):
     f0, t = pyworld.harvest(
         audio,
         fs=fs,
@@ -40,28 +193,6 @@ def cache_harvest_f0(input_audio_path, fs, f0max, f0min, frame_period):
     return f0
 
 
-def change_rms(data1, sr1, data2, sr2, rate):  # 1是输入音频，2是输出音频,rate是2的占比
-    # print(data1.max(),data2.max())
-    rms1 = librosa.feature.rms(
-        y=data1, frame_length=sr1 // 2 * 2, hop_length=sr1 // 2
-    )  # 每半秒一个点
-    rms2 = librosa.feature.rms(y=data2, frame_length=sr2 // 2 * 2, hop_length=sr2 // 2)
-    rms1 = torch.from_numpy(rms1)
-    rms1 = F.interpolate(
-        rms1.unsqueeze(0), size=data2.shape[0], mode="linear"
-    ).squeeze()
-    rms2 = torch.from_numpy(rms2)
-    rms2 = F.interpolate(
-        rms2.unsqueeze(0), size=data2.shape[0], mode="linear"
-    ).squeeze()
-    rms2 = torch.max(rms2, torch.zeros_like(rms2) + 1e-6)
-    data2 *= (
-        torch.pow(rms1, torch.tensor(1 - rate))
-        * torch.pow(rms2, torch.tensor(rate - 1))
-    ).numpy()
-    return data2
-
-
 class Pipeline(object):
     def __init__(self, tgt_sr, config):
         self.x_pad, self.x_query, self.x_center, self.x_max, self.is_half = (
@@ -80,6 +211,8 @@ class Pipeline(object):
         self.t_center = self.sr * self.x_center  # 查询切点位置
         self.t_max = self.sr * self.x_max  # 免查询时长阈值
         self.device = config.device
+        self.memory = MemoryPolicy(self.device)
+        self.retrieval = RETRIEVAL
 
     def get_f0(
         self,
@@ -90,14 +223,30 @@ class Pipeline(object):
         f0_method,
         filter_radius,
         inp_f0=None,
+        audio_key=None,
+        cache=True,
     ):
-        global input_audio_path2wav
         time_step = self.window / self.sr * 1000
         f0_min = 50
         f0_max = 1100
         f0_mel_min = 1127 * np.log(1 + f0_min / 700)
         f0_mel_max = 1127 * np.log(1 + f0_max / 700)
-        if f0_method == "pm":
+        # The f0 of the same audio is reused, only the transposition and the f0 file are applied again
+        if cache:
+            f0_params = (f0_method, filter_radius)
+            if f0_method == "rmvpe":
+                # Windowed extraction gives a different f0 than single-shot extraction
+                f0_params += (RMVPE_WINDOW_FRAMES, RMVPE_OVERLAP_FRAMES)
+            f0_key = feature_cache.key(
+                "f0", audio_key or audio_hash(x), p_len, *f0_params
+            )
+            f0 = feature_cache.get(f0_key)
+        else:
+            f0 = None
+        cached = f0 is not None
+        if cached:
+            f0 = f0.copy()
+        elif f0_method == "pm":
             f0 = (
                 parselmouth.Sound(x, self.sr)
                 .to_pitch_ac(
@@ -114,8 +263,7 @@ class Pipeline(object):
                     f0, [[pad_size, p_len - len(f0) - pad_size]], mode="constant"
                 )
         elif f0_method == "harvest":
-            input_audio_path2wav[input_audio_path] = x.astype(np.double)
-            f0 = cache_harvest_f0(input_audio_path, self.sr, f0_max, f0_min, 10)
+            f0 = harvest_f0(x.astype(np.double), self.sr, f0_max, f0_min, 10)
             if filter_radius > 2:
                 f0 = signal.medfilt(f0, 3)
         elif f0_method == "crepe":
@@ -158,6 +306,8 @@ class Pipeline(object):
                 del self.model_rmvpe
                 logger.info("Cleaning ortruntime memory")
 
+        if cache and not cached:
+            feature_cache.put(f0_key, f0)
         f0 *= pow(2, f0_up_key / 12)
         # with open("test.txt","w")as f:f.write("\n".join([str(i)for i in f0.tolist()]))
         tf0 = self.sr // self.window  # 每秒f0点数
@@ -183,6 +333,38 @@ class Pipeline(object):
         f0_coarse = np.rint(f0_mel).astype(np.int32)
         return f0_coarse, f0bak  # 1-0
 
+    def retrieve(self, feats, index, big_npy):
+        """
+        Replaces every HuBERT frame by the weighted average of its 8 nearest neighbours in the speaker's feature bank.
+
+        With a DeviceBank as big_npy, the search runs on the device. Otherwise the frames are copied to the CPU,
+        searched with faiss and blended in NumPy.
+
+        Args:
+            feats (torch.Tensor): The frames, of shape (frames, channels), on the device.
+
+        Returns:
+            torch.Tensor: The blended frames, on the device with the dtype of feats.
+        """
+        if isinstance(big_npy, DeviceBank):
+            return big_npy.blend(feats)
+
+        npy = feats.cpu().numpy()
+        if self.is_half:
+            npy = npy.astype("float32")
+
+        # _, I = index.search(npy, 1)
+        # npy = big_npy[I.squeeze()]
+
+        score, ix = index.search(npy, k=8)
+        weight = np.square(1 / score)
+        weight /= weight.sum(axis=1, keepdims=True)
+        npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
+
+        if self.is_half:
+            npy = npy.astype("float16")
+        return torch.from_numpy(npy).to(self.device)
+
     def vc(
         self,
         model,
@@ -197,6 +379,7 @@ class Pipeline(object):
         index_rate,
         version,
         protect,
+        feature_key=None,
     ):  # ,file_index,file_big_npy
         feats = torch.from_numpy(audio0)
         if self.is_half:
@@ -215,9 +398,15 @@ class Pipeline(object):
             "output_layer": 9 if version == "v1" else 12,
         }
         t0 = ttime()
-        with torch.no_grad():
-            logits = model.extract_features(**inputs)
-            feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+        cached = feature_cache.get(feature_key) if feature_key is not None else None
+        if cached is not None:
+            feats = torch.from_numpy(cached).to(self.device)
+        else:
+            with torch.no_grad():
+                logits = model.extract_features(**inputs)
+                feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+            if feature_key is not None:
+                feature_cache.put(feature_key, feats.cpu().numpy())
         if protect < 0.5 and pitch is not None and pitchf is not None:
             feats0 = feats.clone()
         if (
@@ -225,22 +414,8 @@ class Pipeline(object):
             and not isinstance(big_npy, type(None))
             and index_rate != 0
         ):
-            npy = feats[0].cpu().numpy()
-            if self.is_half:
-                npy = npy.astype("float32")
-
-            # _, I = index.search(npy, 1)
-            # npy = big_npy[I.squeeze()]
-
-            score, ix = index.search(npy, k=8)
-            weight = np.square(1 / score)
-            weight /= weight.sum(axis=1, keepdims=True)
-            npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
-
-            if self.is_half:
-                npy = npy.astype("float16")
             feats = (
-                torch.from_numpy(npy).unsqueeze(0).to(self.device) * index_rate
+                self.retrieve(feats[0], index, big_npy).unsqueeze(0) * index_rate
                 + (1 - index_rate) * feats
             )
 
@@ -271,13 +446,168 @@ class Pipeline(object):
             audio1 = (net_g.infer(*arg)[0][0, 0]).data.cpu().float().numpy()
             del hasp, arg
         del feats, p_len, padding_mask
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        self.memory.after_segment()
+        t2 = ttime()
+        times[0] += t1 - t0
+        times[2] += t2 - t1
+        return audio1
+
+    def vc_batch(
+        self,
+        model,
+        net_g,
+        sid,
+        audios,
+        pitches,
+        pitchfs,
+        times,
+        index,
+        big_npy,
+        index_rate,
+        version,
+        protect,
+        feature_keys=None,
+    ):
+        """
+        Converts several segments at once, with one HuBERT forward and one net_g.infer call, instead of one each in vc.
+
+        The segments are zero-padded to the longest one and masked. Every segment gets the same number of frames and
+        output samples as it would in vc, so the outputs are trimmed and concatenated exactly like vc's. The features
+        of a padded segment still differ slightly from vc's (see SEGMENT_BATCH_SIZE), so this is only used when
+        batching is enabled.
+
+        Returns:
+            list: The converted audio of each segment, untrimmed like vc's.
+        """
+        hasp = pitches is not None and pitchfs is not None
+        lengths = [audio0.shape[0] for audio0 in audios]
+        feats = torch.zeros(len(audios), max(lengths))
+        padding_mask = torch.ones(feats.shape, dtype=torch.bool)
+        for i, audio0 in enumerate(audios):
+            audio0 = torch.from_numpy(audio0)
+            if audio0.dim() == 2:  # double channels
+                audio0 = audio0.mean(-1)
+            assert audio0.dim() == 1, audio0.dim()
+            feats[i, : lengths[i]] = audio0
+            padding_mask[i, : lengths[i]] = False
+        feats = feats.half() if self.is_half else feats.float()
+
+        inputs = {
+            "source": feats.to(self.device),
+            "padding_mask": padding_mask.to(self.device),
+            "output_layer": 9 if version == "v1" else 12,
+        }
+        t0 = ttime()
+        cached = [feature_cache.get(key) for key in feature_keys] if feature_keys is not None else [None]
+        if all(c is not None for c in cached):
+            feats = torch.zeros(
+                len(cached), max(c.shape[0] for c in cached), cached[0].shape[1], dtype=torch.from_numpy(cached[0]).dtype
+            )
+            for i, c in enumerate(cached):
+                feats[i, : c.shape[0]] = torch.from_numpy(c)
+            feats = feats.to(self.device)
+        else:
+            with torch.no_grad():
+                logits = model.extract_features(**inputs)
+                feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+        if protect < 0.5 and hasp:
+            feats0 = feats.clone()
+
+        # Only the frames of each segment that vc would have produced
+        n_frames = [min(hubert_frames(length), feats.shape[1]) for length in lengths]
+        if feature_keys is not None and any(c is None for c in cached):
+            for i, n in enumerate(n_frames):
+                feature_cache.put(feature_keys[i], feats[i, :n].cpu().numpy())
+        if (
+            not isinstance(index, type(None))
+            and not isinstance(big_npy, type(None))
+            and index_rate != 0
+        ):
+            # One search for the frames of all segments
+            npy = self.retrieve(
+                torch.cat([feats[i, :n] for i, n in enumerate(n_frames)]), index, big_npy
+            )
+            offset = 0
+            for i, n in enumerate(n_frames):
+                feats[i, :n] = npy[offset : offset + n] * index_rate + (1 - index_rate) * feats[i, :n]
+                offset += n
+
+        feats = F.interpolate(feats.permute(0, 2, 1), scale_factor=2).permute(0, 2, 1)
+        if protect < 0.5 and hasp:
+            feats0 = F.interpolate(feats0.permute(0, 2, 1), scale_factor=2).permute(
+                0, 2, 1
+            )
+        t1 = ttime()
+        p_lens = [min(length // self.window, n * 2) for length, n in zip(lengths, n_frames)]
+        max_p_len = max(p_lens)
+        feats = feats[:, :max_p_len]
+        if hasp:
+            feats0 = feats0[:, :max_p_len] if protect < 0.5 else None
+            pitch = torch.zeros(len(audios), max_p_len, dtype=torch.long, device=self.device)
+            pitchf = torch.zeros(len(audios), max_p_len, device=self.device)
+            for i, p_len in enumerate(p_lens):
+                pitch[i, :p_len] = pitches[i][0, :p_len]
+                pitchf[i, :p_len] = pitchfs[i][0, :p_len]
+
+        if protect < 0.5 and hasp:
+            pitchff = pitchf.clone()
+            pitchff[pitchf > 0] = 1
+            pitchff[pitchf < 1] = protect
+            pitchff = pitchff.unsqueeze(-1)
+            feats = feats * pitchff + feats0 * (1 - pitchff)
+            feats = feats.to(feats0.dtype)
+        p_len = torch.tensor(p_lens, device=self.device).long()
+        sid = sid.repeat(len(audios))
+        with torch.no_grad():
+            arg = (feats, p_len, pitch, pitchf, sid) if hasp else (feats, p_len, sid)
+            audio1 = net_g.infer(*arg)[0][:, 0].data.cpu().float().numpy()
+            del arg
+        # Samples per frame of the synthesizer
+        hop = audio1.shape[1] // max_p_len
+        audio1 = [audio1[i, : p_len * hop] for i, p_len in enumerate(p_lens)]
+        del feats, p_len, padding_mask
+        self.memory.after_segment()
         t2 = ttime()
         times[0] += t1 - t0
         times[2] += t2 - t1
         return audio1
 
+    def get_retrieval(self, file_index, index_rate):
+        """
+        Returns the faiss index and feature bank used to retrieve the features of the speaker, or (None, None).
+        """
+        if (
+            file_index != ""
+            # and file_big_npy != ""
+            # and os.path.exists(file_big_npy) == True
+            and os.path.exists(file_index)
+            and index_rate != 0
+        ):
+            try:
+                index, big_npy = get_index(file_index)
+                if self.retrieval == "device" and big_npy.shape[0] <= DEVICE_RETRIEVAL_MAX_BANK:
+                    big_npy = get_device_bank(file_index, big_npy, self.device, self.is_half)
+                return index, big_npy
+            except:
+                traceback.print_exc()
+        return None, None
+
+    def get_segment_batch_size(self, segment_samples):
+        """
+        Returns how many segments of `segment_samples` samples vc_batch converts at once: SEGMENT_BATCH_SIZE, or when
+        it is 0, as many as the free GPU memory allows on CUDA, and one at a time elsewhere.
+        """
+        if SEGMENT_BATCH_SIZE > 0:
+            return SEGMENT_BATCH_SIZE
+        if "cuda" not in str(self.device) or not torch.cuda.is_available():
+            return 1
+        free, _ = torch.cuda.mem_get_info(self.device)
+        # Memory the caching allocator holds but does not use is available too
+        free += torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+        mb_per_second = SEGMENT_BATCH_MB_PER_SECOND * (1 if self.is_half else 2)
+        segment_mb = segment_samples / self.sr * mb_per_second
+        return max(1, int(free / 1024 / 1024 * 0.8 / segment_mb))
+
     def pipeline(
         self,
         model,
@@ -299,41 +629,19 @@ class Pipeline(object):
         protect,
         f0_file=None,
     ):
-        if (
-            file_index != ""
-            # and file_big_npy != ""
-            # and os.path.exists(file_big_npy) == True
-            and os.path.exists(file_index)
-            and index_rate != 0
-        ):
-            try:
-                index = faiss.read_index(file_index)
-                # big_npy = np.load(file_big_npy)
-                big_npy = index.reconstruct_n(0, index.ntotal)
-            except:
-                traceback.print_exc()
-                index = big_npy = None
-        else:
-            index = big_npy = None
+        self.memory.start_job()
+        # Hash of the input, the f0 and HuBERT features computed from it are cached
+        audio_key = audio_hash(audio)
+        index, big_npy = self.get_retrieval(file_index, index_rate)
         audio = signal.filtfilt(bh, ah, audio)
         audio_pad = np.pad(audio, (self.window // 2, self.window // 2), mode="reflect")
         opt_ts = []
         if audio_pad.shape[0] > self.t_max:
-            audio_sum = np.zeros_like(audio)
-            for i in range(self.window):
-                audio_sum += np.abs(audio_pad[i : i - self.window])
-            for t in range(self.t_center, audio.shape[0], self.t_center):
-                opt_ts.append(
-                    t
-                    - self.t_query
-                    + np.where(
-                        audio_sum[t - self.t_query : t + self.t_query]
-                        == audio_sum[t - self.t_query : t + self.t_query].min()
-                    )[0][0]
-                )
+            opt_ts = find_cut_points(
+                audio_pad, audio.shape[0], self.window, self.t_center, self.t_query
+            )
         s = 0
         audio_opt = []
-        t = None
         t1 = ttime()
         audio_pad = np.pad(audio, (self.t_pad, self.t_pad), mode="reflect")
         p_len = audio_pad.shape[0] // self.window
@@ -359,6 +667,7 @@ class Pipeline(object):
                 f0_method,
                 filter_radius,
                 inp_f0,
+                audio_key,
             )
             pitch = pitch[:p_len]
             pitchf = pitchf[:p_len]
@@ -368,77 +677,70 @@ class Pipeline(object):
             pitchf = torch.tensor(pitchf, device=self.device).unsqueeze(0).float()
         t2 = ttime()
         times[1] += t2 - t1
+        # Bounds of each segment in audio_pad, the consecutive segments overlap by t_pad2 + window
+        segments = []
         for t in opt_ts:
             t = t // self.window * self.window
+            segments.append((s, t + self.t_pad2 + self.window))
+            s = t
+        segments.append((s, None))
+
+        batch_size = self.get_segment_batch_size(
+            max((e or audio_pad.shape[0]) - b for b, e in segments)
+        )
+        for i in range(0, len(segments), batch_size):
+            batch = segments[i : i + batch_size]
+            audios = [audio_pad[b:e] for b, e in batch]
+            # The pitch of a segment stops at the last full frame before its end, the window past t_pad2 is excluded
+            frames = [
+                (b // self.window, (e - self.window) // self.window if e is not None else None)
+                for b, e in batch
+            ]
+            # The features of a segment depend on the length it is padded to in its batch
+            padded_length = max(a.shape[0] for a in audios)
+            feature_keys = [
+                feature_cache.key("hubert", audio_key, self.x_pad, b, e, padded_length, version, self.is_half)
+                for b, e in batch
+            ]
+            pitches = pitchfs = None
             if if_f0 == 1:
-                audio_opt.append(
+                pitches = [pitch[:, b:e] for b, e in frames]
+                pitchfs = [pitchf[:, b:e] for b, e in frames]
+            if len(batch) == 1:
+                audio1 = [
                     self.vc(
                         model,
                         net_g,
                         sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
-                        pitch[:, s // self.window : (t + self.t_pad2) // self.window],
-                        pitchf[:, s // self.window : (t + self.t_pad2) // self.window],
+                        audios[0],
+                        pitches[0] if if_f0 == 1 else None,
+                        pitchfs[0] if if_f0 == 1 else None,
                         times,
                         index,
                         big_npy,
                         index_rate,
                         version,
                         protect,
-                    )[self.t_pad_tgt : -self.t_pad_tgt]
-                )
+                        feature_keys[0],
+                    )
+                ]
             else:
-                audio_opt.append(
-                    self.vc(
-                        model,
-                        net_g,
-                        sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
-                        None,
-                        None,
-                        times,
-                        index,
-                        big_npy,
-                        index_rate,
-                        version,
-                        protect,
-                    )[self.t_pad_tgt : -self.t_pad_tgt]
-                )
-            s = t
-        if if_f0 == 1:
-            audio_opt.append(
-                self.vc(
+                audio1 = self.vc_batch(
                     model,
                     net_g,
                     sid,
-                    audio_pad[t:],
-                    pitch[:, t // self.window :] if t is not None else pitch,
-                    pitchf[:, t // self.window :] if t is not None else pitchf,
+                    audios,
+                    pitches,
+                    pitchfs,
                     times,
                     index,
                     big_npy,
                     index_rate,
                     version,
                     protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
-            )
-        else:
-            audio_opt.append(
-                self.vc(
-                    model,
-                    net_g,
-                    sid,
-                    audio_pad[t:],
-                    None,
-                    None,
-                    times,
-                    index,
-                    big_npy,
-                    index_rate,
-                    version,
-                    protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
-            )
+                    feature_keys,
+                )
+            audio_opt.extend(a[self.t_pad_tgt : -self.t_pad_tgt] for a in audio1)
         audio_opt = np.concatenate(audio_opt)
         if rms_mix_rate != 1:
             audio_opt = change_rms(audio, 16000, audio_opt, tgt_sr, rms_mix_rate)
@@ -452,6 +754,125 @@ class Pipeline(object):
             max_int16 /= audio_max
         audio_opt = (audio_opt * max_int16).astype(np.int16)
         del pitch, pitchf, sid
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        self.memory.end_job()
         return audio_opt
+
+    def stream(
+        self,
+        model,
+        net_g,
+        sid,
+        blocks,
+        sr,
+        f0_up_key,
+        f0_method,
+        file_index,
+        index_rate,
+        if_f0,
+        filter_radius,
+        tgt_sr,
+        rms_mix_rate,
+        version,
+        protect,
+        block_ms=STREAM_BLOCK_MS,
+        crossfade_ms=STREAM_CROSSFADE_MS,
+    ):
+        """
+        Converts an audio stream block by block, yielding the converted audio as soon as each block is converted.
+
+        Every block is converted along with the t_pad samples of input before it, and the crossfade_ms of input after
+        it. The converted lookahead is crossfaded with the start of the next block, so the latency is
+        block_ms + crossfade_ms plus the conversion time. The start of the stream is preceded by silence.
+        Unlike pipeline, the output is not normalized and the RMS is mixed per block.
+
+        Args:
+            blocks (iterable): Mono float32 audio in [-1, 1] at sr, in blocks of any length.
+            sr (int): The sample rate of the input, a multiple of 100.
+            block_ms (int, optional): The length of the converted blocks, rounded down to 10ms.
+            crossfade_ms (int, optional): The length of the crossfade between blocks, rounded down to 10ms and at most block_ms.
+
+        Yields:
+            np.ndarray: The converted audio, float32 at tgt_sr.
+        """
+        assert sr % 100 == 0, sr
+        self.memory.start_job()
+        try:
+            index, big_npy = self.get_retrieval(file_index, index_rate)
+            sid = torch.tensor(sid, device=self.device).unsqueeze(0).long()
+            times = [0, 0, 0]
+
+            # Lengths in input samples, all multiples of a 10ms frame
+            frame = sr // 100
+            block = max(1, block_ms // 10) * frame
+            fade = min(crossfade_ms // 10 * frame, block)
+            context = self.x_pad * sr
+            # The same lengths at tgt_sr
+            out_frame = tgt_sr // 100
+            out_block = block // frame * out_frame
+            out_fade = fade // frame * out_frame
+            fade_in = np.linspace(0, 1, out_fade + 2, dtype=np.float32)[1:-1]
+
+            def convert(window):
+                """
+                Converts a window of input (context, then the samples to convert) and returns the converted samples.
+                """
+                audio = window if sr == 16000 else signal.resample_poly(window, 16000, sr)
+                audio = signal.filtfilt(bh, ah, audio)
+                n = audio.shape[0]
+                # HuBERT outputs a few frames less than the input, they are taken from a padding of 50ms
+                audio = np.pad(audio, (0, min(800, n - 1)), mode="reflect")
+                p_len = audio.shape[0] // self.window
+                pitch = pitchf = None
+                if if_f0 == 1:
+                    pitch, pitchf = self.get_f0(
+                        None, audio, p_len, f0_up_key, f0_method, filter_radius, cache=False
+                    )
+                    pitch = torch.tensor(pitch[:p_len], device=self.device).unsqueeze(0).long()
+                    pitchf = torch.tensor(pitchf[:p_len].astype(np.float32), device=self.device).unsqueeze(0)
+                audio1 = self.vc(
+                    model, net_g, sid, audio, pitch, pitchf, times, index, big_npy, index_rate, version, protect
+                )
+                if rms_mix_rate != 1:
+                    audio1 = change_rms(audio, 16000, audio1, tgt_sr, rms_mix_rate)
+                start = context // frame * out_frame
+                end = n // self.window * out_frame
+                audio1 = audio1[start:end]
+                if audio1.shape[0] < end - start:
+                    audio1 = np.pad(audio1, (0, end - start - audio1.shape[0]))
+                return audio1.astype(np.float32)
+
+            # The context and the input not converted yet
+            buffer = np.zeros(context, dtype=np.float32)
+            # The converted lookahead of the last block, blended with the start of the next one
+            tail = None
+            blocks = iter(blocks)
+            done = False
+            while not done:
+                while buffer.shape[0] < context + block + fade:
+                    chunk = next(blocks, None)
+                    if chunk is None:
+                        done = True
+                        break
+                    buffer = np.concatenate([buffer, np.asarray(chunk, dtype=np.float32)])
+
+                if done:
+                    # The rest of the input, padded with silence to a whole frame
+                    n = buffer.shape[0] - context
+                    if n <= 0:
+                        break
+                    window = np.pad(buffer, (0, -n % frame))
+                    audio1 = convert(window)[: n * out_frame // frame]
+                else:
+                    window = buffer[: context + block + fade]
+                    audio1 = convert(window)
+
+                if tail is not None:
+                    audio1[:out_fade] = audio1[:out_fade] * fade_in + tail * (1 - fade_in)
+                if done:
+                    yield audio1
+                else:
+                    yield audio1[:out_block]
+                    tail = audio1[out_block : out_block + out_fade]
+                    buffer = buffer[block:]
+        finally:
+            self.memory.end_job()
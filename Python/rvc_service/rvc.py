@@ -1,8 +1,85 @@
 import os
+import numpy as np
 from dotenv import load_dotenv
 from scipy.io import wavfile
 from rvc_service.configs.config import Config
 from rvc_service.infer.modules.vc.modules import VC
+from rvc_service.infer.modules.vc.utils import load_hubert
+from rvc_service.infer.lib.audio_cache import audio_cache
+from rvc_service.infer.modules.vc.pipeline import RETRIEVAL
+from model_registry import registry
+import job_queue as jq
+
+# Shared model paths
+HUBERT_MODEL_PATH = "ServerFiles/Speakers/hubert_base.pt"
+RMVPE_MODEL_PATH = "ServerFiles/Speakers/rmvpe.pt"
+
+# Speakers whose feature retrieval runs on the device instead of faiss, comma-separated, "*" for all
+DEVICE_RETRIEVAL_SPEAKERS = [s.strip() for s in os.getenv("RVC_DEVICE_RETRIEVAL_SPEAKERS", "").split(",") if s.strip()]
+
+def get_retrieval(speaker_name):
+    """
+    Returns the feature retrieval engine used for the given speaker (see Pipeline.retrieve).
+    """
+    if "*" in DEVICE_RETRIEVAL_SPEAKERS or speaker_name in DEVICE_RETRIEVAL_SPEAKERS:
+        return "device"
+    return RETRIEVAL
+
+def get_config():
+    """
+    Returns the RVC config, along with the device and dtype the RVC models run with.
+
+    Returns:
+        tuple: The config, the device and the dtype ('float16' or 'float32').
+    """
+    # Load .env file
+    load_dotenv()
+
+    config = Config()
+    return config, str(config.device), "float16" if config.is_half else "float32"
+
+def load_vc(model_path, device, dtype):
+    """
+    Loads the voice conversion model of a speaker. Used by the model registry.
+    HuBERT and RMVPE are shared between speakers and attached when the model is used, so the model is registered as
+    exclusive: one conversion uses it at a time.
+
+    Args:
+        model_path (str): The path to the speaker's model.
+        device (str): The device to load the model on. Taken from the config, only part of the registry key.
+        dtype (str): The dtype of the model. Taken from the config, only part of the registry key.
+
+    Returns:
+        VC: The loaded model.
+    """
+    vc = VC(get_config()[0])
+    vc.get_vc(model_path)
+    return vc
+
+def load_rmvpe(model_path, device, dtype):
+    """
+    Loads the RMVPE pitch extractor. Used by the model registry.
+    """
+    from rvc_service.infer.lib.rmvpe import RMVPE
+
+    return RMVPE(model_path, is_half=dtype == "float16", device=device)
+
+registry.register("rvc", load_vc, exclusive=True)
+registry.register("hubert", lambda model_path, device, dtype: load_hubert(get_config()[0]))
+registry.register("rmvpe", load_rmvpe)
+
+def preload(speaker_name, base_path):
+    """
+    Loads the RVC models of the given speaker, along with HuBERT and RMVPE, so that the first request does not pay for the load.
+
+    Args:
+        speaker_name (str): The name of the speaker.
+        base_path (str): The base path for the speaker model and index.
+    """
+    _, device, dtype = get_config()
+    registry.preload("rvc", get_speaker_model_path(speaker_name, base_path), device, dtype)
+    registry.preload("hubert", HUBERT_MODEL_PATH, device, dtype)
+    registry.preload("rmvpe", RMVPE_MODEL_PATH, device, dtype)
 
 def get_speaker_model_path(speaker_name,base_path):
     """
@@ -65,6 +142,70 @@ def get_speaker_index_path(speaker_name,base_path):
         print(f"Error in rvc.get_speaker_index_path: {e} \n Speaker name: {speaker_name} \n Base path: {base_path} \n")
         raise e
     
+def get_target_sample_rate(speaker_name, base_path):
+    """
+    Returns the sample rate of the audio converted to the given speaker's voice.
+    """
+    _, device, dtype = get_config()
+    model_path = get_speaker_model_path(speaker_name, base_path)
+
+    # Read it from the resident model without waiting for the conversion that may be using it
+    vc = registry.peek("rvc", model_path, device, dtype)
+    if vc is not None:
+        return vc.tgt_sr
+    with registry.use("rvc", model_path, device, dtype) as vc:
+        return vc.tgt_sr
+
+def stream_voice(chunks, sample_rate, speaker_name, base_path, index_rate=0.5, filter_radius=3, rms_mix_rate=0.25, protect=0.33,
+                 block_ms=None, crossfade_ms=None):
+    """
+    Converts a stream of audio to the given speaker's voice, yielding the converted audio block by block (e.g. the chunks of tts.stream_audio_tortoise).
+    The models stay in use until the stream ends.
+
+    Args:
+        chunks (iterable): Mono 16-bit PCM audio at sample_rate, as bytes.
+        sample_rate (int): The sample rate of the input, a multiple of 100.
+        speaker_name (str): The name of the speaker.
+        base_path (str): The base path for the speaker model and index.
+        index_rate (float, optional): The rate at which the index is generated. Defaults to 0.5.
+        filter_radius (int, optional): The radius of the filter used for voice conversion. Defaults to 3.
+        rms_mix_rate (float, optional): The rate at which the RMS of the converted voice is mixed with the original voice. Defaults to 0.25.
+        protect (float, optional): The protection of voiceless consonants and breaths. Defaults to 0.33.
+        block_ms (int, optional): The length of the converted blocks, in milliseconds. Defaults to RVC_STREAM_BLOCK_MS.
+        crossfade_ms (int, optional): The length of the crossfade between blocks, in milliseconds. Defaults to RVC_STREAM_CROSSFADE_MS.
+
+    Yields:
+        bytes: Mono 16-bit PCM audio at the speaker's sample rate (see get_target_sample_rate).
+    """
+    try:
+        model_path = get_speaker_model_path(speaker_name, base_path)
+        index_path = get_speaker_index_path(speaker_name, base_path)
+        config, device, dtype = get_config()
+
+        blocks = (np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32768 for chunk in chunks)
+
+        with registry.use("rvc", model_path, device, dtype) as vc, \
+             registry.use("hubert", HUBERT_MODEL_PATH, device, dtype) as hubert_model, \
+             registry.use("rmvpe", RMVPE_MODEL_PATH, device, dtype) as model_rmvpe:
+            vc.hubert_model = hubert_model
+            vc.pipeline.model_rmvpe = model_rmvpe
+            vc.pipeline.retrieval = get_retrieval(speaker_name)
+
+            try:
+                for audio in vc.vc_stream(0, blocks, sample_rate, 0, "rmvpe", index_path, index_rate, filter_radius,
+                                          rms_mix_rate, protect, block_ms=block_ms, crossfade_ms=crossfade_ms):
+                    yield audio.tobytes()
+            finally:
+                # Detach the shared models so the registry can evict them independently of the speaker's VC
+                vc.hubert_model = None
+                if hasattr(vc.pipeline, "model_rmvpe"):
+                    del vc.pipeline.model_rmvpe
+
+    except Exception as e:
+        # If an error occurs, print the error message to the console and raise it again
+        print(f"Error in rvc.stream_voice: {e} \n Speaker name: {speaker_name} \n Base path: {base_path} \n")
+        raise e
+
 def clone_voice(audio_file_path,speaker_name,base_path,index_rate,filter_radius,resample_sr,rms_mix_rate,protect):
     """
     Clone the voice from the given audio file using the specified parameters.
@@ -103,38 +244,45 @@ def clone_voice(audio_file_path,speaker_name,base_path,index_rate,filter_radius,
         # Define the status file path
         status_file_path = f'{file_name}_rvc_status.txt'
 
-        # Create a status file to indicate that the rvc is in progress
-        with open(status_file_path, 'w') as f:
-            f.write('In progress')
-            f.close()
-
-        # Load .env file
-        load_dotenv()
+        # Mark the rvc step as in progress (also writes the status file)
+        jq.start_step('rvc', status_file_path)
 
         # Load config
-        config = Config()
-        
-        # Init VC
-        vc = VC(config)
+        config, device, dtype = get_config()
 
-        # Get VC
-        vc.get_vc(model_path,protect,protect)
-        
-        # Do RVC
-        _, wav_opt = vc.vc_single(
-            sid=0,
-            input_audio_path=audio_file_path,
-            f0_up_key=0,
-            f0_file=None,
-            f0_method="rmvpe",
-            file_index=index_path,
-            file_index2=None,
-            index_rate=index_rate,
-            filter_radius=filter_radius,
-            resample_sr=resample_sr,
-            rms_mix_rate=rms_mix_rate,
-            protect=protect,
-        )
+        # Get the resident VC of the speaker, checked out by this conversion only, along with the shared HuBERT and RMVPE models
+        with registry.use("rvc", model_path, device, dtype) as vc, \
+             registry.use("hubert", HUBERT_MODEL_PATH, device, dtype) as hubert_model, \
+             registry.use("rmvpe", RMVPE_MODEL_PATH, device, dtype) as model_rmvpe:
+            vc.hubert_model = hubert_model
+            vc.pipeline.model_rmvpe = model_rmvpe
+            vc.pipeline.retrieval = get_retrieval(speaker_name)
+
+            try:
+                # Do RVC
+                _, wav_opt = vc.vc_single(
+                    sid=0,
+                    input_audio_path=audio_file_path,
+                    f0_up_key=0,
+                    f0_file=None,
+                    f0_method="rmvpe",
+                    file_index=index_path,
+                    file_index2=None,
+                    index_rate=index_rate,
+                    filter_radius=filter_radius,
+                    resample_sr=resample_sr,
+                    rms_mix_rate=rms_mix_rate,
+                    protect=protect,
+                )
+
+                # Record the GPU memory used by the conversion on the job
+                for name, value in vc.pipeline.memory.job_stats.items():
+                    jq.record_metric(name, value)
+            finally:
+                # Detach the shared models so the registry can evict them independently of the speaker's VC
+                vc.hubert_model = None
+                if hasattr(vc.pipeline, "model_rmvpe"):
+                    del vc.pipeline.model_rmvpe
 
         print(f"_: {_}\n")
 
@@ -145,18 +293,15 @@ def clone_voice(audio_file_path,speaker_name,base_path,index_rate,filter_radius,
         os.remove(audio_file_path)
         os.rename(new_audio_file_path, audio_file_path)
         
-        # Once the rvc is complete, delete the status file
-        os.remove(status_file_path)
+        # Once the rvc is complete, mark the step as done (also deletes the status file)
+        jq.finish_step(status_file_path)
 
         print("RVC request complete")
         print("-------------------- RVC Complete --------------------")
 
     except Exception as e:
-        # If an error occurs, update the status file with the error message
-        with open(status_file_path, 'w') as f:
-            f.write('Error\n')
-            f.write(str(e))
-            f.close()
+        # If an error occurs, mark the step as failed (also updates the status file with the error message)
+        jq.fail_step(e, status_file_path)
 
         # If an error occurs, print the error message to the console and raise it again
         print(f"Error in rvc.clone_voice: {e} \n Audio file path: {audio_file_path} \n Speaker name: {speaker_name} \n Base path: {base_path} \n")
@@ -1,17 +1,22 @@
 # Import Python Libraries
 from aiohttp import web
 from huggingface_hub import snapshot_download
+import asyncio
+import json
 import os
-import torch
 import threading
+import time
+import torch
 
 # Import Custom Libraries
 import transcription_service.stt as stt
+from transcription_service.transcript_writer import read_transcript_range
 import text_to_speech_service.tts
 import rvc_service.rvc
 import assistant_service.ingest
 import assistant_service.chat
 import service_pipeline as sp
+import job_queue as jq
 
 # Server Settings
 HOST = "0.0.0.0"
@@ -23,6 +28,30 @@ PODCASTS_FOLDER_PATH = "/ServerFiles/Podcasts"
 SPEAKERS_FOLDER_PATH = "/ServerFiles/Speakers"
 REPO_ID = "Awaazo/Speakers"
 
+# Bounded worker pools that run the long jobs, one pool per stage
+jobs = jq.create_job_queue()
+
+# Interval between keep-alive comments on job event streams, in seconds
+SSE_KEEP_ALIVE_INTERVAL = 15
+
+def get_resource(podcast_id, episode_id, kind):
+    '''
+    Returns the name of an episode resource that only one job may work on at a time.
+
+    Args:
+        podcast_id (str): The ID of the podcast.
+        episode_id (str): The ID of the episode.
+        kind (str): The kind of resource ('transcript', 'audio' or 'ingestion').
+    '''
+    return f'{podcast_id}/{episode_id}/{kind}'
+
+def get_transcript_status_file_path(podcast_id, episode_id):
+    '''
+    Returns the legacy status file of the transcription of an episode, the one written by stt.create_transcript_whisperx
+    and read by the Backend.
+    '''
+    return f'{os.getcwd()}{PODCASTS_FOLDER_PATH}/{podcast_id}/{episode_id}_status.txt'
+
 async def handle_transcription_request(request):
     '''
     Handles the transcription request
@@ -32,6 +61,7 @@ async def handle_transcription_request(request):
         It should contain the following data:
             podcast_id (str): The ID of the podcast to transcribe. Required. 
             episode_file_name (str): The name of the episode file to transcribe. Required.
+            priority (int): The priority of the job, lower values run first. Default is 5.
     
     Returns:
         A web response with the status of the transcription process.
@@ -48,6 +78,16 @@ async def handle_transcription_request(request):
         podcast_id = request.match_info['podcast_id']
         episode_file_name = request.match_info['episode_file_name']
 
+        # Get the priority of the job
+        priority = request.query.get('priority', jq.DEFAULT_PRIORITY)
+
+        # Whether to label the lines with their speaker
+        diarize = request.query.get('diarize', '1' if stt.STT_DIARIZATION else '0') == '1'
+
+        # An explicit request fails here with a clear message when the diarization model is missing
+        if request.query.get('diarize') == '1':
+            stt.diarization.check_model()
+
         # Get the path to the audio file
         episode_audio_path = f'{os.getcwd()}{PODCASTS_FOLDER_PATH}/{podcast_id}/{episode_file_name}'
 
@@ -56,27 +96,29 @@ async def handle_transcription_request(request):
             raise Exception(f'No Audio exists for the given podcastID and episode file name.')
         
         transcript_file_path = episode_audio_path.split('.')[0]+'.json'
-        status_file_path = episode_audio_path.split('.')[0]+'_status.txt'
+        episode_id = episode_file_name.split('.')[0]
 
         # Check if the transcript already exists
         if os.path.isfile(transcript_file_path):
             raise Exception(f'Transcript already exists for the given episode.')
 
-        # Check if the transcription is already in progress
-        if os.path.isfile(status_file_path):
-            with open(status_file_path, 'r') as f:
-                status = f.read()
-                f.close()
-            if status == 'In progress':
-                raise Exception(f'Transcription is already in progress for the given episode.')
-    
-        # Launch the thread to create the transcript (DO NOT AWAIT as it could take a long time depending on the audio size)
-        threading.Thread(target=stt.create_transcript_whisperx, args=(episode_audio_path,)).start()
+        # Queue the job to create the transcript (DO NOT AWAIT as it could take a long time depending on the audio size)
+        # Claiming the transcript resource fails if a transcription is already queued or in progress for the episode
+        job = jobs.submit(jq.STT_STAGE, 'transcription', stt.create_transcript_whisperx, args=(episode_audio_path,), kwargs={'diarize': diarize}, priority=priority,
+                          podcast_id=podcast_id, episode_id=episode_id, resource=get_resource(podcast_id, episode_id, 'transcript'),
+                          status_file_path=get_transcript_status_file_path(podcast_id, episode_id))
 
         status = "Transcription process has been initiated."
 
-        return web.Response(text=status, status=200)
+        return web.Response(text=status, status=200, headers={'X-Job-Id': job.id})
     
+    except jq.JobConflictError as e:
+        # If the episode is already being worked on, send a 409 response
+        return web.Response(status=409, text=str(e))
+    except jq.QueueFullError as e:
+        # If the queue is full, send a 429 response so the caller can retry later
+        print(f"Queue full in handle_transcription_request: {e}")
+        return web.Response(status=429, text=str(e))
     except Exception as e:
         return web.Response(status=400, text=str(e))
 
@@ -93,6 +135,7 @@ async def handle_text_to_speech_request(request):
             podcast_id (str): The ID of the podcast to convert the text to speech. Required. 
             episode_id (str): The ID of the episode to convert the text to speech. Required.
             delimiter (str): The delimiter to use for the text to speech process. Default is ''.
+            priority (int): The priority of the job, lower values run first. Default is 5.
     Returns:
         A web response with the status of the text-to-speech process.
         It should contain the following data:
@@ -122,6 +165,7 @@ async def handle_text_to_speech_request(request):
         # Get the podcast and episode IDs to convert to speech
         podcast_id = data.get('podcast_id')
         episode_id = data.get('episode_id')
+        priority = data.get('priority', jq.DEFAULT_PRIORITY)
 
         print(f"Text: {text}, Language: {language}, Speaker Name: {speaker_name}, Podcast ID: {podcast_id}, Episode ID: {episode_id}")
 
@@ -142,9 +186,6 @@ async def handle_text_to_speech_request(request):
 
         # Set the path to the resulting audio file
         episode_audio_path = f'{os.getcwd()}{PODCASTS_FOLDER_PATH}/{podcast_id}/{episode_id}.wav'
-        
-        # Set the path to the status file for the text to speech process
-        status_file_path = episode_audio_path.split('.')[0]+'_tts_status.txt'
 
         # Check if the audio file already exists
         if os.path.isfile(episode_audio_path):
@@ -153,31 +194,166 @@ async def handle_text_to_speech_request(request):
         if not os.path.isdir(f'{os.getcwd()}{PODCASTS_FOLDER_PATH}/{podcast_id}'):
             raise Exception(f'Podcast folder does not exist for the given podcast ID.')
 
-        # Check if the text to speech is already in progress
-        if os.path.isfile(status_file_path):
-            with open(status_file_path, 'r') as f:
-                status = f.read()
-                f.close()
-            if status == 'In progress':
-                raise Exception(f'Text to speech is already in progress for the given episode.')
+        # Claiming the audio resource fails if a job is already queued or in progress for the episode's audio
+        episode = dict(podcast_id=podcast_id, episode_id=episode_id, resource=get_resource(podcast_id, episode_id, 'audio'))
 
         # If GPU is available, launch the text to speech process using Tortoise TTS
         if torch.cuda.is_available():
-            threading.Thread(target=text_to_speech_service.tts.create_audio_tortoise, args=(text,speaker_name,episode_audio_path,delimiter)).start()
+            job = jobs.submit(jq.TTS_STAGE, 'tts', text_to_speech_service.tts.create_audio_tortoise, args=(text,speaker_name,episode_audio_path,delimiter), priority=priority, **episode)
         else:
-            # Launch the thread to create the audio file (DO NOT AWAIT as it could take a long time depending on the text size)
-            threading.Thread(target=text_to_speech_service.tts.create_audio_coqui, args=(text,language,speaker_file_path,episode_audio_path)).start()
+            # Queue the job to create the audio file (DO NOT AWAIT as it could take a long time depending on the text size)
+            job = jobs.submit(jq.TTS_STAGE, 'tts', text_to_speech_service.tts.create_audio_coqui, args=(text,language,speaker_file_path,episode_audio_path), priority=priority, **episode)
 
         status = "Text to speech process has been initiated."
 
         # Return a 200 response with the status
-        return web.Response(text=status, status=200)
+        return web.Response(text=status, status=200, headers={'X-Job-Id': job.id})
 
+    except jq.JobConflictError as e:
+        # If the episode is already being worked on, send a 409 response
+        print(f"Conflict in handle_text_to_speech_request: {e}")
+        return web.Response(status=409, text=str(e))
+
+    except jq.QueueFullError as e:
+        # If the queue is full, send a 429 response so the caller can retry later
+        print(f"Queue full in handle_text_to_speech_request: {e}")
+        return web.Response(status=429, text=str(e))
     except Exception as e:
         # If an error occurs, send a 400 response with the error message
         print(f"Error in handle_text_to_speech_request: {e}")
         return web.Response(status=400, text=str(e))
 
+async def handle_text_to_speech_stream_request(request):
+    """
+    Handle a streaming text-to-speech request. The audio is sent as it is generated, so playback can start
+    after the first chunk is decoded instead of after the whole text.
+
+    Args:
+        request: The HTTP request object.
+        It should contain the following data:
+            text (str): The text to convert to speech. Required.
+            speaker_name (str): The name of the speaker to convert the text to speech. Default is 'Default'.
+            delimiter (str): The delimiter to use for the text to speech process. Default is ''.
+            format (str): 'wav' for a WAV stream or 'pcm' for raw 16-bit mono PCM (at 24kHz, or the speaker's RVC sample rate with rvc). Default is 'wav'.
+            stream_chunk_size (int): The number of tokens decoded per chunk, lower values start sooner. Default is 40.
+            rvc (bool): Whether to convert the audio to the speaker's voice with RVC block by block. Default is False.
+            index_rate, filter_radius, rms_mix_rate, protect: The RVC parameters, see handle_realistic_voice_cloning_request.
+            priority (int): The priority of the job, lower values run first. Default is 0.
+    Returns:
+        A chunked response with the audio. The time to first audio is logged and recorded in the job's metrics.
+
+    Raises:
+        Exception: If an error occurs before the first chunk of audio is sent.
+    """
+    try:
+        print("Handling text-to-speech stream request...")
+
+        received_at = time.time()
+
+        # Get all the data from the request
+        data = await request.json()
+
+        text = data.get('text')
+        speaker_name = data.get('speaker_name', 'Default')
+        delimiter = data.get('delimiter','')
+        audio_format = data.get('format', 'wav')
+        stream_chunk_size = int(data.get('stream_chunk_size', 40))
+        use_rvc = bool(data.get('rvc', False))
+        index_rate = data.get('index_rate', 0.5)
+        filter_radius = data.get('filter_radius', 3)
+        rms_mix_rate = data.get('rms_mix_rate', 0.25)
+        protect = data.get('protect', 0.33)
+        priority = data.get('priority', jq.HIGH_PRIORITY)
+
+        print(f"Text: {text}, Speaker Name: {speaker_name}, Format: {audio_format}, Stream Chunk Size: {stream_chunk_size}, RVC: {use_rvc}")
+
+        # Make sure the text is not empty
+        if not text:
+            raise Exception(f'No text was provided.')
+
+        # Make sure the format is supported
+        if audio_format not in ('wav', 'pcm'):
+            raise Exception(f'Unsupported format {audio_format}, use wav or pcm.')
+
+        # Make sure the speaker exists
+        base_path = f'{os.getcwd()}{SPEAKERS_FOLDER_PATH}'
+        text_to_speech_service.tts.get_speaker_file_path(speaker_name, base_path)
+        if use_rvc:
+            rvc_service.rvc.get_speaker_model_path(speaker_name, base_path)
+
+        # The job runs on a TTS worker and hands the chunks to this handler, None marks the end of the stream
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        stopped = threading.Event()
+        # Set by the job before the first chunk
+        stream_info = {'sample_rate': text_to_speech_service.tts.STREAM_SAMPLE_RATE}
+
+        def stream():
+            try:
+                audio = text_to_speech_service.tts.stream_audio_tortoise(text, speaker_name, delimiter, stream_chunk_size, should_stop=stopped.is_set)
+                if use_rvc:
+                    # Convert the voice chunk by chunk as the TTS produces it
+                    stream_info['sample_rate'] = rvc_service.rvc.get_target_sample_rate(speaker_name, base_path)
+                    audio = rvc_service.rvc.stream_voice(audio, text_to_speech_service.tts.STREAM_SAMPLE_RATE, speaker_name, base_path,
+                                                         index_rate, filter_radius, rms_mix_rate, protect)
+                for chunk in audio:
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            except Exception as e:
+                loop.call_soon_threadsafe(chunks.put_nowait, e)
+                raise e
+            finally:
+                loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+        # Queue the job to stream the audio, on the stream workers rather than behind the episode jobs
+        job = jobs.submit(jq.TTS_STREAM_STAGE, 'tts_stream', stream, priority=priority)
+
+    except jq.QueueFullError as e:
+        # If the queue is full, send a 429 response so the caller can retry later
+        print(f"Queue full in handle_text_to_speech_stream_request: {e}")
+        return web.Response(status=429, text=str(e))
+    except Exception as e:
+        # If an error occurs, send a 400 response with the error message
+        print(f"Error in handle_text_to_speech_stream_request: {e}")
+        return web.Response(status=400, text=str(e))
+
+    response = None
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+
+            if isinstance(chunk, Exception):
+                # Errors before the first chunk get a proper status, after that the stream is cut short
+                if response is None:
+                    return web.Response(status=500, text=str(chunk), headers={'X-Job-Id': job.id})
+                break
+
+            # Start the response with the first chunk so that errors while loading the model can still be reported
+            if response is None:
+                time_to_first_audio = time.time() - received_at
+                jobs.store.record_metric(job, 'time_to_first_audio', round(time_to_first_audio, 3))
+                print(f"Time to first audio for job {job.id}: {time_to_first_audio:.2f}s")
+
+                sample_rate = stream_info['sample_rate']
+                content_type = 'audio/wav' if audio_format == 'wav' else f'audio/L16;rate={sample_rate};channels=1'
+                response = web.StreamResponse(headers={'Content-Type': content_type, 'X-Job-Id': job.id})
+                response.enable_chunked_encoding()
+                await response.prepare(request)
+                if audio_format == 'wav':
+                    await response.write(text_to_speech_service.tts.get_wav_header(sample_rate))
+
+            await response.write(chunk)
+
+        if response is None:
+            return web.Response(status=500, text='No audio was generated.', headers={'X-Job-Id': job.id})
+
+        await response.write_eof()
+        return response
+    finally:
+        # Stop the generation if the client went away
+        stopped.set()
+
 async def handle_realistic_voice_cloning_request(request):
     """
     Handle a realistic voice cloning request.
@@ -193,6 +369,7 @@ async def handle_realistic_voice_cloning_request(request):
             resample_sr (int): The target sampling rate for the converted voice. Default is 0.
             rms_mix_rate (float): The rate at which the RMS of the converted voice is mixed with the original voice. Default is 0.25.
             protect (bool): Flag indicating whether to protect the converted voice. Default is False.
+            priority (int): The priority of the job, lower values run first. Default is 5.
     Returns:
         A web response with the status of the realistic voice cloning process.
 
@@ -210,6 +387,7 @@ async def handle_realistic_voice_cloning_request(request):
         # Get the podcast and episode IDs to use realistic voice cloning
         podcast_id = data.get('podcast_id')
         episode_id = data.get('episode_id')
+        priority = data.get('priority', jq.DEFAULT_PRIORITY)
 
         # Get the speaker's name to use realistic voice cloning
         speaker_name = data.get('speaker_name', 'Default')
@@ -241,9 +419,6 @@ async def handle_realistic_voice_cloning_request(request):
 
         # Set the path to the resulting audio file
         episode_audio_path = f'{os.getcwd()}{PODCASTS_FOLDER_PATH}/{podcast_id}/{episode_id}.wav'
-        
-        # Set the path to the status file for the rvc process
-        status_file_path = episode_audio_path.split('.')[0]+'_rvc_status.txt'
 
         # Get the base path
         base_path = f'{os.getcwd()}{SPEAKERS_FOLDER_PATH}'
@@ -252,21 +427,23 @@ async def handle_realistic_voice_cloning_request(request):
         if os.path.isfile(episode_audio_path) == False:
             raise Exception(f'Audio does not exists for the given episode.')
 
-        # Check if the rvc is already in progress
-        if os.path.isfile(status_file_path):
-            with open(status_file_path, 'r') as f:
-                status = f.read()
-                f.close()
-            if status == 'In progress':
-                raise Exception(f'RVC is already in progress for the given episode.')
-
-        # Launch the thread to create the audio file (DO NOT AWAIT as it could take a long time depending on the audio duration)
-        threading.Thread(target=rvc_service.rvc.clone_voice, args=(episode_audio_path,speaker_name,base_path,index_rate,filter_radius,resample_sr,rms_mix_rate,protect)).start()
+        # Queue the job to create the audio file (DO NOT AWAIT as it could take a long time depending on the audio duration)
+        # Claiming the audio resource fails if a job is already queued or in progress for the episode's audio
+        job = jobs.submit(jq.TTS_STAGE, 'rvc', rvc_service.rvc.clone_voice, args=(episode_audio_path,speaker_name,base_path,index_rate,filter_radius,resample_sr,rms_mix_rate,protect), priority=priority,
+                          podcast_id=podcast_id, episode_id=episode_id, resource=get_resource(podcast_id, episode_id, 'audio'))
 
         status = "RVC process has been initiated."
 
         # Return a 200 response with the status
-        return web.Response(text=status, status=200)
+        return web.Response(text=status, status=200, headers={'X-Job-Id': job.id})
+    except jq.JobConflictError as e:
+        # If the episode is already being worked on, send a 409 response
+        print(f"Conflict in handle_realistic_voice_cloning_request: {e}")
+        return web.Response(status=409, text=str(e))
+    except jq.QueueFullError as e:
+        # If the queue is full, send a 429 response so the caller can retry later
+        print(f"Queue full in handle_realistic_voice_cloning_request: {e}")
+        return web.Response(status=429, text=str(e))
     except Exception as e:
         # If an error occurs, send a 400 response with the error message
         print(f"Error in handle_realistic_voice_cloning_request: {e}")
@@ -281,6 +458,7 @@ async def handle_ingest_request(request):
         It should contain the following data:
             podcast_id (str): The ID of the podcast to ingest. Required. 
             episode_id (str): The ID of the episode to ingest. Required.
+            priority (int): The priority of the job, lower values run first. Default is 5.
     Returns:
         A web response with the status of the ingest process.
 
@@ -295,12 +473,22 @@ async def handle_ingest_request(request):
         # Get the podcast and episode IDs to ingest
         podcast_id = data.get('podcast_id')
         episode_id = data.get('episode_id')
+        priority = data.get('priority', jq.DEFAULT_PRIORITY)
 
         print(f"Podcast ID: {podcast_id}, Episode ID: {episode_id}")
 
-        assistant_service.ingest.process_transcript(podcast_id,episode_id)
-
-        return web.Response(text="Ingest process has been initiated.", status=200)
+        job = jobs.submit(jq.INGEST_STAGE, 'ingest', assistant_service.ingest.process_transcript, args=(podcast_id,episode_id), priority=priority,
+                          podcast_id=podcast_id, episode_id=episode_id, resource=get_resource(podcast_id, episode_id, 'ingestion'))
+
+        return web.Response(text="Ingest process has been initiated.", status=200, headers={'X-Job-Id': job.id})
+    except jq.JobConflictError as e:
+        # If the episode is already being worked on, send a 409 response
+        print(f"Conflict in handle_ingest_request: {e}")
+        return web.Response(status=409, text=str(e))
+    except jq.QueueFullError as e:
+        # If the queue is full, send a 429 response so the caller can retry later
+        print(f"Queue full in handle_ingest_request: {e}")
+        return web.Response(status=429, text=str(e))
     except Exception as e:
         # If an error occurs, send a 400 response with the error message
         print(f"Error in handle_ingest_request: {e}")
@@ -362,6 +550,7 @@ async def handle_tts_request(request):
             resample_sr (int): The target sampling rate for the converted voice. Default is 0.
             rms_mix_rate (float): The rate at which the RMS of the converted voice is mixed with the original voice. Default is 0.25.
             protect (bool): Flag indicating whether to protect the converted voice. Default is False.
+            priority (int): The priority of the job, lower values run first. Default is 5.
 
     Returns:
         A web response with the status of the TTS/RVC process.
@@ -376,6 +565,7 @@ async def handle_tts_request(request):
 
         podcast_id = data.get('podcast_id')
         episode_id = data.get('episode_id')
+        priority = data.get('priority', jq.DEFAULT_PRIORITY)
         text = data.get('text')
         language = data.get('language','en')
         speaker_name = data.get('speaker_name', 'Default')
@@ -389,12 +579,21 @@ async def handle_tts_request(request):
 
         print(f"Podcast ID: {podcast_id}, Episode ID: {episode_id}, Text: {text}, Language: {language}, Speaker Name: {speaker_name}, Delimiter: {delimiter}, Use Tortoise?: {use_tortoise}, Index Rate: {index_rate}, Filter Radius: {filter_radius}, Resample Sample Rate: {resample_sr}, RMS Mix Rate:{rms_mix_rate}, Protect: {protect}\n")
 
-        threading.Thread(target=sp.tts_rvc_pipeline, args=(podcast_id,episode_id,text,delimiter,speaker_name,language,use_tortoise,index_rate,filter_radius,resample_sr,rms_mix_rate,protect)).start()
+        job = jobs.submit(jq.TTS_STAGE, 'tts_rvc', sp.tts_rvc_pipeline, args=(podcast_id,episode_id,text,delimiter,speaker_name,language,use_tortoise,index_rate,filter_radius,resample_sr,rms_mix_rate,protect), priority=priority,
+                          podcast_id=podcast_id, episode_id=episode_id, resource=get_resource(podcast_id, episode_id, 'audio'))
 
         print("---------------- TTS/RVC Request Completed ----------------")
         
-        return web.Response(text="TTS/RVC started...", status=200)
+        return web.Response(text="TTS/RVC started...", status=200, headers={'X-Job-Id': job.id})
     
+    except jq.JobConflictError as e:
+        # If the episode is already being worked on, send a 409 response
+        print(f"Conflict in handle_tts_request: {e}")
+        return web.Response(status=409, text=str(e))
+    except jq.QueueFullError as e:
+        # If the queue is full, send a 429 response so the caller can retry later
+        print(f"Queue full in handle_tts_request: {e}")
+        return web.Response(status=429, text=str(e))
     except Exception as e:
         print(f"Error in handle_tts_request: {e}")
         return web.Response(status=400, text=str(e))
@@ -408,6 +607,7 @@ async def handle_stt_ingest_request(request):
         It should contain the following data:
             podcast_id (str): The ID of the podcast to transcribe. Required. 
             episode_id (str): The ID of the episode to transcribe. Required.
+            priority (int): The priority of the job, lower values run first. Default is 5.
 
     Returns:
         A web response with the status of the transcription process.
@@ -422,15 +622,26 @@ async def handle_stt_ingest_request(request):
 
         podcast_id = data.get('podcast_id')
         episode_id = data.get('episode_id')
+        priority = data.get('priority', jq.DEFAULT_PRIORITY)
 
         print(f"Podcast ID: {podcast_id}, Episode ID: {episode_id}\n")
 
-        threading.Thread(target=sp.transcription_ingestion_pipeline, args=(podcast_id,episode_id)).start()
+        job = jobs.submit(jq.STT_STAGE, 'stt_ingest', sp.transcription_ingestion_pipeline, args=(podcast_id,episode_id), priority=priority,
+                          podcast_id=podcast_id, episode_id=episode_id, resource=get_resource(podcast_id, episode_id, 'transcript'),
+                          status_file_path=get_transcript_status_file_path(podcast_id, episode_id))
         #sp.transcription_ingestion_pipeline(podcast_id,episode_id)
 
         print("---------------- TTS/RVC Request Completed ----------------")
 
-        return web.Response(text="STT started...", status=200)
+        return web.Response(text="STT started...", status=200, headers={'X-Job-Id': job.id})
+    except jq.JobConflictError as e:
+        # If the episode is already being worked on, send a 409 response
+        print(f"Conflict in handle_stt_ingest_request: {e}")
+        return web.Response(status=409, text=str(e))
+    except jq.QueueFullError as e:
+        # If the queue is full, send a 429 response so the caller can retry later
+        print(f"Queue full in handle_stt_ingest_request: {e}")
+        return web.Response(status=429, text=str(e))
     except Exception as e:
         print(f"Error in handle_stt_request: {e}")
         return web.Response(status=400, text=str(e))
@@ -445,6 +656,7 @@ async def handle_stt_request(request):
             podcast_id (str): The ID of the podcast to transcribe. Required. 
             episode_id (str): The ID of
             the episode to transcribe. Required.
+            priority (int): The priority of the job, lower values run first. Default is 5.
         
     Returns:
         A web response with the status of the transcription process.
@@ -465,6 +677,7 @@ async def handle_stt_request(request):
         # Get the podcast and episode IDs to transcribe
         podcast_id = data.get('podcast_id')
         episode_id = data.get('episode_id')
+        priority = data.get('priority', jq.DEFAULT_PRIORITY)
 
         print(f"Podcast ID: {podcast_id}, Episode ID: {episode_id}\n")
         
@@ -503,11 +716,21 @@ async def handle_stt_request(request):
 
         print("Starting transcription step...")
 
-        threading.Thread(target=stt.create_transcript_whisperx, args=(episode_filename,)).start()
+        job = jobs.submit(jq.STT_STAGE, 'stt', stt.create_transcript_whisperx, args=(episode_filename,), priority=priority,
+                          podcast_id=podcast_id, episode_id=episode_id, resource=get_resource(podcast_id, episode_id, 'transcript'),
+                          status_file_path=get_transcript_status_file_path(podcast_id, episode_id))
         
         print("---------------- STT Request Completed ----------------")
-        return web.Response(text="STT started...", status=200)
+        return web.Response(text="STT started...", status=200, headers={'X-Job-Id': job.id})
     
+    except jq.JobConflictError as e:
+        # If the episode is already being worked on, send a 409 response
+        print(f"Conflict in handle_stt_request: {e}")
+        return web.Response(status=409, text=str(e))
+    except jq.QueueFullError as e:
+        # If the queue is full, send a 429 response so the caller can retry later
+        print(f"Queue full in handle_stt_request: {e}")
+        return web.Response(status=429, text=str(e))
     except Exception as e:
         print(f"Error in handle_stt_request: {e}")
         return web.Response(status=400, text=str(e))
@@ -525,6 +748,7 @@ async def handle_generate_episode_request(request):
             podcast_description (str): The description of the podcast. Required.
             prompt (str): The prompt to generate the episode. Required.
             speaker_name (str): The name of the speaker to generate the episode. Default is 'Drinker'.
+            priority (int): The priority of the job, lower values run first. Default is 5.
 
     Returns:
         A web response with the status of the text generation process.
@@ -539,6 +763,7 @@ async def handle_generate_episode_request(request):
 
         podcast_id = data.get('podcast_id')
         episode_id = data.get('episode_id')
+        priority = data.get('priority', jq.DEFAULT_PRIORITY)
         podcast_name = data.get('podcast_name')
         podcast_description = data.get('podcast_description')
         prompt = data.get('prompt')
@@ -546,11 +771,20 @@ async def handle_generate_episode_request(request):
 
         print(f"Podcast ID: {podcast_id}, Episode ID: {episode_id}, Podcast Name: {podcast_name}, Podcast Description: {podcast_description}, Prompt: {prompt}\n")
 
-        threading.Thread(target=sp.generate_episode_pipeline, args=(podcast_id,episode_id,podcast_name,podcast_description,prompt,speaker_name)).start()
+        job = jobs.submit(jq.TTS_STAGE, 'generate_episode', sp.generate_episode_pipeline, args=(podcast_id,episode_id,podcast_name,podcast_description,prompt,speaker_name), priority=priority,
+                          podcast_id=podcast_id, episode_id=episode_id, resource=get_resource(podcast_id, episode_id, 'audio'))
 
         print("---------------- Text Generation Request Completed ----------------")
 
-        return web.Response(text="Generation started...", status=200)
+        return web.Response(text="Generation started...", status=200, headers={'X-Job-Id': job.id})
+    except jq.JobConflictError as e:
+        # If the episode is already being worked on, send a 409 response
+        print(f"Conflict in handle_generate_episode_request: {e}")
+        return web.Response(status=409, text=str(e))
+    except jq.QueueFullError as e:
+        # If the queue is full, send a 429 response so the caller can retry later
+        print(f"Queue full in handle_generate_episode_request: {e}")
+        return web.Response(status=429, text=str(e))
     except Exception as e:
         print(f"Error in handle_generate_episode_request: {e}")
         return web.Response(status=400, text=str(e))
@@ -566,6 +800,7 @@ async def handle_generate_episode_from_text_request(request):
             episode_id (str): The ID of the episode to generate. Required.
             text (str): The text to generate the episode from. Required.
             speaker_name (str): The name of the speaker to generate the episode. Default is 'Drinker'.
+            priority (int): The priority of the job, lower values run first. Default is 5.
 
     Returns:
         A web response with the status of the text generation process.
@@ -580,19 +815,152 @@ async def handle_generate_episode_from_text_request(request):
 
         podcast_id = data.get('podcast_id')
         episode_id = data.get('episode_id')
+        priority = data.get('priority', jq.DEFAULT_PRIORITY)
         text = data.get('text', '')
         speaker_name = data.get('speaker_name', 'Drinker')
 
         print(f"Podcast ID: {podcast_id}, Episode ID: {episode_id}, Text: {text}\n")
 
-        threading.Thread(target=sp.generate_episode_pipeline_with_text, args=(podcast_id,episode_id,text,speaker_name)).start()
+        job = jobs.submit(jq.TTS_STAGE, 'generate_episode_from_text', sp.generate_episode_pipeline_with_text, args=(podcast_id,episode_id,text,speaker_name), priority=priority,
+                          podcast_id=podcast_id, episode_id=episode_id, resource=get_resource(podcast_id, episode_id, 'audio'))
 
         print("---------------- Text Generation Request Completed ----------------")
 
-        return web.Response(text="Generation started...", status=200)
+        return web.Response(text="Generation started...", status=200, headers={'X-Job-Id': job.id})
+    except jq.JobConflictError as e:
+        # If the episode is already being worked on, send a 409 response
+        print(f"Conflict in handle_generate_episode_from_text_request: {e}")
+        return web.Response(status=409, text=str(e))
+    except jq.QueueFullError as e:
+        # If the queue is full, send a 429 response so the caller can retry later
+        print(f"Queue full in handle_generate_episode_from_text_request: {e}")
+        return web.Response(status=429, text=str(e))
     except Exception as e:
         print(f"Error in handle_generate_episode_request: {e}")
         return web.Response(status=400, text=str(e))
+
+async def handle_transcript_request(request):
+    """
+    Handle a request for the lines of a transcript around a seek time, read through the seek index of the transcript.
+    While the episode is being transcribed, the lines transcribed so far are returned.
+
+    Args:
+        request: The HTTP request object.
+        It should contain the following data:
+            podcast_id (str): The ID of the podcast. Required.
+            episode_id (str): The ID of the episode. Required.
+        It can contain the following query parameters:
+            seek (float): The earliest start time of the lines, in seconds. Default is 0.
+            duration (float): The length of the range, in seconds. Default is 60.
+
+    Returns:
+        A JSON response with the lines starting within the range and whether the transcript is complete,
+        or a 404 response if the episode has no transcript.
+    """
+    try:
+        podcast_id = request.match_info['podcast_id']
+        episode_id = request.match_info['episode_id']
+        seek = float(request.query.get('seek', 0))
+        duration = float(request.query.get('duration', 60))
+
+        transcript_file_path = f'{os.getcwd()}{PODCASTS_FOLDER_PATH}/{podcast_id}/{episode_id}.json'
+        lines, complete = read_transcript_range(transcript_file_path, seek, seek + duration)
+
+        return web.json_response({'lines': lines, 'complete': complete})
+    except FileNotFoundError:
+        return web.Response(status=404, text='No transcript exists for the given podcastID and episodeID.')
+    except Exception as e:
+        print(f"Error in handle_transcript_request: {e}")
+        return web.Response(status=400, text=str(e))
+
+async def handle_list_jobs_request(request):
+    """
+    Handle a request listing the jobs.
+
+    Args:
+        request: The HTTP request object.
+        It can contain the following query parameters:
+            podcast_id (str): Only list the jobs of this podcast. Optional.
+            episode_id (str): Only list the jobs of this episode, requires podcast_id. Optional.
+
+    Returns:
+        A JSON response with the jobs, oldest first, the stats of the worker pools and of the RVC audio cache.
+    """
+    try:
+        podcast_id = request.query.get('podcast_id')
+        episode_id = request.query.get('episode_id')
+
+        if podcast_id is not None and episode_id is not None:
+            found = jobs.store.find(podcast_id, episode_id)
+        else:
+            found = [job for job in jobs.store.list() if podcast_id is None or job.podcast_id == podcast_id]
+
+        return web.json_response({'jobs': [job.to_dict() for job in found], 'pools': jobs.stats(), 'rvc_audio_cache': rvc_service.rvc.audio_cache.stats()})
+    except Exception as e:
+        print(f"Error in handle_list_jobs_request: {e}")
+        return web.Response(status=400, text=str(e))
+
+async def handle_job_request(request):
+    """
+    Handle a job status request.
+
+    Args:
+        request: The HTTP request object.
+        It should contain the following data:
+            job_id (str): The ID of the job, as returned in the X-Job-Id header. Required.
+
+    Returns:
+        A JSON response with the status, step, progress and error of the job, or a 404 response if the job is unknown.
+    """
+    job = jobs.store.get(request.match_info['job_id'])
+    if job is None:
+        return web.Response(status=404, text='No job exists for the given job ID.')
+    return web.json_response(job.to_dict())
+
+async def handle_job_events_request(request):
+    """
+    Handle a job events request by streaming the updates of the job as server-sent events.
+    The current state of the job is sent first, the stream ends once the job is done or has failed.
+
+    Args:
+        request: The HTTP request object.
+        It should contain the following data:
+            job_id (str): The ID of the job, as returned in the X-Job-Id header. Required.
+
+    Returns:
+        A text/event-stream response with one 'job' event per update, or a 404 response if the job is unknown.
+    """
+    job_id = request.match_info['job_id']
+    job = jobs.store.get(job_id)
+    if job is None:
+        return web.Response(status=404, text='No job exists for the given job ID.')
+
+    # Subscribe before taking the snapshot so no update is missed in between
+    events = asyncio.Queue()
+    jobs.store.subscribe(job_id, asyncio.get_running_loop(), events)
+    try:
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+
+        event = job.to_dict()
+        while True:
+            await response.write(f"event: job\ndata: {json.dumps(event)}\n\n".encode('utf-8'))
+            if event['status'] in (jq.DONE, jq.FAILED):
+                break
+
+            # Wait for the next update, sending keep-alive comments so proxies do not close the stream
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=SSE_KEEP_ALIVE_INTERVAL)
+                    break
+                except asyncio.TimeoutError:
+                    await response.write(b": keep-alive\n\n")
+
+        await response.write_eof()
+        return response
+    finally:
+        # Stop receiving updates, also when the client went away
+        jobs.store.unsubscribe(job_id, events)
         
 
 # Create the server instance
@@ -601,7 +969,9 @@ app = web.Application()
 # Add the routes to the server
 app.add_routes([web.post('/stt', handle_stt_request)])
 app.add_routes([web.get('/{podcast_id}/{episode_file_name}/create_transcript', handle_transcription_request)])
+app.add_routes([web.get('/{podcast_id}/{episode_id}/transcript', handle_transcript_request)])
 app.add_routes([web.post('/tts', handle_text_to_speech_request)])
+app.add_routes([web.post('/tts/stream', handle_text_to_speech_stream_request)])
 app.add_routes([web.post('/rvc', handle_realistic_voice_cloning_request)])
 app.add_routes([web.post('/ingest', handle_ingest_request)])
 app.add_routes([web.post('/chat', handle_chat_request)])
@@ -609,6 +979,9 @@ app.add_routes([web.post('/tts_rvc', handle_tts_request)])
 app.add_routes([web.post('/stt_ingest', handle_stt_ingest_request)])
 app.add_routes([web.post('/generate_episode', handle_generate_episode_request)])
 app.add_routes([web.post('/generate_episode_from_text', handle_generate_episode_from_text_request)])
+app.add_routes([web.get('/jobs', handle_list_jobs_request)])
+app.add_routes([web.get('/jobs/{job_id}', handle_job_request)])
+app.add_routes([web.get('/jobs/{job_id}/events', handle_job_events_request)])
 
 # Download the Speakers
 print("Downloading Speaker Models...")
@@ -618,5 +991,9 @@ if(not os.path.isdir(f'{os.getcwd()}{SPEAKERS_FOLDER_PATH}')):
 else:
     print("Speaker Models already exist.")
 
+# Preload the models that should be resident before the first request (e.g. PRELOAD_MODELS="tts,stt,rvc:Drinker")
+print("Preloading Models...")
+sp.preload_models(os.getenv("PRELOAD_MODELS", ""))
+
 # Start the server
 web.run_app(app, port=PORT)
@@ -8,6 +8,33 @@ import torch
 import os
 import requests
 
+def preload_models(models):
+    """
+    Loads the given models into the model registry so that the first requests do not pay for the load.
+
+    Args:
+        models (str): Comma separated list of the models to preload. 
+                      Supported values are 'tts', 'stt', 'diarization' and 'rvc:<speaker>'. Unknown values are ignored.
+
+    Returns:
+        None
+    """
+    for model in [m.strip() for m in models.split(',') if m.strip()]:
+        try:
+            print(f"Preloading {model}...")
+            if model == 'tts':
+                tts.preload()
+            elif model == 'stt':
+                stt.preload()
+            elif model == 'diarization':
+                stt.diarization.preload()
+            elif model.startswith('rvc:'):
+                rvc.preload(speaker_name=model.split(':', 1)[1], base_path="./ServerFiles/Speakers")
+            else:
+                print(f"Unknown model to preload: {model}")
+        except Exception as e:
+            print(f"Failed to preload {model}: {e}")
+
 def tts_rvc_pipeline(podcast_id, episode_id, text, delimiter='', speaker='Default', language='en', use_tortoise=True, 
                      index_rate=0.5, filter_radius=3, resample_sr=0, rms_mix_rate=0.25, protect=0.33):
     """
@@ -165,12 +192,13 @@ def transcription_ingestion_pipeline(podcast_id, episode_id, model_name="base",
 
         print("Starting transcription step...")
 
-        stt.create_transcript_whisperx(audio_path=f"{episode_filename}", model_name=model_name, batch_size=batch_size, compute_type=compute_type, device=device)
+        has_speaker_labels = stt.create_transcript_whisperx(audio_path=f"{episode_filename}", model_name=model_name, batch_size=batch_size, compute_type=compute_type, device=device)
 
         print("Transcription step done...")
         print("Starting ingestion step...")
 
-        ingest.process_transcript(podcast_id=podcast_id, episode_id=episode_id)
+        # Diarized transcripts are ingested with their speakers, so the assistant can tell who said what
+        ingest.process_transcript(podcast_id=podcast_id, episode_id=episode_id, has_speaker_labels=bool(has_speaker_labels))
 
         print("Ingestion step done...")
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The services import each other from the Python folder, like when the server is run from it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,24 @@
+import json
+
+import pytest
+
+from atomic_file import open_atomic, write_json_atomic
+
+
+def test_write_json_atomic_replaces_the_file(tmp_path):
+    file_path = tmp_path / "data.json"
+    file_path.write_text("old")
+    write_json_atomic({"a": 1}, str(file_path))
+    assert json.loads(file_path.read_text()) == {"a": 1}
+    assert [p.name for p in tmp_path.iterdir()] == ["data.json"]
+
+
+def test_open_atomic_keeps_the_file_on_error(tmp_path):
+    file_path = tmp_path / "data.json"
+    file_path.write_text("old")
+    with pytest.raises(ValueError):
+        with open_atomic(str(file_path)) as file:
+            file.write("{")
+            raise ValueError()
+    assert file_path.read_text() == "old"
+    assert [p.name for p in tmp_path.iterdir()] == ["data.json"]
@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+pytest.importorskip("transformers")
+
+from text_to_speech_service.tortoise.models.autoregressive import UnifiedVoice
+
+
+def generate(model, conds, text, kv_cache, num_tokens, **kwargs):
+    model.inference_model.kv_cache = kv_cache
+    # min_length keeps the stop token out so both modes decode num_tokens tokens
+    trunc_index = text.shape[1] + 4
+    torch.manual_seed(0)
+    with torch.no_grad():
+        return model.inference_speech(conds, text, max_generate_length=num_tokens, min_length=trunc_index + num_tokens, **kwargs)
+
+
+@pytest.mark.parametrize("kwargs", [
+    dict(do_sample=False),
+    # Sampling with a fixed seed also covers the repeat_interleave path of num_return_sequences
+    dict(do_sample=True, top_p=.8, num_return_sequences=2),
+])
+def test_kv_cache_matches_uncached_decoding(kwargs):
+    torch.manual_seed(0)
+    model = UnifiedVoice(layers=2, model_dim=64, heads=2, max_text_tokens=40, max_mel_tokens=60, checkpointing=False)
+    model.post_init_gpt2_config()
+    model.eval()
+    conds = torch.randn(1, model.model_dim)
+    text = torch.randint(high=model.number_text_tokens, size=(1, 20))
+
+    cached = generate(model, conds, text, True, 30, **kwargs)
+    uncached = generate(model, conds, text, False, 30, **kwargs)
+    assert cached.shape == uncached.shape
+    assert torch.equal(cached, uncached)
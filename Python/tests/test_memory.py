@@ -0,0 +1,38 @@
+import pytest
+import torch
+
+from rvc_service.infer.lib.memory import MemoryPolicy
+
+requires_cuda = pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a CUDA device")
+
+
+def test_policy_is_disabled_off_cuda():
+    policy = MemoryPolicy("cpu", pressure=0)
+    policy.start_job()
+    policy.after_segment()
+    assert policy.num_empties == 0
+    assert policy.end_job() == {}
+
+
+@requires_cuda
+def test_policy_keeps_the_cache_warm_under_the_pressure():
+    policy = MemoryPolicy("cuda:0", pressure=1.1, empty_at_job_end=False)
+    policy.start_job()
+    x = torch.randn(1024, 1024, device="cuda:0")
+    del x
+    policy.after_segment()
+    stats = policy.end_job()
+    assert stats["gpu_cache_empties"] == 0
+    assert stats["gpu_reserved_mb"] > 0
+
+
+@requires_cuda
+def test_policy_empties_the_cache_over_the_pressure():
+    policy = MemoryPolicy("cuda:0", pressure=0, empty_at_job_end=False)
+    policy.start_job()
+    x = torch.randn(1024, 1024, device="cuda:0")
+    del x
+    policy.after_segment()
+    stats = policy.end_job()
+    assert stats["gpu_cache_empties"] >= 1
+    assert stats["gpu_peak_allocated_mb"] >= 4
@@ -0,0 +1,44 @@
+import librosa
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from rvc_service.infer.lib.rms import BLOCK_SIZE, change_rms, frame_rms
+
+
+def change_rms_reference(data1, sr1, data2, sr2, rate):
+    """
+    change_rms as originally written in pipeline.py, interpolating both envelopes to the full length of data2.
+    """
+    rms1 = librosa.feature.rms(y=data1, frame_length=sr1 // 2 * 2, hop_length=sr1 // 2)
+    rms2 = librosa.feature.rms(y=data2, frame_length=sr2 // 2 * 2, hop_length=sr2 // 2)
+    rms1 = torch.from_numpy(rms1)
+    rms1 = F.interpolate(rms1.unsqueeze(0), size=data2.shape[0], mode="linear").squeeze()
+    rms2 = torch.from_numpy(rms2)
+    rms2 = F.interpolate(rms2.unsqueeze(0), size=data2.shape[0], mode="linear").squeeze()
+    rms2 = torch.max(rms2, torch.zeros_like(rms2) + 1e-6)
+    data2 *= (torch.pow(rms1, torch.tensor(1 - rate)) * torch.pow(rms2, torch.tensor(rate - 1))).numpy()
+    return data2
+
+
+def test_frame_rms_matches_librosa():
+    rng = np.random.default_rng(0)
+    hop_length = 8000
+    # A partial last hop, and more hops than fit in a block
+    y = (rng.standard_normal(BLOCK_SIZE * 3 + 1234) * 0.1).astype(np.float32)
+    expected = librosa.feature.rms(y=y, frame_length=2 * hop_length, hop_length=hop_length)[0]
+    np.testing.assert_allclose(frame_rms(y, hop_length), expected, rtol=1e-5)
+
+
+def test_change_rms_matches_reference():
+    rng = np.random.default_rng(0)
+    sr1, sr2, rate = 16000, 40000, 0.25
+    seconds = 30
+    envelope = np.abs(np.sin(np.arange(seconds * sr1) * 2 * np.pi * 0.3 / sr1))
+    data1 = (rng.standard_normal(seconds * sr1) * 0.1 * envelope).astype(np.float32)
+    data2 = (rng.standard_normal(seconds * sr2) * 0.2).astype(np.float32)
+
+    expected = change_rms_reference(data1, sr1, data2.copy(), sr2, rate)
+    actual = change_rms(data1, sr1, data2.copy(), sr2, rate)
+    relative = np.abs(actual - expected) / np.maximum(np.abs(expected), 1e-6)
+    assert relative.max() < 1e-3
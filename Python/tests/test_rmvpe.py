@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import torch
+
+from rvc_service.infer.lib.rmvpe import E2E, RMVPE
+
+
+def to_local_average_cents_loop(cents_mapping, salience, thred=0.05):
+    """
+    RMVPE.to_local_average_cents as originally written, looping over the frames.
+    """
+    center = np.argmax(salience, axis=1)
+    salience = np.pad(salience, ((0, 0), (4, 4)))
+    center += 4
+    todo_salience = []
+    todo_cents_mapping = []
+    starts = center - 4
+    ends = center + 5
+    for idx in range(salience.shape[0]):
+        todo_salience.append(salience[:, starts[idx] : ends[idx]][idx])
+        todo_cents_mapping.append(cents_mapping[starts[idx] : ends[idx]])
+    todo_salience = np.array(todo_salience)
+    todo_cents_mapping = np.array(todo_cents_mapping)
+    product_sum = np.sum(todo_salience * todo_cents_mapping, 1)
+    weight_sum = np.sum(todo_salience, 1)
+    devided = product_sum / weight_sum
+    maxx = np.max(salience, axis=1)
+    devided[maxx <= thred] = 0
+    return devided
+
+
+@pytest.fixture(scope="module")
+def rmvpe(tmp_path_factory):
+    # The decoders do not depend on the weights, a randomly initialized model is enough
+    model_path = tmp_path_factory.mktemp("rmvpe") / "rmvpe.pt"
+    torch.save(E2E(4, 1, (2, 2)).state_dict(), model_path)
+    return RMVPE(str(model_path), is_half=False, device="cpu")
+
+
+@pytest.fixture(scope="module")
+def salience():
+    rng = np.random.default_rng(0)
+    n_frames = 20000
+    # A peak around a random bin per frame, including bins at the edges
+    bins = rng.integers(0, 360, n_frames)
+    salience = np.exp(-0.5 * ((np.arange(360)[None] - bins[:, None]) / 2.0) ** 2)
+    salience *= rng.random((n_frames, 1))
+    return salience.astype("float32")
+
+
+def test_to_local_average_cents_matches_loop(rmvpe, salience):
+    expected = to_local_average_cents_loop(rmvpe.cents_mapping, salience, thred=0.03)
+    assert np.array_equal(rmvpe.to_local_average_cents(salience, thred=0.03), expected)
+
+
+def test_to_local_average_cents_torch_matches_loop(rmvpe, salience):
+    expected = to_local_average_cents_loop(rmvpe.cents_mapping, salience, thred=0.03)
+    actual = rmvpe.to_local_average_cents_torch(torch.from_numpy(salience), thred=0.03).numpy()
+    # float32 on the device instead of float64, within a hundredth of a cent
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-2)
+    assert np.array_equal(actual == 0, expected == 0)
+
+
+def test_infer_from_audio_decodes_like_numpy(rmvpe):
+    audio = np.random.default_rng(0).standard_normal(16000 * 3).astype(np.float32) * 0.1
+    mel = rmvpe.mel_extractor(torch.from_numpy(audio).float().unsqueeze(0), center=True)
+    hidden = rmvpe.mel2hidden(mel).squeeze(0).float()
+    expected = rmvpe.decode(hidden.numpy(), thred=0.03)
+    np.testing.assert_allclose(rmvpe.infer_from_audio(audio, thred=0.03), expected, rtol=1e-5, atol=1e-2)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from scipy import signal
+
+from rvc_service.infer.lib.silence import find_cut_points
+
+
+def find_cut_points_loop(audio_pad, length, window, t_center, t_query):
+    """
+    find_cut_points as originally written in Pipeline.pipeline, summing `window` shifted copies of the whole input.
+    """
+    audio_sum = np.zeros(length, dtype=audio_pad.dtype)
+    for i in range(window):
+        audio_sum += np.abs(audio_pad[i : i - window])
+    opt_ts = []
+    for t in range(t_center, length, t_center):
+        opt_ts.append(
+            t
+            - t_query
+            + np.where(
+                audio_sum[t - t_query : t + t_query]
+                == audio_sum[t - t_query : t + t_query].min()
+            )[0][0]
+        )
+    return opt_ts
+
+
+@pytest.mark.parametrize("minutes", [1, 3])
+def test_find_cut_points_matches_loop(minutes):
+    # The settings Config picks for 6GB+ GPUs
+    sr, window, x_query, x_center = 16000, 160, 6, 38
+    bh, ah = signal.butter(N=5, Wn=48, btype="high", fs=16000)
+    rng = np.random.default_rng(minutes)
+    length = minutes * 60 * sr
+    # Noise with a syllable-rate envelope and regular pauses, high-passed like Pipeline.pipeline does
+    envelope = np.abs(np.sin(np.arange(length) * 2 * np.pi * 3 / sr)) * (rng.random(length // sr + 1) > 0.2).repeat(sr)[:length]
+    audio = signal.filtfilt(bh, ah, (rng.standard_normal(length) * 0.1 * envelope).astype(np.float32))
+    audio_pad = np.pad(audio, (window // 2, window // 2), mode="reflect")
+
+    expected = find_cut_points_loop(audio_pad, length, window, sr * x_center, sr * x_query)
+    assert find_cut_points(audio_pad, length, window, sr * x_center, sr * x_query) == expected
+
+
+def test_find_cut_points_picks_the_first_silent_spot():
+    sr, window = 16000, 160
+    length = 10 * sr
+    audio = np.ones(length, dtype=np.float32)
+    # Two equally silent spots around the 5s mark, the first one wins
+    audio[int(4.5 * sr) : int(4.6 * sr)] = 0
+    audio[int(5.2 * sr) : int(5.3 * sr)] = 0
+    audio_pad = np.pad(audio, (window // 2, window // 2), mode="reflect")
+
+    expected = find_cut_points_loop(audio_pad, length, window, 5 * sr, sr)
+    assert find_cut_points(audio_pad, length, window, 5 * sr, sr) == expected
+    # The first position whose window, centered on it, is all silent
+    assert expected[0] == int(4.5 * sr) + window // 2
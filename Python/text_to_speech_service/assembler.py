@@ -0,0 +1,166 @@
+import json
+import os
+import struct
+
+import torch
+
+from atomic_file import write_json_atomic
+
+# Size of the header written by get_wav_header
+WAV_HEADER_SIZE = 44
+
+def get_wav_header(sample_rate, num_samples=None, channels=1, bits_per_sample=16):
+    """
+    Returns the header of a PCM WAV file.
+
+    Args:
+        sample_rate (int): The sample rate of the audio.
+        num_samples (int, optional): The number of samples per channel. None for a stream whose length is not known in advance,
+            the RIFF and data sizes are then set to the maximum value, which players treat as 'read until the end of the stream'. Defaults to None.
+        channels (int, optional): The number of channels. Defaults to 1.
+        bits_per_sample (int, optional): The number of bits per sample. Defaults to 16.
+
+    Returns:
+        bytes: The 44 byte WAV header.
+    """
+    byte_rate = sample_rate * channels * bits_per_sample // 8
+    block_align = channels * bits_per_sample // 8
+    if num_samples is None:
+        riff_size = data_size = 0xFFFFFFFF
+    else:
+        data_size = num_samples * block_align
+        riff_size = data_size + WAV_HEADER_SIZE - 8
+    return (b'RIFF' + struct.pack('<I', riff_size) + b'WAVE'
+            + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, sample_rate, byte_rate, block_align, bits_per_sample)
+            + b'data' + struct.pack('<I', data_size))
+
+class EpisodeAssembler:
+    """
+    Writes the generated chunks of an episode, in order, straight into a mono 16-bit WAV file.
+
+    The audio is written to '<result file>.part' as it arrives and renamed to the result file by finish(), so the result
+    file only ever exists complete. Consecutive chunks can be crossfaded, the end of the previous chunk is then rewritten
+    in place once the next chunk arrives.
+
+    With a checkpoint key, the header and a '<result file>.checkpoint.json' file are updated after every chunk.
+    If generation crashes, the next assembler created with the same key resumes after the last finished chunk.
+    """
+    def __init__(self, result_file_path, sample_rate, crossfade_ms=0, checkpoint_key=None):
+        """
+        Args:
+            result_file_path (str): The file path to save the episode audio to.
+            sample_rate (int): The sample rate of the chunks.
+            crossfade_ms (int, optional): The length of the crossfade between consecutive chunks, in milliseconds. Defaults to 0.
+            checkpoint_key (str, optional): Identifies the episode's texts and voice, enables checkpointing when set. Defaults to None.
+        """
+        self.result_file_path = result_file_path
+        self.part_file_path = f'{result_file_path}.part'
+        self.checkpoint_file_path = f'{result_file_path}.checkpoint.json'
+        self.sample_rate = sample_rate
+        self.crossfade_samples = int(sample_rate * crossfade_ms / 1000)
+        self.checkpoint_key = checkpoint_key
+
+        # Number of chunks and samples written so far
+        self.num_chunks = 0
+        self.num_samples = 0
+
+        # The end of the last chunk, blended with the start of the next one when crossfading
+        self.tail = None
+
+        if checkpoint_key is not None and self.resume():
+            return
+
+        self.file = open(self.part_file_path, 'w+b')
+        self.file.write(get_wav_header(sample_rate, 0))
+
+    def resume(self):
+        """
+        Reopens the partial file of a previous run with the same checkpoint key.
+
+        Returns:
+            bool: True if a checkpoint was found and the assembler continues after its last chunk.
+        """
+        if not os.path.isfile(self.checkpoint_file_path) or not os.path.isfile(self.part_file_path):
+            return False
+
+        with open(self.checkpoint_file_path, 'r') as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('key') != self.checkpoint_key or checkpoint.get('sample_rate') != self.sample_rate:
+            print(f"Checkpoint out of date: {self.checkpoint_file_path}")
+            return False
+
+        self.num_chunks = checkpoint['num_chunks']
+        self.num_samples = checkpoint['num_samples']
+
+        # Drop anything written after the checkpoint, it belongs to a chunk that did not finish
+        self.file = open(self.part_file_path, 'r+b')
+        self.file.truncate(WAV_HEADER_SIZE + self.num_samples * 2)
+
+        if self.crossfade_samples > 0 and self.num_samples > 0:
+            n = min(self.crossfade_samples, self.num_samples)
+            self.file.seek(-n * 2, os.SEEK_END)
+            self.tail = torch.frombuffer(bytearray(self.file.read(n * 2)), dtype=torch.int16).float() / 32767
+
+        self.file.seek(0, os.SEEK_END)
+        print(f"Resuming {self.result_file_path} after {self.num_chunks} chunks")
+        return True
+
+    def add(self, audio):
+        """
+        Appends a chunk to the episode.
+
+        Args:
+            audio (torch.Tensor): The chunk, any shape holding mono samples in [-1, 1].
+        """
+        audio = audio.detach().reshape(-1).float().cpu()
+
+        # Blend the start of the chunk with the end of the previous one, overwriting it in the file
+        n = min(self.crossfade_samples, 0 if self.tail is None else self.tail.shape[0], audio.shape[0])
+        if n > 0:
+            fade = torch.linspace(0.0, 1.0, n)
+            head = audio[:n] * fade + self.tail[-n:] * (1 - fade)
+            audio = torch.cat([head, audio[n:]])
+            self.file.seek(-n * 2, os.SEEK_END)
+            self.num_samples -= n
+
+        self.file.write((audio.clamp(-1, 1) * 32767).to(torch.int16).numpy().tobytes())
+        self.num_samples += audio.shape[0]
+        self.num_chunks += 1
+        self.tail = audio[-self.crossfade_samples:] if self.crossfade_samples > 0 else None
+
+        if self.checkpoint_key is not None:
+            self.save_checkpoint()
+
+    def write_header(self):
+        self.file.seek(0)
+        self.file.write(get_wav_header(self.sample_rate, self.num_samples))
+        self.file.seek(0, os.SEEK_END)
+
+    def save_checkpoint(self):
+        """
+        Makes the chunks written so far durable and records how far the episode got.
+        """
+        self.write_header()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        write_json_atomic({'key': self.checkpoint_key, 'sample_rate': self.sample_rate, 'num_chunks': self.num_chunks, 'num_samples': self.num_samples},
+                          self.checkpoint_file_path)
+
+    def finish(self):
+        """
+        Completes the WAV file and moves it to the result file path.
+        """
+        self.write_header()
+        self.file.close()
+        os.replace(self.part_file_path, self.result_file_path)
+        if os.path.isfile(self.checkpoint_file_path):
+            os.remove(self.checkpoint_file_path)
+
+    def abort(self):
+        """
+        Closes the file after a failure. The partial file is only kept when it can be resumed from a checkpoint.
+        """
+        self.file.close()
+        if self.checkpoint_key is None and os.path.isfile(self.part_file_path):
+            os.remove(self.part_file_path)
@@ -1,5 +1,6 @@
 import os
 import random
+import threading
 from time import time
 from urllib import request
 from progressbar import progressbar
@@ -17,12 +18,13 @@ from text_to_speech_service.tortoise.utils.audio import denormalize_tacotron_mel
 from text_to_speech_service.tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule
 from text_to_speech_service.tortoise.utils.tokenizer import VoiceBpeTokenizer
 from text_to_speech_service.tortoise.utils.wav2vec_alignment import Wav2VecAlignment
-# from tortoise.models.stream_generator import init_stream_support
+from text_to_speech_service.tortoise.models.stream_generator import init_stream_support
 
 from text_to_speech_service.tortoise.utils.device import get_device_name, do_gc
 
 pbar = None
-# init_stream_support()
+# Adds generate_stream to the GPT-2 inference model, used by tts_stream
+init_stream_support()
 STOP_SIGNAL = False
 DEFAULT_MODELS_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tortoise', 'models')
 MODELS_DIR = os.environ.get('TORTOISE_MODELS_DIR', DEFAULT_MODELS_DIR)
@@ -273,7 +275,7 @@ class TextToSpeech:
     """
 
     def __init__(self, autoregressive_batch_size=None, models_dir=MODELS_DIR, 
-                 enable_redaction=True, kv_cache=False, use_deepspeed=False, half=False, device=None,
+                 enable_redaction=True, kv_cache=True, use_deepspeed=False, half=False, device=None,
                  tokenizer_vocab_file=None, tokenizer_basic=False,
                  autoregressive_model_path=None, tokenizer_json=None,
                  minor_optimizations=True,
@@ -288,7 +290,10 @@ class TextToSpeech:
                            models, otherwise use the defaults.
         :param enable_redaction: When true, text enclosed in brackets are automatically redacted from the spoken output
                                  (but are still rendered by the model). This can be used for prompt engineering.
+                                 The wav2vec2 aligner this needs is only loaded when it is first used.
                                  Default is true.
+        :param kv_cache: When true, the autoregressive model reuses the attention keys and values of previous tokens instead of
+                         re-running the whole sequence for every new mel token. Default is true.
         :param device: Device to use when running the model. If omitted, the device will be automatically chosen.
         """
         self.use_deepspeed = use_deepspeed # Store deepspeed
@@ -303,8 +308,9 @@ class TextToSpeech:
         self.device = torch.device('cuda' if torch.cuda.is_available() else'cpu')
         if torch.backends.mps.is_available():
             self.device = torch.device('mps')
-        if self.enable_redaction:
-            self.aligner = Wav2VecAlignment()
+        # The aligner used for redaction is loaded on first use, see the aligner property
+        self._aligner = None
+        self.aligner_lock = threading.Lock()
 
         self.load_tokenizer_json(tokenizer_json)
 
@@ -497,6 +503,21 @@ class TextToSpeech:
         else:
             return auto_latent
 
+    @property
+    def aligner(self):
+        """
+        The wav2vec2 aligner used for redaction, loaded on first use. It stays resident afterwards.
+        None when redaction is disabled.
+        """
+        if not self.enable_redaction:
+            return None
+        if self._aligner is None:
+            with self.aligner_lock:
+                if self._aligner is None:
+                    print("Loading wav2vec2 aligner for redaction..")
+                    self._aligner = Wav2VecAlignment()
+        return self._aligner
+
     def get_random_conditioning_latents(self):
         # Lazy-load the RLG models.
         if self.rlg_auto is None:
@@ -578,7 +599,7 @@ class TextToSpeech:
             auto_conditioning = self.get_conditioning_latents(voice_samples, return_mels=False)
         elif conditioning_latents is not None:
             latent_tuple = conditioning_latents
-            if len(latent_tuple) == 2:
+            if torch.is_tensor(latent_tuple) or len(latent_tuple) == 2:
                 auto_conditioning = conditioning_latents
             else:
                 auto_conditioning, auto_conds, _ = conditioning_latents
@@ -731,6 +752,100 @@ class TextToSpeech:
                 print("generating audio..")
             wav_gen = self.hifi_decoder.inference(gpt_latents.to(self.device), auto_conditioning)
             return wav_gen
+
+    def tts_batch(self, texts, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
+            batch_size=None,
+            # autoregressive generation parameters follow
+            num_autoregressive_samples=512, temperature=.8, length_penalty=6, repetition_penalty=8.0,
+            top_p=.8, max_mel_tokens=500,
+            # CVVP parameters follow
+            cvvp_amount=.0,
+            **hf_generate_kwargs):
+        """
+        Produces one audio clip per text, running the texts through the autoregressive model and the vocoder in batches.
+        Takes the same arguments as tts(), plus:
+        :param texts: List of texts to be spoken, each short enough for tts() (e.g. the output of split_and_recombine_text).
+        :param batch_size: Number of texts generated together. Defaults to autoregressive_batch_size, which is picked from
+                           the free GPU memory by pick_best_batch_size_for_gpu().
+        The text tokens of a batch are padded with stop tokens to the longest text. Each clip is cut at the first stop token
+        generated for it, so texts that finish early do not carry the padding of the longer ones.
+        :return: List of generated audio clips, one torch tensor of shape (1,1,S) per text, in the order of texts.
+                 Sample rate is 24kHz.
+        """
+        deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+        batch_size = max(1, batch_size or self.autoregressive_batch_size)
+
+        if voice_samples is not None:
+            auto_conditioning = self.get_conditioning_latents(voice_samples, return_mels=False)
+        elif conditioning_latents is not None:
+            auto_conditioning = conditioning_latents
+        else:
+            auto_conditioning  = self.get_random_conditioning_latents()
+
+        auto_conditioning = migrate_to_device(auto_conditioning, self.device)
+
+        stop_mel_token = self.autoregressive.stop_mel_token
+        wavs = []
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            if verbose:
+                print(f"Generating autoregressive samples for texts {start + 1}-{start + len(batch)}/{len(texts)}..")
+
+            # Pad the text tokens with stop tokens (0), like the single padding token added by tts()
+            tokens = [torch.IntTensor(self.tokenizer.encode(text)) for text in batch]
+            text_tokens = torch.nn.utils.rnn.pad_sequence(tokens, batch_first=True, padding_value=0).to(self.device)
+            text_tokens = F.pad(text_tokens, (0, 1))
+            assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
+
+            conditioning = auto_conditioning.repeat(len(batch), 1)
+
+            with torch.no_grad():
+                with torch.autocast(
+                        device_type="cuda" , dtype=torch.float16, enabled=self.half
+                    ):
+                    codes = self.autoregressive.inference_speech(conditioning, text_tokens,
+                                                                top_k=50,
+                                                                top_p=top_p,
+                                                                temperature=temperature,
+                                                                do_sample=True,
+                                                                num_beams=1,
+                                                                num_return_sequences=1,
+                                                                length_penalty=float(length_penalty),
+                                                                repetition_penalty=float(repetition_penalty),
+                                                                output_attentions=False,
+                                                                output_hidden_states=True,
+                                                                **hf_generate_kwargs)
+
+                    # Cut each sample after its own stop token, the rest of the row is padding from the longer samples
+                    code_lengths = []
+                    for row in codes:
+                        stop_token_indices = (row == stop_mel_token).nonzero()
+                        code_lengths.append(stop_token_indices[0].item() + 1 if len(stop_token_indices) > 0 else row.shape[0])
+                    code_lengths = torch.tensor(code_lengths, device=codes.device)
+
+                    gpt_latents = self.autoregressive(conditioning, text_tokens,
+                                    torch.tensor([text_tokens.shape[-1]] * len(batch), device=text_tokens.device), codes,
+                                    code_lengths * self.autoregressive.mel_length_compression,
+                                    return_latent=True, clip_inputs=False)
+
+                if verbose:
+                    print("generating audio..")
+
+                # Pad every latent to the longest one by repeating its last frame, then cut the audio back to the latent's length
+                max_length = int(code_lengths.max().item())
+                latents = []
+                for latent, length in zip(gpt_latents, code_lengths.tolist()):
+                    latent = latent[:length]
+                    latents.append(torch.cat([latent, latent[-1:].expand(max_length - length, -1)], dim=0))
+                wav_gen = self.hifi_decoder.inference(torch.stack(latents).to(self.device), auto_conditioning)
+
+                for i, length in enumerate(code_lengths.tolist()):
+                    # Same resampling as HifiganGenerator.inference, followed by its 256x upsampling
+                    num_samples = int(int(length * 1024 / 256) * 24000 / 22050) * 256
+                    wavs.append(wav_gen[i:i + 1, :, :num_samples])
+
+        return wavs
+
     def deterministic_state(self, seed=None):
         """
         Sets the random seeds that tortoise uses to the current time() and returns that seed so results can be
@@ -143,9 +143,11 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
                 mel_emb = self.cached_mel_emb
             emb = torch.cat([mel_emb, text_emb], dim=1)
         else:
+            # With the KV cache only the newest mel token is passed. The mel tokens start at index mel_len with the
+            # start token at position 0, so the newest one (index attention_mask.shape[1] - 1) is at this position.
             emb = self.embeddings(input_ids)
             emb = emb + self.text_pos_embedding.get_fixed_embedding(
-                attention_mask.shape[1] - mel_len, attention_mask.device
+                attention_mask.shape[1] - mel_len - 1, attention_mask.device
             )
         transformer_outputs = self.transformer(
             inputs_embeds=emb,
@@ -355,7 +357,7 @@ class UnifiedVoice(nn.Module):
             embeddings.append(self.mel_embedding)
         for module in embeddings:
             module.weight.data.normal_(mean=0.0, std=.02)
-    def post_init_gpt2_config(self, use_deepspeed=False, kv_cache=False, half=False):
+    def post_init_gpt2_config(self, use_deepspeed=False, kv_cache=True, half=False):
         seq_length = self.max_mel_tokens + self.max_text_tokens + 2
         gpt_config = GPT2Config(
             vocab_size=self.max_mel_tokens,
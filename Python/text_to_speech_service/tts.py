@@ -1,11 +1,182 @@
+import hashlib
 import os
+import threading
 from TTS.api import TTS
 import torch
 import torchaudio
 
 from text_to_speech_service.tortoise.api_fast import TextToSpeech as Tortoise_TTS_Hifi
 from text_to_speech_service.tortoise.utils.text import split_and_recombine_text
-from text_to_speech_service.tortoise.utils.audio import load_audio, load_voice
+from text_to_speech_service.tortoise.utils.audio import load_audio, get_voice
+from text_to_speech_service.assembler import EpisodeAssembler, get_wav_header
+from atomic_file import open_atomic
+from model_registry import registry
+import job_queue as jq
+
+# Model paths
+AUTOREGRESSIVE_MODEL_PATH = "./ServerFiles/Speakers/autoregressive.pth"
+TOKENIZER_JSON_PATH = "./text_to_speech_service/tortoise/tokenizer.json"
+COQUI_MODEL_NAME = "tts_models/multilingual/multi-dataset/xtts_v2"
+
+# Folder holding one folder per speaker with its reference audio and cached conditioning latents
+SPEAKERS_DIR = "./ServerFiles/Speakers"
+
+# Sample rate of the audio produced by Tortoise TTS with HiFi-GAN vocoder
+STREAM_SAMPLE_RATE = 24000
+
+# Whether Tortoise TTS checkpoints finished chunks so that a crashed episode resumes where it stopped
+TTS_CHECKPOINT = os.getenv("TTS_CHECKPOINT", "0") == "1"
+
+# Crossfade between consecutive Tortoise TTS chunks, in milliseconds
+TTS_CROSSFADE_MS = int(os.getenv("TTS_CROSSFADE_MS", "0"))
+
+def get_tortoise_device():
+    """
+    Returns the device Tortoise TTS runs on, matching the device picked by TextToSpeech.
+    """
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def load_tortoise(autoregressive_model_path, device, dtype, use_deepspeed=False):
+    """
+    Loads Tortoise TTS with the HiFi-GAN vocoder. Used by the model registry.
+
+    Args:
+        autoregressive_model_path (str): The path to the autoregressive model.
+        device (str): The device to load the model on. TextToSpeech picks it itself, it is only part of the registry key.
+        dtype (str): 'float16' to run the autoregressive model in half precision, 'float32' otherwise.
+        use_deepspeed (bool, optional): Whether to use DeepSpeed for inference. Defaults to False.
+
+    Returns:
+        TextToSpeech: The loaded model.
+    """
+    return Tortoise_TTS_Hifi(autoregressive_model_path=autoregressive_model_path,
+                             tokenizer_json=TOKENIZER_JSON_PATH,
+                             use_deepspeed=use_deepspeed,
+                             half=dtype == "float16")
+
+def load_coqui(model_name, device, dtype):
+    """
+    Loads a Coqui TTS model. Used by the model registry.
+
+    Args:
+        model_name (str): The name of the Coqui model.
+        device (str): The device to load the model on.
+        dtype (str): Unused, Coqui models run in float32.
+
+    Returns:
+        TTS: The loaded model.
+    """
+    return TTS(model_name).to(device)
+
+# TextToSpeech keeps state between calls (e.g. cached_mel_emb, the lazily loaded aligner), so it is used by one job at a time
+registry.register("tortoise", load_tortoise, exclusive=True)
+registry.register("xtts", load_coqui)
+
+# Number of stream previews waiting for the Tortoise model. The model is exclusive, so episode jobs hand it over to them
+# between batches of text chunks instead of holding it for the whole episode
+stream_waiters = 0
+stream_waiters_condition = threading.Condition()
+
+def acquire_tortoise_for_stream():
+    """
+    Acquires the resident Tortoise model for a stream preview, ahead of the episode jobs using it.
+    Every call must be matched by a call to registry.release().
+    """
+    global stream_waiters
+    with stream_waiters_condition:
+        stream_waiters += 1
+    try:
+        return registry.acquire("tortoise", AUTOREGRESSIVE_MODEL_PATH, get_tortoise_device(), "float32")
+    finally:
+        with stream_waiters_condition:
+            stream_waiters -= 1
+            stream_waiters_condition.notify_all()
+
+def streams_waiting():
+    """
+    Returns whether stream previews are waiting for the Tortoise model.
+    """
+    with stream_waiters_condition:
+        return stream_waiters > 0
+
+def wait_for_streams():
+    """
+    Waits until the stream previews waiting for the Tortoise model have acquired it.
+    """
+    with stream_waiters_condition:
+        while stream_waiters > 0:
+            stream_waiters_condition.wait()
+
+def preload():
+    """
+    Loads the TTS model used on this device so that the first request does not pay for the load.
+    """
+    if torch.cuda.is_available():
+        registry.preload("tortoise", AUTOREGRESSIVE_MODEL_PATH, get_tortoise_device(), "float32")
+    else:
+        registry.preload("xtts", COQUI_MODEL_NAME, "cpu", "float32")
+
+# Conditioning latents already computed, keyed by (speaker, autoregressive model hash, reference files and their mtimes)
+conditioning_latents_cache = {}
+conditioning_latents_lock = threading.Lock()
+
+def get_conditioning_latents(tts, speaker, speakers_dir=SPEAKERS_DIR):
+    """
+    Returns the conditioning latents of a speaker for the loaded autoregressive model, computing them only once.
+
+    The latents are kept in memory and saved next to the speaker's reference audio as cond_latents_<model hash>.pth,
+    along with the modification times of the reference files. Adding, removing or changing a reference file invalidates them.
+
+    Args:
+        tts (TextToSpeech): The loaded Tortoise TTS model.
+        speaker (str): The name of the speaker.
+        speakers_dir (str, optional): The folder holding the speaker folders. Defaults to SPEAKERS_DIR.
+
+    Returns:
+        torch.Tensor: The autoregressive conditioning latents of the speaker.
+
+    Raises:
+        Exception: If the speaker has no reference audio.
+    """
+    reference_files = get_voice(speaker, dir=speakers_dir, load_latents=False)
+    if not reference_files:
+        raise Exception(f'No reference audio exists for the given speaker name.')
+
+    model_hash = tts.autoregressive_model_hash[:8]
+    sources = {os.path.basename(path): os.stat(path).st_mtime_ns for path in reference_files}
+    key = (speaker, model_hash, tuple(sorted(sources.items())))
+    latents_file_path = f'{speakers_dir}/{speaker}/cond_latents_{model_hash}.pth'
+
+    with conditioning_latents_lock:
+        latents = conditioning_latents_cache.get(key)
+        if latents is not None:
+            return latents
+
+        # Use the latents saved on disk if they were computed from the same reference files
+        if os.path.isfile(latents_file_path):
+            saved = torch.load(latents_file_path, map_location='cpu')
+            if isinstance(saved, dict) and saved.get('sources') == sources:
+                print(f"Reading conditioning latents from {latents_file_path}")
+                latents = saved['latents']
+            else:
+                print(f"Conditioning latents out of date: {latents_file_path}")
+
+        if latents is None:
+            print(f"Computing conditioning latents for {speaker} with model {model_hash}")
+            voice_samples = [load_audio(path, 22050) for path in reference_files]
+            latents = tts.get_conditioning_latents(voice_samples, return_mels=False).cpu()
+
+            with open_atomic(latents_file_path, 'wb') as latents_file:
+                torch.save({'sources': sources, 'latents': latents}, latents_file)
+
+        # Drop the latents of older reference files of the same speaker and model
+        for cached_key in [k for k in conditioning_latents_cache if k[:2] == key[:2]]:
+            del conditioning_latents_cache[cached_key]
+        conditioning_latents_cache[key] = latents
+
+        return latents
 
 def create_audio_coqui(text, language, speaker_file_path, result_file_path):
     """
@@ -28,48 +199,46 @@ def create_audio_coqui(text, language, speaker_file_path, result_file_path):
         # Define the status file path
         status_file_path = f'{file_name}_tts_status.txt'
 
-        # Create a status file to indicate that the text to speech is in progress
-        with open(status_file_path, 'w') as f:
-            f.write('In progress')
-            f.close()
+        # Mark the text to speech step as in progress (also writes the status file)
+        jq.start_step('tts', status_file_path)
 
         # Check if GPU is available
         device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"Using {device} device")
 
-        # Init TTS
-        tts = TTS("tts_models/multilingual/multi-dataset/xtts_v2").to(device)
-
-        # Generate audio from text and save it to a file
-        tts.tts_to_file(text=text, language=language, speaker_wav=speaker_file_path, file_path=result_file_path)
+        # Get the resident TTS model and generate audio from text and save it to a file
+        with registry.use("xtts", COQUI_MODEL_NAME, device, "float32") as tts:
+            tts.tts_to_file(text=text, language=language, speaker_wav=speaker_file_path, file_path=result_file_path)
 
-        # Once the audio is generated, delete the status file
-        os.remove(status_file_path)
+        # Once the audio is generated, mark the step as done (also deletes the status file)
+        jq.finish_step(status_file_path)
 
     except Exception as e:
-        # If an error occurs, update the status file with the error message
-        with open(status_file_path, 'w') as f:
-            f.write('Error\n')
-            f.write(str(e))
-            f.close()
+        # If an error occurs, mark the step as failed (also updates the status file with the error message)
+        jq.fail_step(e, status_file_path)
 
         # If an error occurs, print the error message to the console and raise it again
         print(f"Error in tts.create_audio: {e} \n Text: {text} \n Language: {language} \n Speaker file path: {speaker_file_path} \n Result file path: {result_file_path} \n device: {device} \n")
         raise e
 
-def create_audio_tortoise(text,speaker,result_file_path,delimiter=''):
+def create_audio_tortoise(text,speaker,result_file_path,delimiter='',crossfade_ms=TTS_CROSSFADE_MS,checkpoint=TTS_CHECKPOINT):
     """
     Converts text to audio using Tortoise TTS with HiFi-GAN vocoder.
+    The chunks are written straight into the result file as they are generated.
 
     Args:
         text (str): The text to convert to audio.
         speaker (str): The name of the speaker to use.
         result_file_path (str): The file path to save the generated audio file.
         delimiter (str, optional): The delimiter to use for splitting the text into sections. Defaults to ''.
+        crossfade_ms (int, optional): The crossfade between consecutive chunks, in milliseconds. Defaults to TTS_CROSSFADE_MS.
+        checkpoint (bool, optional): Whether to checkpoint finished chunks so that a crashed run resumes after them. Defaults to TTS_CHECKPOINT.
 
     Raises:
         Exception: If an error occurs during the audio generation process.
     """
+    tts = None
+    assembler = None
     try:
         print("-------------------- Starting Tortoise TTS --------------------")
         print(result_file_path)
@@ -80,22 +249,15 @@ def create_audio_tortoise(text,speaker,result_file_path,delimiter=''):
         # Define the status file path
         status_file_path = f'{file_name}_tts_status.txt'
 
-        # Create a status file to indicate that the text to speech is in progress
-        with open(status_file_path, 'w') as f:
-            f.write('In progress')
-            f.close()
+        # Mark the text to speech step as in progress (also writes the status file)
+        jq.start_step('tts', status_file_path)
 
         print("Tortoise TTS started...")
 
         output_volume = 1
-        autoregressive_model_path = "./ServerFiles/Speakers/autoregressive.pth"
-        tokenizer_json_path = "./text_to_speech_service/tortoise/tokenizer.json"
-        use_deepspeed = False
-        
-        # Load the TTS model (Tortoise TTS with HiFi-GAN vocoder)
-        tts = Tortoise_TTS_Hifi(autoregressive_model_path=autoregressive_model_path,
-                                tokenizer_json=tokenizer_json_path,
-                                use_deepspeed=use_deepspeed)
+
+        # Get the resident TTS model (Tortoise TTS with HiFi-GAN vocoder), it is only loaded on first use
+        tts = registry.acquire("tortoise", AUTOREGRESSIVE_MODEL_PATH, get_tortoise_device(), "float32")
     
         print("Loaded TTS, ready for generation.")
 
@@ -134,62 +296,117 @@ def create_audio_tortoise(text,speaker,result_file_path,delimiter=''):
             'tokenizer_json': './text_to_speech_service/tortoise/tokenizer.json',
         }
 
-        # Gotta load voice samples and conditioning latents
+        # Get the conditioning latents once, they are reused for every text chunk instead of recomputing them from the voice samples
         print(f"Loading voice: {speaker} with model {tts.autoregressive_model_hash[:8]}")
-        voice_samples, conditioning_latents = load_voice(voice=speaker,extra_voice_dirs=["./ServerFiles/Speakers"], model_hash=tts.autoregressive_model_hash)
+        settings['conditioning_latents'] = get_conditioning_latents(tts, speaker)
+
+        # The chunks go straight into the result file, a checkpoint is only valid for the same speaker, model and texts
+        checkpoint_key = None
+        if checkpoint:
+            checkpoint_key = hashlib.sha1('\n'.join([speaker, tts.autoregressive_model_hash] + texts).encode('utf-8')).hexdigest()
+        assembler = EpisodeAssembler(result_file_path, tts.output_sample_rate, crossfade_ms=crossfade_ms, checkpoint_key=checkpoint_key)
+
+        # Generate audio, several texts at a time (the batch size is picked from the free GPU memory)
+        batch_size = tts.autoregressive_batch_size
+        for start in range(assembler.num_chunks, len(texts), batch_size):
+            # Hand the model over to the stream previews waiting for it, they then run between two batches of the episode
+            if streams_waiting():
+                registry.release(tts)
+                tts = None
+                wait_for_streams()
+                tts = registry.acquire("tortoise", AUTOREGRESSIVE_MODEL_PATH, get_tortoise_device(), "float32")
+
+            print(f"Generating audio for texts {start+1}-{min(start+batch_size, len(texts))}/{len(texts)}")
+            jq.report_progress(100 * start / len(texts))
+            gen = tts.tts_batch(texts[start:start+batch_size], batch_size=batch_size, **settings)
+
+            for g in gen:
+                audio = g.squeeze(0)
+                if volume_adjust is not None:
+                    audio = volume_adjust(audio)
+                assembler.add(audio)
+
+        assembler.finish()
+        assembler = None
+
+        # Hand the TTS model back to the registry, it stays resident for the next request
+        registry.release(tts)
+        tts = None
+
+        # Once the audio is generated, mark the step as done (also deletes the status file)
+        jq.finish_step(status_file_path)
+        print("-------------------- Tortoise TTS Complete --------------------")
 
-        settings['voice_samples'] = voice_samples
-        settings['conditioning_latents'] = conditioning_latents
+    except Exception as e:
+        # If an error occurs, close the episode file (it is kept if it can be resumed) and hand the TTS model back to the registry
+        if assembler is not None:
+            assembler.abort()
+        if tts is not None:
+            registry.release(tts)
+
+        # If an error occurs, mark the step as failed (also updates the status file with the error message)
+        jq.fail_step(e, status_file_path)
+        
+        # If an error occurs, print the error message to the console and raise it again
+        print(f"Error in tts.create_audio: {e} \n Text: {text} \n Speaker: {speaker} \n Result file path: {result_file_path} \n")
+        raise e
 
-        # Generate audio
+def stream_audio_tortoise(text, speaker, delimiter='', stream_chunk_size=40, should_stop=None):
+    """
+    Converts text to audio using Tortoise TTS with HiFi-GAN vocoder, yielding the audio as soon as it is decoded.
+    The first chunk is yielded once stream_chunk_size tokens (at least 60 for the first chunk) have been generated.
 
-        for i, cut_text in enumerate(texts):
-            print(f"Generating audio for text {i+1}/{len(texts)}: {cut_text}")
-            gen = tts.tts(cut_text, **settings)    
+    Args:
+        text (str): The text to convert to audio.
+        speaker (str): The name of the speaker to use.
+        delimiter (str, optional): The delimiter to use for splitting the text into sections. Defaults to ''.
+        stream_chunk_size (int, optional): The number of tokens decoded per chunk. Defaults to 40.
+        should_stop (callable, optional): Called between chunks, generation stops when it returns True (e.g. the client went away). Defaults to None.
 
-            if not isinstance(gen, list):
-                gen = [gen]
-            
-            for j, g in enumerate(gen):
-                audio = g.squeeze(0).cpu()
-                name = str(file_name)+'_'+str(i)
+    Yields:
+        bytes: Mono 16-bit PCM audio at STREAM_SAMPLE_RATE.
 
-                torchaudio.save(f'{name}.wav',audio,tts.output_sample_rate)
+    Raises:
+        Exception: If an error occurs during the audio generation process.
+    """
+    tts = None
+    try:
+        print("-------------------- Starting Tortoise TTS Stream --------------------")
 
-        # Combine audio
-        print("Combining audio...")
-        combined = None
-        for i, cut_text in enumerate(texts):
-            name = str(file_name)+'_'+str(i)
-            audio = load_audio(f'{name}.wav',tts.output_sample_rate)
-            if volume_adjust is not None:
-                audio = volume_adjust(audio)
-            if combined is None:
-                combined = audio
-            else:
-                combined = torch.cat([combined, audio], dim=1)
+        # Get the resident TTS model (Tortoise TTS with HiFi-GAN vocoder), it is only loaded on first use.
+        # Episode jobs holding it hand it over between batches of text chunks
+        tts = acquire_tortoise_for_stream()
 
-        torchaudio.save(result_file_path,combined,tts.output_sample_rate)
+        # Split the text into sections of 200-300 characters
+        if delimiter == '':
+            texts = split_and_recombine_text(text)
+        else:
+            texts = text.split(delimiter)
+
+        conditioning_latents = get_conditioning_latents(tts, speaker)
 
-        # Cleanup
-        print("Cleaning up...")
         for i, cut_text in enumerate(texts):
-            name = str(file_name)+'_'+str(i)
-            os.remove(f'{name}.wav')
+            print(f"Streaming audio for text {i+1}/{len(texts)}: {cut_text}")
+            jq.report_progress(100 * i / len(texts))
 
-        # Once the audio is generated, delete the status file
-        os.remove(status_file_path)
-        print("-------------------- Tortoise TTS Complete --------------------")
+            for chunk in tts.tts_stream(cut_text, conditioning_latents=conditioning_latents,
+                                        stream_chunk_size=stream_chunk_size, verbose=False):
+                if should_stop is not None and should_stop():
+                    print("Tortoise TTS stream stopped")
+                    return
+                yield (chunk.clamp(-1, 1) * 32767).to(torch.int16).cpu().numpy().tobytes()
+
+        print("-------------------- Tortoise TTS Stream Complete --------------------")
 
     except Exception as e:
-        # If an error occurs, update the status file with the error message
-        with open(status_file_path, 'w') as f:
-            f.write(str(e))
-            f.close()
-        
         # If an error occurs, print the error message to the console and raise it again
-        print(f"Error in tts.create_audio: {e} \n Text: {text} \n Speaker: {speaker} \n Result file path: {result_file_path} \n")
-        raise e    
+        print(f"Error in tts.stream_audio_tortoise: {e} \n Text: {text} \n Speaker: {speaker} \n")
+        raise e
+
+    finally:
+        # Hand the TTS model back to the registry, it stays resident for the next request
+        if tts is not None:
+            registry.release(tts)
 
 def get_speaker_file_path(speaker_name, base_path):
     """
@@ -0,0 +1,66 @@
+import subprocess
+import tempfile
+
+import numpy as np
+from whisperx.audio import SAMPLE_RATE
+
+
+def get_duration(path):
+    """
+    Returns the duration of an audio file in seconds, read from its container by ffprobe.
+
+    Returns:
+        float: The duration, or None if it cannot be read.
+    """
+    cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", path]
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+        return float(out.decode().strip())
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+def read_audio_blocks(path, block_seconds, sr=SAMPLE_RATE):
+    """
+    Decodes an audio file with ffmpeg, block_seconds at a time, resampled like whisperx.load_audio.
+    Only the current block is held in memory, whatever the length of the file.
+
+    Args:
+        path (str): The path to the audio file.
+        block_seconds (float): The length of the blocks, in seconds.
+        sr (int, optional): The sample rate to resample to. Defaults to SAMPLE_RATE.
+
+    Yields:
+        tuple: The block, as mono float32 samples, and whether it is the last one.
+
+    Raises:
+        RuntimeError: If ffmpeg fails to decode the file.
+    """
+    cmd = [
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-threads", "0", "-i", path,
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sr), "-",
+    ]
+    block_bytes = int(block_seconds * sr) * 2
+    # ffmpeg's errors go to a file rather than a pipe, which ffmpeg could fill and block on while stdout is being read
+    stderr_file = tempfile.TemporaryFile()
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file)
+    try:
+        # Read one block ahead to know which block is the last one
+        block = process.stdout.read(block_bytes)
+        while True:
+            next_block = process.stdout.read(block_bytes) if len(block) == block_bytes else b""
+            yield np.frombuffer(block, np.int16).astype(np.float32) / 32768.0, not next_block
+            if not next_block:
+                break
+            block = next_block
+
+        if process.wait() != 0:
+            # The last errors are the relevant ones
+            stderr_file.seek(max(0, stderr_file.seek(0, 2) - 4096))
+            raise RuntimeError(f"Failed to load audio: {stderr_file.read().decode(errors='replace')}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        stderr_file.close()
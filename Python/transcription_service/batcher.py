@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+
+import torch
+import whisperx
+from faster_whisper.tokenizer import Tokenizer
+from whisperx.audio import SAMPLE_RATE
+
+from model_registry import registry
+
+# How long the first episode of a batch waits for others to join it, in seconds
+STT_BATCH_WAIT = float(os.getenv("STT_BATCH_WAIT", "0.5"))
+
+# Largest number of episodes transcribed together
+STT_BATCH_MAX_EPISODES = int(os.getenv("STT_BATCH_MAX_EPISODES", "8"))
+
+# Largest length of a VAD segment, in seconds, like WhisperX's transcribe
+CHUNK_SIZE = 30
+
+
+class TranscriptionRequest:
+    """
+    An episode waiting to be transcribed by a TranscriptionBatcher.
+    """
+    def __init__(self, audio, language=None):
+        self.audio = audio
+        self.language = language
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def get_vad_segments(model, audio):
+    """
+    Splits the audio into the speech segments WhisperX transcribes, like FasterWhisperPipeline.transcribe does.
+
+    Returns:
+        list: The segments, as dicts with 'start' and 'end' in seconds.
+    """
+    if hasattr(model.vad_model, "preprocess_audio"):
+        # WhisperX 3.3+ VAD classes
+        waveform = model.vad_model.preprocess_audio(audio)
+        merge_chunks = model.vad_model.merge_chunks
+    else:
+        from whisperx.vad import merge_chunks
+        waveform = torch.from_numpy(audio).unsqueeze(0)
+
+    vad_segments = model.vad_model({"waveform": waveform, "sample_rate": SAMPLE_RATE})
+    return merge_chunks(vad_segments, CHUNK_SIZE, onset=model._vad_params["vad_onset"], offset=model._vad_params["vad_offset"])
+
+
+class TranscriptionBatcher:
+    """
+    Transcribes the episodes of several STT workers together with one resident WhisperX model.
+
+    Each episode is split into speech segments by the VAD and its language is detected. The segments of all the episodes
+    of the same language are then packed into shared batches for the CTranslate2 backend, instead of each episode filling
+    its own batches, and the results are handed back to each episode.
+    Episodes arriving within STT_BATCH_WAIT seconds of each other are transcribed together, so STT_WORKERS should be
+    above 1 for episodes to be batched. Batches hold batch_size segments, like those of a single episode, so batching
+    does not raise the peak memory of the model.
+
+    The segments are fed to the pipeline's __call__ with its tokenizer set to their language, like
+    FasterWhisperPipeline.transcribe does, which relies on WhisperX internals (hence the pinned WhisperX version in
+    requirements.txt). The model is exclusive in the registry, so no other caller sees the tokenizer change.
+    """
+    def __init__(self, model_name, device, compute_type, batch_size, max_wait=STT_BATCH_WAIT,
+                 max_episodes=STT_BATCH_MAX_EPISODES):
+        self.model_name = model_name
+        self.device = device
+        self.compute_type = compute_type
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_episodes = max_episodes
+
+        self.pending = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name=f"stt-batcher-{model_name}-{batch_size}", daemon=True)
+        self.thread.start()
+
+    def transcribe(self, audio, language=None):
+        """
+        Transcribes an episode along with the episodes submitted around the same time. Blocks until it is transcribed.
+
+        Args:
+            audio (np.ndarray): The audio of the episode, mono float32 at 16kHz.
+            language (str, optional): The language of the episode, detected when None. Defaults to None.
+
+        Returns:
+            dict: The 'segments' and 'language' of the episode, like FasterWhisperPipeline.transcribe.
+        """
+        request = TranscriptionRequest(audio, language)
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                # Give the other workers a chance to join the batch
+                deadline = time.time() + self.max_wait
+                while len(self.pending) < self.max_episodes and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                requests = self.pending[:self.max_episodes]
+                self.pending = self.pending[self.max_episodes:]
+
+            try:
+                self.process(requests)
+            except Exception as e:
+                for request in requests:
+                    if not request.done.is_set():
+                        request.error = e
+            finally:
+                for request in requests:
+                    request.done.set()
+
+    def process(self, requests):
+        """
+        Transcribes a group of episodes, one shared batch stream per language.
+        """
+        print(f"Transcribing {len(requests)} episodes together")
+        with registry.use("whisperx", self.model_name, self.device, self.compute_type) as model:
+            segments = {}
+            for request in requests:
+                try:
+                    segments[request] = get_vad_segments(model, request.audio)
+                    if request.language is None:
+                        request.language = model.detect_language(request.audio)
+                except Exception as e:
+                    request.error = e
+                    request.done.set()
+
+            languages = {request.language for request in segments}
+            for language in languages:
+                group = [request for request in segments if request.language == language]
+                # Every segment of the group, along with the episode it belongs to
+                items = [(request, segment) for request in group for segment in segments[request]]
+
+                def data():
+                    for request, segment in items:
+                        f1 = int(segment['start'] * SAMPLE_RATE)
+                        f2 = int(segment['end'] * SAMPLE_RATE)
+                        yield {'inputs': request.audio[f1:f2]}
+
+                model.tokenizer = Tokenizer(model.model.hf_tokenizer, model.model.model.is_multilingual, task="transcribe", language=language)
+                try:
+                    results = {request: [] for request in group}
+                    for (request, segment), out in zip(items, model(data(), batch_size=self.batch_size, num_workers=0)):
+                        text = out['text']
+                        if self.batch_size in [0, 1, None]:
+                            text = text[0]
+                        results[request].append({"text": text, "start": round(segment['start'], 3), "end": round(segment['end'], 3)})
+                finally:
+                    # Revert the tokenizer like transcribe does when the language is not fixed
+                    if model.preset_language is None:
+                        model.tokenizer = None
+
+                for request in group:
+                    request.result = {"segments": results[request], "language": language}
+                    request.done.set()
+
+
+batchers = {}
+batchers_lock = threading.Lock()
+
+def get_batcher(model_name, device, compute_type, batch_size):
+    """
+    Returns the TranscriptionBatcher of a WhisperX model and batch size, starting it on first use.
+    """
+    key = (model_name, device, compute_type, batch_size)
+    with batchers_lock:
+        if key not in batchers:
+            batchers[key] = TranscriptionBatcher(model_name, device, compute_type, batch_size)
+        return batchers[key]
@@ -0,0 +1,155 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from atomic_file import write_json_atomic
+from model_registry import registry
+import job_queue as jq
+
+# The config.yaml of a local copy of the pyannote diarization pipeline, whose segmentation and embedding models point at
+# local checkpoints too, so diarization runs offline. A Hugging Face hub id (e.g. "pyannote/speaker-diarization-3.1")
+# can be given instead to download the gated pipeline with HF_API_KEY on first use
+STT_DIARIZATION_MODEL = os.getenv("STT_DIARIZATION_MODEL", "ServerFiles/Models/speaker-diarization/config.yaml")
+
+# Device of the diarization model. It runs on the CPU by default, next to the transcription on the GPU
+STT_DIARIZATION_DEVICE = os.getenv("STT_DIARIZATION_DEVICE", "cpu")
+
+# Number of episodes diarized at the same time
+STT_DIARIZATION_WORKERS = int(os.getenv("STT_DIARIZATION_WORKERS", "1"))
+
+# Workers that diarize episodes while the STT workers transcribe and align them
+executor = ThreadPoolExecutor(max_workers=STT_DIARIZATION_WORKERS, thread_name_prefix="stt-diarization")
+
+
+def is_local_model(model_name):
+    """
+    Returns whether a diarization model is the config.yaml of a local pipeline rather than a Hugging Face hub id.
+    """
+    return model_name.endswith((".yaml", ".yml"))
+
+
+def check_model(model_name=STT_DIARIZATION_MODEL):
+    """
+    Checks that a diarization model can be loaded before diarizing with it. Hub ids are only checked when downloaded.
+
+    Raises:
+        FileNotFoundError: If the model is a local config.yaml that does not exist.
+    """
+    if is_local_model(model_name) and not os.path.isfile(model_name):
+        raise FileNotFoundError(
+            f"No diarization pipeline at {model_name}. Copy a pyannote speaker diarization pipeline there, "
+            f"or set STT_DIARIZATION_MODEL to its config.yaml (or to a Hugging Face hub id to download it)."
+        )
+
+
+def load_diarization_model(model_name, device, dtype):
+    """
+    Loads the pyannote diarization pipeline through WhisperX. Used by the model registry.
+
+    Raises:
+        FileNotFoundError: If the model is a local config.yaml that does not exist.
+    """
+    check_model(model_name)
+    use_auth_token = None if is_local_model(model_name) else os.getenv("HF_API_KEY")
+
+    # pyannote is only imported when diarization is used
+    from whisperx.diarize import DiarizationPipeline
+    return DiarizationPipeline(model_name=model_name, use_auth_token=use_auth_token, device=device)
+
+# The pipeline wraps its torch modules, so its size is given as a hint
+registry.register("diarization", load_diarization_model, size_hint_gb=0.1)
+
+
+def preload():
+    """
+    Loads the diarization model so that the first diarized episode does not pay for the load.
+    """
+    registry.preload("diarization", STT_DIARIZATION_MODEL, STT_DIARIZATION_DEVICE, "float32")
+
+
+def get_cache_file_path(audio_path):
+    """
+    Returns the path of the file caching the diarization of an episode.
+    """
+    return f'{os.path.splitext(audio_path)[0]}_diarization.json'
+
+
+def get_cache_key(audio_path, model_name):
+    """
+    Returns what the cached diarization of an episode depends on: the audio file and the model.
+    """
+    stat = os.stat(audio_path)
+    return {'audio': [stat.st_size, stat.st_mtime_ns], 'model': model_name}
+
+
+def diarize(audio_path, audio, model_name=STT_DIARIZATION_MODEL, device=STT_DIARIZATION_DEVICE):
+    """
+    Finds who speaks when in an episode. The result is cached next to the episode, so transcribing or aligning the
+    episode again does not diarize it again, as long as the audio file and the model are the same.
+
+    Parameters:
+        audio_path (str): The path to the audio file of the episode.
+        audio (np.ndarray): The audio of the episode, mono float32 at 16kHz.
+
+    Returns:
+        list: The speaker turns, as dicts with 'start' and 'end' in seconds and 'speaker'.
+    """
+    cache_file_path = get_cache_file_path(audio_path)
+    key = get_cache_key(audio_path, model_name)
+    try:
+        with open(cache_file_path, 'r') as cache_file:
+            cached = json.load(cache_file)
+        if cached['key'] == key:
+            print(f'Using the cached diarization of {audio_path}')
+            return cached['segments']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    with registry.use("diarization", model_name, device, "float32") as model:
+        diarize_segments = model(audio)
+
+    segments = [
+        {'start': round(float(row.start), 3), 'end': round(float(row.end), 3), 'speaker': row.speaker}
+        for row in diarize_segments.itertuples()
+    ]
+
+    write_json_atomic({'key': key, 'segments': segments}, cache_file_path)
+    return segments
+
+
+def submit(audio_path, audio):
+    """
+    Diarizes an episode on a diarization worker.
+
+    Returns:
+        Future: The future of the speaker turns (see diarize).
+    """
+    def run():
+        start = time.time()
+        segments = diarize(audio_path, audio)
+        return segments, time.time() - start
+
+    return executor.submit(run)
+
+
+def assign_speakers(segments, future):
+    """
+    Waits for the diarization of an episode and labels its aligned segments, and their words, with their speaker.
+    Segments that overlap no speaker turn are left without a 'speaker'.
+
+    Returns:
+        list: The segments.
+    """
+    import pandas as pd
+    from whisperx.diarize import assign_word_speakers
+
+    start = time.time()
+    speaker_turns, elapsed = future.result()
+    # Time the transcription waited for the diarization after aligning, the extra time diarization costs
+    jq.record_metric('diarization_seconds', round(elapsed, 2))
+    jq.record_metric('diarization_wait_seconds', round(time.time() - start, 2))
+
+    diarize_df = pd.DataFrame(speaker_turns, columns=['start', 'end', 'speaker'])
+    return assign_word_speakers(diarize_df, {'segments': segments})['segments']
+
@@ -0,0 +1,218 @@
+import bisect
+import json
+import os
+
+from atomic_file import write_json_atomic
+
+# Length of the seek buckets of a transcript, in seconds
+SEEK_INTERVAL = 30
+
+
+def get_partial_file_path(transcript_file_path):
+    """
+    Returns the path of the transcript of an episode while it is being written.
+    """
+    return f'{os.path.splitext(transcript_file_path)[0]}_partial.json'
+
+
+def get_index_file_path(transcript_file_path):
+    """
+    Returns the path of the seek index of a transcript.
+    """
+    return f'{os.path.splitext(transcript_file_path)[0]}_index.json'
+
+
+class SeekNumbering:
+    """
+    Assigns an id and a seek time to the lines of a transcript as they come.
+
+    The seek time of a line is the start time of the first line of its seek bucket. A new bucket starts with the first line
+    ending after the end of the previous bucket, the buckets being seek_interval seconds long.
+    """
+    def __init__(self, seek_interval=SEEK_INTERVAL):
+        self.seek_interval = seek_interval
+        self.next_seek_time = 0
+        self.current_seek_time = 0
+        self.current_id = 0
+
+    def __call__(self, line):
+        """
+        Sets the 'id' and 'seek' of a line.
+
+        Returns:
+            bool: Whether the line starts a new seek bucket.
+        """
+        line['id'] = self.current_id
+        self.current_id += 1
+
+        new_bucket = line['end'] > self.next_seek_time
+        if new_bucket:
+            self.next_seek_time = self.next_seek_time + self.seek_interval
+            self.current_seek_time = line['start']
+
+        line['seek'] = self.current_seek_time
+        return new_bucket
+
+
+class TranscriptWriter:
+    """
+    Writes a transcript as its segments are transcribed, numbering them on the fly.
+
+    The transcript is a JSON list with one line per segment, written to the partial file and kept valid after every call
+    to append(), so it can be read while the episode is being transcribed. close() renames it to the transcript file,
+    whose existence marks the transcription as done.
+
+    Along with it, a seek index lists the byte offset of the first line of every seek bucket, so that a range of the
+    transcript can be read without parsing the whole file (see read_transcript_range). The index is replaced atomically
+    after every append.
+
+    Example:
+        with TranscriptWriter(transcript_file_path) as writer:
+            for segments in windows:
+                writer.append(segments)
+    """
+    def __init__(self, transcript_file_path, seek_interval=SEEK_INTERVAL):
+        self.transcript_file_path = transcript_file_path
+        self.partial_file_path = get_partial_file_path(transcript_file_path)
+        self.index_file_path = get_index_file_path(transcript_file_path)
+        self.numbering = SeekNumbering(seek_interval)
+
+        # (seek time, byte offset, id) of the first line of every seek bucket
+        self.index = []
+        self.closed = False
+
+        # Lines are ASCII JSON (ensure_ascii), the file is binary so that offsets are bytes
+        self.file = open(self.partial_file_path, 'wb')
+        self.file.write(b'[\n]')
+        self.file.flush()
+        self.write_index()
+
+    def append(self, segments):
+        """
+        Numbers segments and appends them to the transcript.
+
+        Args:
+            segments (list): The segments, with 'start' and 'end' times in seconds, in order.
+
+        Returns:
+            list: The segments, with their 'id' and 'seek' set.
+        """
+        for segment in segments:
+            new_bucket = self.numbering(segment)
+
+            # Overwrite the closing bracket, then close the list again after the line
+            first = segment['id'] == 0
+            self.file.seek(-1 if first else -2, os.SEEK_END)
+            if not first:
+                self.file.write(b',\n')
+            offset = self.file.tell()
+            self.file.write(json.dumps(segment).encode() + b'\n]')
+
+            if new_bucket:
+                self.index.append([segment['seek'], offset, segment['id']])
+
+        self.file.flush()
+        self.write_index()
+        return segments
+
+    def write_index(self, complete=False):
+        write_json_atomic({
+            'seek_interval': self.numbering.seek_interval,
+            'lines': self.numbering.current_id,
+            'size': self.file.tell() if not complete else os.path.getsize(self.transcript_file_path),
+            'complete': complete,
+            'index': self.index,
+        }, self.index_file_path)
+
+    def close(self):
+        """
+        Publishes the transcript under the transcript file path.
+        """
+        if self.closed:
+            return
+        self.file.close()
+        os.replace(self.partial_file_path, self.transcript_file_path)
+        self.write_index(complete=True)
+        self.closed = True
+
+    def abort(self):
+        """
+        Stops writing without publishing the transcript. The partial transcript is left for inspection.
+        """
+        if not self.closed:
+            self.file.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_transcript_range(transcript_file_path, start=0, end=None):
+    """
+    Reads the lines of a transcript starting between start and end, from the finished transcript or, while it is being
+    written, from the partial one.
+
+    With a seek index matching the file, only the lines from the seek bucket of start onwards are parsed. Otherwise
+    (e.g. the transcript was edited since) the whole file is.
+
+    Args:
+        transcript_file_path (str): The path of the transcript.
+        start (float, optional): The earliest start time of the lines, in seconds. Defaults to 0.
+        end (float, optional): The latest start time of the lines, in seconds. Defaults to None (the end of the transcript).
+
+    Returns:
+        tuple: The lines, and whether the transcript is complete.
+
+    Raises:
+        FileNotFoundError: If there is neither a transcript nor a partial transcript.
+    """
+    complete = os.path.isfile(transcript_file_path)
+    file_path = transcript_file_path if complete else get_partial_file_path(transcript_file_path)
+    if not complete and not os.path.isfile(file_path):
+        # The partial transcript may have just been published
+        complete, file_path = True, transcript_file_path
+
+    def in_range(line):
+        return line['start'] >= start and (end is None or line['start'] <= end)
+
+    try:
+        with open(get_index_file_path(transcript_file_path), 'r') as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        index = None
+
+    with open(file_path, 'rb') as file:
+        # The partial transcript grows past the size in the index, a finished one must match it exactly
+        size = os.fstat(file.fileno()).st_size
+        if index is None or index['complete'] != complete or (size != index['size'] if complete else size < index['size']):
+            return [line for line in json.load(file) if in_range(line)], complete
+
+        # Start at the last bucket whose seek time is not after start
+        buckets = index['index']
+        if not buckets:
+            return [], complete
+        position = max(0, bisect.bisect_right([bucket[0] for bucket in buckets], start) - 1)
+        offset = buckets[position][1]
+        file.seek(offset)
+
+        lines = []
+        for raw_line in file:
+            # Lines written after the index was are skipped, the last one may be incomplete
+            offset += len(raw_line)
+            if offset > index['size']:
+                break
+            raw_line = raw_line.strip().rstrip(b',')
+            if not raw_line or raw_line == b']':
+                break
+            line = json.loads(raw_line)
+            if end is not None and line['start'] > end:
+                break
+            if in_range(line):
+                lines.append(line)
+        return lines, complete